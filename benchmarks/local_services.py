@@ -0,0 +1,273 @@
+import random
+import sqlite3
+import threading
+import time
+import zlib
+
+from contextlib import contextmanager
+from datetime import datetime
+from types import SimpleNamespace
+
+from azure.core.exceptions import ResourceNotFoundError
+
+from synthetic import PDF_CONTAINER, SyntheticReport
+
+LOCAL_SCHEMA = [
+    '''CREATE TABLE public.dicom_stow_rs (
+        id INTEGER PRIMARY KEY,
+        created_at TIMESTAMP NOT NULL
+    )''',
+    '''CREATE TABLE public.dicom_report (
+        id INTEGER PRIMARY KEY,
+        dicom_stow_rs_id INTEGER NOT NULL REFERENCES dicom_stow_rs(id),
+        file_name TEXT NOT NULL,
+        container_name TEXT NOT NULL
+    )''',
+    '''CREATE TABLE public.dicom_report_metadata (
+        dicom_report_id INTEGER PRIMARY KEY REFERENCES dicom_report(id),
+        readable BOOLEAN NOT NULL,
+        instance_created_at TIMESTAMP,
+        study_instance_uid TEXT,
+        series_instance_uid TEXT,
+        referenced_sop_instance_uid TEXT,
+        pdf_file_name TEXT,
+        updated_at TIMESTAMP
+    )''',
+    "CREATE INDEX public.dicom_stow_rs_created_at ON dicom_stow_rs (created_at)",
+]
+
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+sqlite3.register_converter("TIMESTAMP", lambda value: datetime.fromisoformat(value.decode()))
+
+
+class _Blob:
+    """
+    Blob content given by its leading bytes followed by `tail_size` zero bytes, the tail is never stored.
+    """
+    def __init__(self, head: bytes, tail_size: int = 0):
+        self.head = head
+        self.tail_size = tail_size
+        self.size = len(head) + tail_size
+        self.etag = f'"0x{zlib.crc32(head):08X}"'
+
+    def read(self, offset: int = 0, length: int | None = None) -> bytes:
+        end = self.size if length is None else min(self.size, offset + length)
+        content = self.head[offset:end]
+        return content + bytes(max(0, end - max(offset, len(self.head))))
+
+
+class _Downloader:
+    """
+    Stand-in for `azure.storage.blob.StorageStreamDownloader`.
+    """
+    def __init__(self, content: bytes):
+        self._content = content
+
+    def readall(self) -> bytes:
+        return self._content
+
+    def readinto(self, stream) -> int:
+        # write in chunks, as the real downloader does
+        for start in range(0, len(self._content), 4 * 1024 * 1024):
+            stream.write(self._content[start:start + 4 * 1024 * 1024])
+        return len(self._content)
+
+
+class LocalBlobClient:
+    """
+    Stand-in for `azure.storage.blob.BlobClient` serving one blob of a `LocalBlobService`.
+    """
+    def __init__(self, service: "LocalBlobService", container: str, blob: str):
+        self._service = service
+        self.container_name = container
+        self.blob_name = blob
+
+    def _blob(self) -> _Blob:
+        self._service.request()
+        blob = self._service.lookup(self.container_name, self.blob_name)
+        if blob is None:
+            raise ResourceNotFoundError(f"The specified blob does not exist: {self.container_name}/{self.blob_name}")
+        return blob
+
+    def get_blob_properties(self) -> SimpleNamespace:
+        blob = self._blob()
+        return SimpleNamespace(name=self.blob_name, container=self.container_name, size=blob.size, etag=blob.etag)
+
+    def download_blob(self, offset: int | None = None, length: int | None = None) -> _Downloader:
+        return _Downloader(self._blob().read(offset or 0, length))
+
+
+class _LocalPager:
+    """
+    Stand-in for the `azure.core.paging.ItemPaged` returned by `list_blobs`, every page costs a request.
+    """
+    def __init__(self, service: "LocalBlobService", blobs: list, page_size: int):
+        self._service = service
+        self._blobs = blobs
+        self._page_size = page_size
+
+    def __iter__(self):
+        for page in self.by_page():
+            yield from page
+
+    def by_page(self):
+        for start in range(0, len(self._blobs), self._page_size):
+            self._service.request()
+            yield iter(self._blobs[start:start + self._page_size])
+
+
+class LocalContainerClient:
+    """
+    Stand-in for `azure.storage.blob.ContainerClient`, only listing is supported.
+    """
+    def __init__(self, service: "LocalBlobService", container: str):
+        self._service = service
+        self.container_name = container
+
+    def list_blobs(self, name_starts_with: str | None = None, results_per_page: int = 5000) -> _LocalPager:
+        blobs = [
+            SimpleNamespace(name=name, container=container, size=blob.size, etag=blob.etag)
+            for (container, name), blob in sorted(self._service._blobs.items())
+            if container == self.container_name and name.startswith(name_starts_with or "")
+            and self._service.lookup(container, name) is not None
+        ]
+        return _LocalPager(self._service, blobs, results_per_page)
+
+
+class LocalBlobService:
+    """
+    In-process stand-in for `azure.storage.blob.BlobServiceClient`.
+    Every request sleeps for `latency` seconds (plus up to `jitter`), and a deterministic `miss_rate`
+    fraction of the blobs is reported as missing, the same blobs on every request.
+    """
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, miss_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.miss_rate = miss_rate
+        self.requests = 0
+        self._blobs = {}
+        self._lock = threading.Lock()
+
+    def add(self, container: str, name: str, head: bytes, tail_size: int = 0) -> None:
+        self._blobs[container, name] = _Blob(head, tail_size)
+
+    def add_reports(self, reports: list[SyntheticReport], pixel_bytes: int) -> None:
+        """
+        Upload the DICOM files and PDF reports of `reports`, PDFs under the `/tmp/` prefix the pipeline uses.
+        """
+        for report in reports:
+            self.add(report.container, report.file_name, report.dicom_header, pixel_bytes)
+            self.add(PDF_CONTAINER, "/tmp/" + report.pdf_file_name, report.pdf)
+
+    def lookup(self, container: str, name: str) -> _Blob | None:
+        if self.miss_rate and zlib.crc32(f"{container}/{name}".encode()) % 10_000 < self.miss_rate * 10_000:
+            return None
+        return self._blobs.get((container, name))
+
+    def request(self) -> None:
+        with self._lock:
+            self.requests += 1
+        delay = self.latency + self.jitter * random.random()
+        if delay:
+            time.sleep(delay)
+
+    def get_blob_client(self, container: str, blob: str) -> LocalBlobClient:
+        return LocalBlobClient(self, container, blob)
+
+    def get_container_client(self, container: str) -> LocalContainerClient:
+        return LocalContainerClient(self, container)
+
+    def close(self) -> None:
+        pass
+
+    # used in place of the `BlobServiceClient` class, every account is served by this instance
+    def from_connection_string(self, connection_string: str, **kwargs) -> "LocalBlobService":
+        return self
+
+
+class _LocalCursor:
+    """
+    Stand-in for a psycopg cursor, translates the `%(name)s` placeholders to SQLite ones.
+    """
+    def __init__(self, connection: "LocalPostgres"):
+        self._connection = connection
+        self._cursor = None
+        self.itersize = 100
+
+    def execute(self, query: str, params: dict | None = None) -> None:
+        query = query.replace("%(", ":").replace(")s", "").replace("now()", "CURRENT_TIMESTAMP")
+        self._connection.request()
+        with self._connection.lock:
+            self._cursor = self._connection.db.execute(query, params or {})
+            self._rows = self._cursor.fetchall()
+
+    def fetchall(self) -> list[tuple]:
+        return self._rows
+
+    def fetchone(self) -> tuple | None:
+        return self._rows[0] if self._rows else None
+
+    def __iter__(self):
+        # a server-side cursor pays a round trip for every `itersize` rows
+        for start in range(0, len(self._rows), self.itersize):
+            if start:
+                self._connection.request()
+            yield from self._rows[start:start + self.itersize]
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> "_LocalCursor":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class LocalPostgres:
+    """
+    In-process stand-in for the Postgres database with the `dicom_report` and `dicom_stow_rs` tables,
+    backed by an in-memory SQLite database. Every statement sleeps for `latency` seconds.
+    Use the instance in place of `psycopg.connect`.
+    """
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(":memory:", detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute("ATTACH DATABASE ':memory:' AS public")
+        for statement in LOCAL_SCHEMA:
+            self.db.execute(statement)
+
+    def add_reports(self, reports: list[SyntheticReport]) -> None:
+        """
+        Insert a `dicom_stow_rs` and a `dicom_report` row for every report.
+        """
+        with self.lock:
+            self.db.executemany("INSERT INTO dicom_stow_rs VALUES (?, ?)",
+                                [(report.id, report.created_at) for report in reports])
+            self.db.executemany("INSERT INTO dicom_report VALUES (?, ?, ?, ?)",
+                                [(report.id, report.id, report.file_name, report.container) for report in reports])
+
+    def request(self) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+
+    def cursor(self, name: str | None = None, withhold: bool = False) -> _LocalCursor:
+        return _LocalCursor(self)
+
+    @contextmanager
+    def transaction(self):
+        yield
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> "LocalPostgres":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __call__(self, **kwargs) -> "LocalPostgres":
+        return self
@@ -0,0 +1,237 @@
+"""
+Offline benchmarks of the pipeline in `src/aggregate_pdf_reports.py`.
+Azure Blob Storage and Postgres are replaced by the in-process stand-ins from `local_services.py`, filled with
+synthetic DICOM files and PDF reports from `synthetic.py`. Every scenario runs in its own process, so the
+reported peak RSS belongs to that scenario only.
+
+    python benchmarks/run_benchmarks.py [--reports 100 1000 10000] [--latency SECONDS] [--miss-rate RATE]
+"""
+import argparse
+import json
+import math
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from contextlib import ExitStack, redirect_stdout
+from datetime import datetime, timedelta
+from functools import partial, wraps
+from pathlib import Path
+from unittest.mock import patch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+import aggregate_pdf_reports  # noqa: E402
+
+from local_services import LocalBlobService, LocalPostgres  # noqa: E402
+from synthetic import DEFAULT_PIXEL_BYTES, generate_reports  # noqa: E402
+
+DEFAULT_SCENARIOS = [100, 1_000, 10_000]
+WINDOW_END = datetime(2025, 1, 15)
+WINDOW = timedelta(days=14)
+
+# pipeline functions timed per call, by stage
+TIMED_FUNCTIONS = {
+    "resolve": ["_get_dicom_metadata"],
+    "download": ["download_pdf_from_azure", "download_pdf_to_disk"],
+    "store": ["store_pdf_on_disk"],
+}
+
+
+class StageTimer:
+    """
+    Collects the latencies of the pipeline stages, safe to use from the pipeline threads.
+    """
+    def __init__(self):
+        self.latencies = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.latencies.setdefault(stage, []).append(seconds)
+
+    def timed(self, stage: str, func):
+        """
+        Wrap `func` so the duration of every call is recorded under `stage`.
+        """
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        return wrapper
+
+    def timed_merge(self, merge):
+        """
+        Wrap the merge step so only its tail is recorded: the time from the end of its input stream
+        to its return. The rest of the merge overlaps with the upstream stages.
+        """
+        @wraps(merge)
+        def wrapper(pdf_paths, **kwargs):
+            exhausted = []
+
+            def paths():
+                yield from pdf_paths
+                exhausted.append(time.perf_counter())
+
+            merge(paths(), **kwargs)
+            self.record("merge", time.perf_counter() - exhausted[0])
+        return wrapper
+
+    def summary(self) -> dict:
+        return {
+            stage: {
+                "count": len(latencies),
+                "p50_ms": round(_percentile(latencies, 0.50) * 1000, 3),
+                "p99_ms": round(_percentile(latencies, 0.99) * 1000, 3),
+            }
+            for stage, latencies in self.latencies.items()
+        }
+
+
+def _percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def run_scenario(reports: int, args: argparse.Namespace) -> dict:
+    """
+    Generate the synthetic data, run the pipeline once against the local stand-ins and return the measurements.
+    """
+    synthetic_reports = generate_reports(reports, WINDOW_END, WINDOW, args.pixel_bytes)
+    blob_service = LocalBlobService(args.latency, args.jitter, args.miss_rate)
+    blob_service.add_reports(synthetic_reports, args.pixel_bytes)
+    database = LocalPostgres(args.db_latency)
+    database.add_reports(synthetic_reports)
+    del synthetic_reports
+    setup_rss_mb = _peak_rss_mb()
+
+    timer = StageTimer()
+    with tempfile.TemporaryDirectory() as work_dir, ExitStack() as stack:
+        stack.enter_context(patch.dict(os.environ, {
+            "AZURE_CONNECTION_STRING": "local",
+            "PDF_TARGET_DIR": str(Path(work_dir) / "pdf_reports"),
+            "JOINED_PDF_TARGET_DIR": str(Path(work_dir) / "joined_pdfs"),
+        }))
+        stack.enter_context(patch("aggregate_pdf_reports.load_dotenv"))
+        stack.enter_context(patch("aggregate_pdf_reports.BlobServiceClient", blob_service))
+        stack.enter_context(patch("aggregate_pdf_reports.psycopg.connect", database))
+        for stage, names in TIMED_FUNCTIONS.items():
+            for name in names:
+                stack.enter_context(patch(f"aggregate_pdf_reports.{name}",
+                                          timer.timed(stage, getattr(aggregate_pdf_reports, name))))
+
+        session = stack.enter_context(aggregate_pdf_reports.PipelineSession(pool_size=max(2 * args.workers, 16),
+                                                                            list_blobs=args.list_blobs))
+        content_store = None
+        if args.mode == "content-store":
+            content_store = stack.enter_context(aggregate_pdf_reports.ContentStore(session.pdf_target_dir))
+        merge = aggregate_pdf_reports.join_pdfs
+        if args.mode == "stream":
+            merge = partial(aggregate_pdf_reports.join_pdfs, use_mmap=True)
+
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            aggregate_pdf_reports.run_pipeline(
+                WINDOW_END - WINDOW, WINDOW_END, workers=args.workers, header_only=args.header_only,
+                session=session, batch_size=args.batch_size, content_store=content_store,
+                merge=timer.timed_merge(merge), stream_to_disk=args.mode == "stream",
+                parse_workers=args.parse_workers)
+        elapsed = time.perf_counter() - start
+        joined_size = (session.joined_pdf_target_dir / "joined_report.pdf").stat().st_size
+
+    return {
+        "reports": reports,
+        "mode": args.mode,
+        "workers": args.workers,
+        "header_only": args.header_only,
+        "parse_workers": args.parse_workers,
+        "list_blobs": args.list_blobs,
+        "latency_ms": args.latency * 1000,
+        "miss_rate": args.miss_rate,
+        "seconds": round(elapsed, 3),
+        "reports_per_second": round(reports / elapsed, 1),
+        "blob_requests": blob_service.requests,
+        "joined_report_bytes": joined_size,
+        "stages": timer.summary(),
+        "setup_rss_mb": setup_rss_mb,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def _print_result(result: dict) -> None:
+    print(f"{result['reports']:>6} reports  {result['seconds']:>8.2f} s  {result['reports_per_second']:>8.1f} reports/s"
+          f"  peak RSS {result['peak_rss_mb']:.1f} MB")
+    for stage, stats in result["stages"].items():
+        print(f"        {stage:<9} n={stats['count']:<6}"
+              f" p50 {stats['p50_ms']:>9.3f} ms  p99 {stats['p99_ms']:>9.3f} ms")
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the PDF report pipeline against local stand-ins.")
+    parser.add_argument("--reports", type=int, nargs="+", default=DEFAULT_SCENARIOS,
+                        help="Number of reports of every scenario (default: 100 1000 10000).")
+    parser.add_argument("--mode", choices=["default", "stream", "content-store"], default="default",
+                        help="How PDFs are stored: numbered files, streamed to disk or in the content store.")
+    parser.add_argument("--workers", type=int, default=8, help="Pipeline workers (default: 8).")
+    parser.add_argument("--parse-workers", type=int, default=0, help="DICOM parsing processes (default: 0).")
+    parser.add_argument("--header-only", action="store_true", help="Download only the DICOM headers.")
+    parser.add_argument("--list-blobs", action="store_true", help="List the containers instead of probing blobs.")
+    parser.add_argument("--batch-size", type=int, default=None, help="Stream DB rows in batches of this size.")
+    parser.add_argument("--latency", type=float, default=0.005,
+                        help="Latency of every blob request in seconds (default: 0.005).")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random extra blob latency up to this many seconds.")
+    parser.add_argument("--db-latency", type=float, default=0.001,
+                        help="Latency of every DB round trip in seconds (default: 0.001).")
+    parser.add_argument("--miss-rate", type=float, default=0.02,
+                        help="Fraction of blobs reported as missing (default: 0.02).")
+    parser.add_argument("--pixel-bytes", type=int, default=DEFAULT_PIXEL_BYTES,
+                        help="Size of the DICOM pixel data (default: a 512x512 16-bit image).")
+    parser.add_argument("--output", type=Path, default=None,
+                        help="Append the results as JSON lines to this file, to track them across releases.")
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    if args.single:
+        # a scenario run by the parent process, the result is the last line of the output
+        print(json.dumps(run_scenario(args.reports[0], args)))
+        return
+
+    revision = _revision()
+    for reports in args.reports:
+        child_argv = list(argv if argv is not None else sys.argv[1:])
+        completed = subprocess.run(
+            [sys.executable, __file__, *child_argv, "--reports", str(reports), "--single"],
+            capture_output=True, text=True, check=True)
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        result["revision"] = revision
+        _print_result(result)
+        if args.output is not None:
+            with args.output.open("a") as output:
+                output.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
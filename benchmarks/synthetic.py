@@ -0,0 +1,112 @@
+import random
+
+from datetime import datetime, timedelta
+from io import BytesIO
+from typing import NamedTuple
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+
+DICOM_CONTAINER = "dicoms"
+PDF_CONTAINER = "pdf-reports"
+
+# a 512x512 16-bit image, the usual size of a CT or MR slice
+DEFAULT_PIXEL_BYTES = 512 * 512 * 2
+
+
+class SyntheticReport(NamedTuple):
+    """
+    One synthetic DICOM report: its DB row values, the DICOM blob and the PDF report it points to.
+    """
+    id: int
+    file_name: str
+    container: str
+    created_at: datetime
+    pdf_file_name: str
+    dicom_header: bytes
+    pdf: bytes
+
+
+def make_dicom_header(study_uid: str, series_uid: str, sop_uid: str, created: datetime,
+                      pixel_bytes: int) -> bytes:
+    """
+    Build a DICOM file with the tags needed for the PDF report name, up to the header of its pixel data.
+    The `pixel_bytes` bytes of pixel data follow the returned bytes in the complete file.
+    """
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.7"
+    file_meta.MediaStorageSOPInstanceUID = _uid(sop_uid, "instance")
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.InstanceCreationDate = created.strftime("%Y%m%d")
+    ds.InstanceCreationTime = created.strftime("%H%M%S")
+    ds.Modality = "OT"
+    ds.PatientName = "Synthetic^Patient"
+    ds.PatientID = "BENCH"
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = _uid(sop_uid, "series")
+    series = Dataset()
+    series.SeriesInstanceUID = series_uid
+    ds.ReferencedSeriesSequence = [series]
+    step = Dataset()
+    step.ReferencedSOPInstanceUID = sop_uid
+    ds.ReferencedPerformedProcedureStepSequence = [step]
+    ds.BitsAllocated = 16
+
+    buffer = BytesIO()
+    ds.save_as(buffer, enforce_file_format=True)
+    # the pixel data element header: tag (7FE0,0010), VR OW, two reserved bytes and the 32-bit length
+    return buffer.getvalue() + b"\xe0\x7f\x10\x00OW\x00\x00" + pixel_bytes.to_bytes(4, "little")
+
+
+def make_pdf(title: str, lines: int = 40) -> bytes:
+    """
+    Build a single-page PDF report with the given title and `lines` lines of text.
+    """
+    buffer = BytesIO()
+    pdf = canvas.Canvas(buffer, pagesize=A4)
+    pdf.drawString(72, 800, title)
+    for i in range(lines):
+        pdf.drawString(72, 780 - i * 18, f"Finding {i + 1}: synthetic report text for benchmarking purposes.")
+    pdf.showPage()
+    pdf.save()
+    return buffer.getvalue()
+
+
+def generate_reports(count: int, to: datetime, delta: timedelta, pixel_bytes: int = DEFAULT_PIXEL_BYTES,
+                     seed: int = 0) -> list[SyntheticReport]:
+    """
+    Generate `count` reports created uniformly within `delta` before `to`, ids in ascending creation order.
+    Several reports belong to one study, as in a real archive.
+    """
+    rng = random.Random(seed)
+    offsets = sorted(rng.uniform(1, delta.total_seconds()) for _ in range(count))
+    reports = []
+    study_uid = None
+    for i, offset in enumerate(offsets):
+        if study_uid is None or rng.random() < 0.3:
+            study_uid = _uid(seed, i, "study")
+        series_uid, sop_uid = _uid(seed, i, "series"), _uid(seed, i, "sop")
+        created = (to - delta + timedelta(seconds=offset)).replace(microsecond=0)
+        pdf_file_name = f"{study_uid}_{series_uid}_{sop_uid}.pdf"
+        reports.append(SyntheticReport(
+            id=i + 1,
+            file_name=f"{study_uid}/{_uid(seed, i, 'file')}.dcm",
+            container=DICOM_CONTAINER,
+            created_at=created,
+            pdf_file_name=pdf_file_name,
+            dicom_header=make_dicom_header(study_uid, series_uid, sop_uid, created, pixel_bytes),
+            pdf=make_pdf(f"Report {i + 1} of study {study_uid}"),
+        ))
+    return reports
+
+
+def _uid(*parts) -> str:
+    # deterministic UIDs, so the same seed gives the same reports (and the same missing blobs) on every run
+    return generate_uid(entropy_srcs=[str(part) for part in parts])
@@ -0,0 +1,38 @@
+-- rollups of the task1-3 queries, maintained incrementally by src/aet_analytics.py
+CREATE TABLE IF NOT EXISTS aet_rollup_watermark (
+  source TEXT PRIMARY KEY,
+  last_id BIGINT NOT NULL,
+  updated_at TIMESTAMP NOT NULL DEFAULT now()
+);
+
+INSERT INTO aet_rollup_watermark (source, last_id) VALUES ('dicom_stow_rs', 0), ('prediction', 0)
+ON CONFLICT (source) DO NOTHING;
+
+-- ids folded in the last band below the watermarks, rows committed late in the band are folded by a later refresh
+CREATE TABLE IF NOT EXISTS aet_rollup_folded (
+  source TEXT NOT NULL,
+  id BIGINT NOT NULL,
+  PRIMARY KEY (source, id)
+);
+
+-- task1: the first scan of every AET
+CREATE TABLE IF NOT EXISTS aet_first_scan (
+  aet TEXT PRIMARY KEY,
+  first_scan TIMESTAMP NOT NULL
+);
+
+-- task2: the number of predictions of every severity per AET
+CREATE TABLE IF NOT EXISTS aet_severity_counts (
+  aet TEXT NOT NULL,
+  severity TEXT NOT NULL,
+  count BIGINT NOT NULL,
+  PRIMARY KEY (aet, severity)
+);
+
+-- task3: the number of scans per AET and month
+CREATE TABLE IF NOT EXISTS aet_monthly_counts (
+  aet TEXT NOT NULL,
+  month TEXT NOT NULL,
+  count BIGINT NOT NULL,
+  PRIMARY KEY (aet, month)
+);
@@ -0,0 +1,13 @@
+CREATE TABLE IF NOT EXISTS dicom_report_metadata (
+  dicom_report_id BIGINT PRIMARY KEY REFERENCES dicom_report(id) ON DELETE CASCADE,
+  readable BOOLEAN NOT NULL,
+  instance_created_at TIMESTAMP,
+  study_instance_uid TEXT,
+  series_instance_uid TEXT,
+  referenced_sop_instance_uid TEXT,
+  pdf_file_name TEXT,
+  updated_at TIMESTAMP NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS dicom_report_metadata_instance_created_at_idx
+ON dicom_report_metadata (instance_created_at);
@@ -0,0 +1,221 @@
+from __future__ import annotations
+
+import argparse
+import sys
+
+from time import perf_counter
+
+from aggregate_pdf_reports import PipelineSession
+
+# the rows of `dicom_stow_rs` and `prediction` up to the watermarks are already counted in the rollups,
+# see sql/aet_rollups.sql for the tables
+WATERMARK_LOCK_QUERY = "SELECT last_id FROM aet_rollup_watermark WHERE source = %(source)s FOR UPDATE"
+WATERMARK_UPDATE = "UPDATE aet_rollup_watermark SET last_id = %(until)s, updated_at = now() WHERE source = %(source)s"
+ROLLUPS_TRUNCATE = "TRUNCATE aet_first_scan, aet_severity_counts, aet_monthly_counts, aet_rollup_folded"
+WATERMARKS_RESET = "UPDATE aet_rollup_watermark SET last_id = 0, updated_at = now()"
+WATERMARKS_QUERY = "SELECT source, last_id FROM aet_rollup_watermark"
+
+# ids are taken when the rows are inserted, not when they commit, a transaction still in progress may commit rows
+# with lower ids than the ones already folded. Every refresh folds the rows of the last `LATE_COMMIT_IDS` ids
+# below the watermark again, except the ones recorded in `aet_rollup_folded`, which holds the ids of that band
+LATE_COMMIT_IDS = 10_000
+FOLDED_PRUNE = "DELETE FROM aet_rollup_folded WHERE source = %(source)s AND id <= %(below)s"
+
+
+def _not_folded(source: str) -> str:
+    """
+    Condition on the rows of `source` that are not recorded as folded.
+    """
+    return f'''NOT EXISTS (SELECT 1 FROM aet_rollup_folded AS folded
+                WHERE folded.source = '{source}' AND folded.id = {source}.id)'''
+
+
+def _counted(source: str) -> str:
+    """
+    Condition on the rows of `source` counted in the rollups, given the watermarks as parameters named by the sources.
+    """
+    return f'''{source}.id <= %({source})s AND ({source}.id <= %({source})s - {LATE_COMMIT_IDS}
+                OR EXISTS (SELECT 1 FROM aet_rollup_folded AS folded
+                    WHERE folded.source = '{source}' AND folded.id = {source}.id))'''
+
+
+AET_SCANS_JOIN = '''FROM aet
+            JOIN study ON study.calling_aet_id = aet.id
+            JOIN series ON series.study_id = study.id
+            JOIN dicom_stow_rs ON dicom_stow_rs.series_id = series.id'''
+# predictions without a severity cannot be keyed in the rollup, they are left out of both the rollup and the check
+AET_PREDICTIONS_JOIN = AET_SCANS_JOIN + '''
+            JOIN prediction ON prediction.dicom_stow_rs_id = dicom_stow_rs.id
+            AND prediction.prediction_string IS NOT NULL'''
+
+# every update folds the rows with an id after `since` and up to `until` that are not folded yet into a rollup
+FIRST_SCAN_UPSERT = f'''INSERT INTO aet_first_scan (aet, first_scan)
+            SELECT aet.name, min(dicom_stow_rs.created_at) {AET_SCANS_JOIN}
+            WHERE dicom_stow_rs.id > %(since)s AND dicom_stow_rs.id <= %(until)s
+            AND {_not_folded("dicom_stow_rs")}
+            GROUP BY aet.name
+            ON CONFLICT (aet) DO UPDATE SET first_scan = LEAST(aet_first_scan.first_scan, EXCLUDED.first_scan)
+            '''
+MONTHLY_COUNTS_UPSERT = f'''INSERT INTO aet_monthly_counts (aet, month, count)
+            SELECT aet.name, TO_CHAR(dicom_stow_rs.created_at, 'YYYY-MM'), COUNT(*) {AET_SCANS_JOIN}
+            WHERE dicom_stow_rs.id > %(since)s AND dicom_stow_rs.id <= %(until)s
+            AND {_not_folded("dicom_stow_rs")}
+            GROUP BY aet.name, TO_CHAR(dicom_stow_rs.created_at, 'YYYY-MM')
+            ON CONFLICT (aet, month) DO UPDATE SET count = aet_monthly_counts.count + EXCLUDED.count
+            '''
+SEVERITY_COUNTS_UPSERT = f'''INSERT INTO aet_severity_counts (aet, severity, count)
+            SELECT aet.name, prediction.prediction_string, COUNT(*) {AET_PREDICTIONS_JOIN}
+            WHERE prediction.id > %(since)s AND prediction.id <= %(until)s
+            AND {_not_folded("prediction")}
+            GROUP BY aet.name, prediction.prediction_string
+            ON CONFLICT (aet, severity) DO UPDATE SET count = aet_severity_counts.count + EXCLUDED.count
+            '''
+
+# source table, the query for its current maximal id, the rollup updates fed by it and the query recording
+# the folded ids
+SOURCES = tuple(
+    (source, f"SELECT coalesce(max(id), 0) FROM {source}", updates,
+     f'''INSERT INTO aet_rollup_folded (source, id) SELECT '{source}', id FROM {source}
+            WHERE id > %(since)s AND id <= %(until)s AND {_not_folded(source)}''')
+    for source, updates in (("dicom_stow_rs", (FIRST_SCAN_UPSERT, MONTHLY_COUNTS_UPSERT)),
+                            ("prediction", (SEVERITY_COUNTS_UPSERT,)))
+)
+
+# the reports of task1-3 served from the rollups, and the same reports computed from the rows of the source tables
+# counted in the rollups
+REPORTS = {
+    "first-scan": '''SELECT aet, DATE(first_scan) AS first_scan FROM aet_first_scan ORDER BY aet''',
+    "severity": '''SELECT aet, severity, count FROM aet_severity_counts ORDER BY aet, severity''',
+    "monthly": '''SELECT aet, month, count, ROUND(AVG(count) OVER (PARTITION BY aet), 2) AS average_per_month
+            FROM aet_monthly_counts ORDER BY month, aet''',
+}
+DIRECT_REPORTS = {
+    "first-scan": f'''SELECT aet.name, DATE(min(dicom_stow_rs.created_at)) {AET_SCANS_JOIN}
+            WHERE {_counted("dicom_stow_rs")}
+            GROUP BY aet.name ORDER BY aet.name''',
+    "severity": f'''SELECT aet.name, prediction.prediction_string, COUNT(*) {AET_PREDICTIONS_JOIN}
+            WHERE {_counted("prediction")}
+            GROUP BY aet.name, prediction.prediction_string ORDER BY aet.name, prediction.prediction_string''',
+    "monthly": f'''WITH monthly_counts AS (
+                SELECT aet.name, TO_CHAR(dicom_stow_rs.created_at, 'YYYY-MM') AS month, COUNT(*) AS entry_count
+                {AET_SCANS_JOIN}
+                WHERE {_counted("dicom_stow_rs")}
+                GROUP BY aet.name, TO_CHAR(dicom_stow_rs.created_at, 'YYYY-MM')
+            )
+            SELECT name, month, entry_count, ROUND(AVG(entry_count) OVER (PARTITION BY name), 2)
+            FROM monthly_counts ORDER BY month, name''',
+}
+
+
+def refresh_rollups(conn) -> dict[str, int]:
+    """
+    Fold the `dicom_stow_rs` and `prediction` rows added since the watermarks into the rollups, with the rows
+    of the last `LATE_COMMIT_IDS` ids below them that committed after the previous refresh.
+    Runs in a single transaction holding the watermark rows, so concurrent refreshes never count a row twice
+    and the rollups never lag behind their watermarks. Returns the number of rows folded per source.
+    """
+    folded = {}
+    with conn.transaction(), conn.cursor() as cur:
+        for source, max_id_query, updates, folded_insert in SOURCES:
+            cur.execute(WATERMARK_LOCK_QUERY, {"source": source})
+            last_id = cur.fetchone()[0]
+            cur.execute(max_id_query)
+            until = max(cur.fetchone()[0], last_id)
+            params = {"since": max(0, last_id - LATE_COMMIT_IDS), "until": until}
+            for update in updates:
+                cur.execute(update, params)
+            cur.execute(folded_insert, params)
+            if cur.rowcount <= 0:
+                continue
+            folded[source] = cur.rowcount
+            cur.execute(WATERMARK_UPDATE, {"source": source, "until": until})
+            cur.execute(FOLDED_PRUNE, {"source": source, "below": until - LATE_COMMIT_IDS})
+    return folded
+
+
+def rebuild_rollups(conn) -> dict[str, int]:
+    """
+    Recompute the rollups from scratch, atomically, readers see either the old or the rebuilt rollups.
+    """
+    with conn.transaction():
+        conn.execute(ROLLUPS_TRUNCATE)
+        conn.execute(WATERMARKS_RESET)
+        return refresh_rollups(conn)
+
+
+def report(conn, name: str) -> list[tuple]:
+    """
+    Return the rows of a report ("first-scan", "severity" or "monthly") served from the rollups.
+    """
+    with conn.cursor() as cur:
+        cur.execute(REPORTS[name])
+        return cur.fetchall()
+
+
+def verify_rollups(conn) -> list[str]:
+    """
+    Compare every report served from the rollups with the same report computed from the rows of the source tables
+    counted in them, the rows not folded yet are left out of both. Returns the names of the reports that differ.
+    """
+    mismatched = []
+    # one snapshot, so rows arriving meanwhile do not show up in only one of the two
+    with conn.transaction():
+        conn.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        with conn.cursor() as cur:
+            cur.execute(WATERMARKS_QUERY)
+            watermarks = dict(cur.fetchall())
+        for name, direct_query in DIRECT_REPORTS.items():
+            with conn.cursor() as cur:
+                cur.execute(direct_query, watermarks)
+                direct = [tuple(row) for row in cur.fetchall()]
+            if [tuple(row) for row in report(conn, name)] != direct:
+                mismatched.append(name)
+    return mismatched
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Maintain and serve the AET rollups of the sql/task1-3 queries.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("refresh", help="Fold the rows added since the last refresh into the rollups.")
+    rebuild = commands.add_parser("rebuild", help="Recompute the rollups from scratch.")
+    rebuild.add_argument(
+        "--verify",
+        action="store_true",
+        help="Compare the rebuilt rollups with the reports computed from the source tables.",
+    )
+    commands.add_parser("verify", help="Compare the rollups with the reports computed from the source tables.")
+    show = commands.add_parser("report", help="Print a report served from the rollups.")
+    show.add_argument("name", choices=sorted(REPORTS))
+    show.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Refresh the rollups before serving the report.",
+    )
+    args = parser.parse_args(argv)
+
+    with PipelineSession() as session:
+        conn = session.pg_connection()
+        if args.command in ("refresh", "rebuild") or getattr(args, "refresh", False):
+            start = perf_counter()
+            folded = rebuild_rollups(conn) if args.command == "rebuild" else refresh_rollups(conn)
+            for source, rows in folded.items():
+                print(f"📊 {rows} {source} rows folded into the rollups")
+            print(f"Rollups up to date in {(perf_counter() - start) * 1000:.1f} ms")
+
+        if args.command == "report":
+            start = perf_counter()
+            rows = report(conn, args.name)
+            for row in rows:
+                print("\t".join(str(value) for value in row))
+            print(f"{len(rows)} rows in {(perf_counter() - start) * 1000:.1f} ms", file=sys.stderr)
+
+        if args.command == "verify" or getattr(args, "verify", False):
+            mismatched = verify_rollups(conn)
+            if mismatched:
+                print(f"❌ Rollups differ from the source tables: {', '.join(mismatched)}")
+                sys.exit(1)
+            print("✅ Rollups match the source tables")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,232 +1,2014 @@
-import psycopg
+from __future__ import annotations
+
 import os
 import re
-import pydicom
 import logging
 import argparse
+import importlib
+import multiprocessing
+import mmap
+import sys
+import tempfile
+import hashlib
+import json
+import threading
+
+from collections import deque
+from contextlib import ExitStack, nullcontext
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import cache, partial
+from itertools import chain
+from time import sleep
+from io import BytesIO
+from pathlib import Path
+from queue import Empty, Full, Queue
+from typing import Callable, Iterable, Iterator, NamedTuple, TypeVar
+
+from blob_listing import BlobListing
+from byte_budget import ByteBudget
+from metadata_index import DicomMetadata, MetadataIndex
+from missing_blobs import MissingBlobCache
+from pdf_store import ContentStore
+from run_journal import RunJournal
+from shards import Shard, ShardReport, merge_shards, plan_shards, shard_path, write_shard
+from pipeline_state import (DEFAULT_STATE_DIR, NAMES_FILE, PDFS_FILE, WATCH_FILE, read_json, read_lines, write_json,
+                            write_lines)
+from telemetry import RunMetrics, Span, configure_logging
+
+
+class _LazyImport:
+    """
+    Stand-in for a module, or for an attribute of a module, that is imported on its first use.
+    The heavy libraries are only imported by the stages that need them, `--help` or a merge imports none of them.
+    """
+    def __init__(self, module: str, attribute: str | None = None):
+        self._module = module
+        self._attribute = attribute
+        self._target = None
+        self._lock = threading.Lock()
+
+    def _resolve(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    target = importlib.import_module(self._module)
+                    self._target = getattr(target, self._attribute) if self._attribute else target
+        return self._target
+
+    def __getattr__(self, name: str):
+        return getattr(self._resolve(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+
+psycopg = _LazyImport("psycopg")
+pydicom = _LazyImport("pydicom")
+requests = _LazyImport("requests")
+azure_exceptions = _LazyImport("azure.core.exceptions")
+load_dotenv = _LazyImport("dotenv", "load_dotenv")
+RequestsTransport = _LazyImport("azure.core.pipeline.transport", "RequestsTransport")
+BlobServiceClient = _LazyImport("azure.storage.blob", "BlobServiceClient")
+read_partial = _LazyImport("pydicom.filereader", "read_partial")
+Tag = _LazyImport("pydicom.tag", "Tag")
+PdfReader = _LazyImport("pypdf", "PdfReader")
+PdfWriter = _LazyImport("pypdf", "PdfWriter")
+pdf_generic = _LazyImport("pypdf.generic")
+HTTPAdapter = _LazyImport("requests.adapters", "HTTPAdapter")
+
+MAX_RETRIES = 5
+# number of items buffered between two stages of the streaming pipeline
+PIPELINE_QUEUE_SIZE = 64
+# blobs larger than this are downloaded in this many parallel ranges
+LARGE_BLOB_SIZE = 32 * 1024 * 1024
+LARGE_BLOB_CONCURRENCY = 4
+# default ceilings of a single part of the split joined report
+JOINED_PART_MAX_PAGES = 1000
+JOINED_PART_MAX_BYTES = 200 * 1024 * 1024
+# cycles of the watch mode in which a PDF report that could not be downloaded is retried
+WATCH_PDF_RETRIES = 10
+# ids below the high-water mark queried again by every watch cycle, the ids of rows inserted by concurrent
+# transactions are not committed in order, a row may become visible after a row with a higher id
+WATCH_RESCAN_IDS = 1000
+# keys of the grouped output, one joined report per sending AET or per study, see `join_pdfs_grouped`
+GROUP_BY = ("aet", "study")
+# group of the reports whose DICOM report is not linked to an AET
+UNKNOWN_GROUP = "unknown"
+# initial size of the ranged read used to fetch only the DICOM header, doubled until the header fits
+DICOM_HEADER_CHUNK_SIZE = 64 * 1024
+# the only tags needed to assemble the PDF file name, all of them are stored near the start of the file
+DICOM_HEADER_KEYWORDS = (
+    "InstanceCreationDate", "InstanceCreationTime", "ReferencedPerformedProcedureStepSequence",
+    "ReferencedSeriesSequence", "StudyInstanceUID", "SeriesInstanceUID",
+)
+
+# query for retriving dcm files
+DICOM_REPORTS_QUERY = '''SELECT dicom_report.file_name, dicom_report.container_name FROM public.dicom_report
+            JOIN dicom_stow_rs ON dicom_report.dicom_stow_rs_id = dicom_stow_rs.id
+            WHERE created_at > %(from)s AND created_at <= %(to)s
+            ORDER BY dicom_report.id DESC
+            '''
+
+# the same query with the report ids, limited to a range of them, the outputs of the shards of a window
+# are merged by the ids and the watch mode queries only the reports above its high-water mark
+DICOM_REPORTS_ID_QUERY = '''SELECT dicom_report.file_name, dicom_report.container_name, dicom_report.id
+            FROM public.dicom_report
+            JOIN dicom_stow_rs ON dicom_report.dicom_stow_rs_id = dicom_stow_rs.id
+            WHERE created_at > %(from)s AND created_at <= %(to)s
+            AND dicom_report.id > %(since)s AND dicom_report.id <= %(until)s
+            ORDER BY dicom_report.id DESC
+            '''
+DICOM_REPORTS_MAX_ID_QUERY = "SELECT coalesce(max(id), 0) FROM public.dicom_report"
+# creation times of a range of reports, the watch mode drops the reports that left its window
+DICOM_REPORTS_CREATED_QUERY = '''SELECT dicom_report.id, created_at FROM public.dicom_report
+            JOIN dicom_stow_rs ON dicom_report.dicom_stow_rs_id = dicom_stow_rs.id
+            WHERE dicom_report.id > %(since)s AND dicom_report.id <= %(until)s
+            '''
+# the largest Postgres bigint, the upper bound of the ids when not limited
+MAX_REPORT_ID = 2 ** 63 - 1
+
+# the same query joined with the metadata backfilled into the DB, rows whose stored metadata does not give
+# a PDF report in the time slot of the whole window are filtered out by the DB, rows without stored metadata are kept
+DICOM_REPORTS_INDEXED_QUERY = '''SELECT dicom_report.file_name, dicom_report.container_name, dicom_report.id,
+            metadata.readable, metadata.instance_created_at, metadata.study_instance_uid,
+            metadata.series_instance_uid, metadata.referenced_sop_instance_uid
+            FROM public.dicom_report
+            JOIN dicom_stow_rs ON dicom_report.dicom_stow_rs_id = dicom_stow_rs.id
+            LEFT JOIN dicom_report_metadata AS metadata ON metadata.dicom_report_id = dicom_report.id
+            WHERE created_at > %(from)s AND created_at <= %(to)s
+            AND dicom_report.id > %(since)s AND dicom_report.id <= %(until)s
+            AND (metadata.dicom_report_id IS NULL OR (metadata.pdf_file_name IS NOT NULL
+                 AND metadata.instance_created_at > %(window_from)s
+                 AND metadata.instance_created_at <= %(window_to)s))
+            ORDER BY dicom_report.id DESC
+            '''
+DB_METADATA_UPSERT = '''INSERT INTO dicom_report_metadata (dicom_report_id, readable, instance_created_at,
+            study_instance_uid, series_instance_uid, referenced_sop_instance_uid, pdf_file_name)
+            VALUES (%(id)s, %(readable)s, %(created)s, %(study)s, %(series)s, %(sop)s, %(pdf)s)
+            ON CONFLICT (dicom_report_id) DO UPDATE SET readable = EXCLUDED.readable,
+                instance_created_at = EXCLUDED.instance_created_at,
+                study_instance_uid = EXCLUDED.study_instance_uid,
+                series_instance_uid = EXCLUDED.series_instance_uid,
+                referenced_sop_instance_uid = EXCLUDED.referenced_sop_instance_uid,
+                pdf_file_name = EXCLUDED.pdf_file_name, updated_at = now()
+            '''
+
+# the sending AET of every DICOM report of the window, through the same tables as the sql/ queries
+REPORT_AETS_QUERY = '''SELECT dicom_report.file_name, dicom_report.container_name, aet.name FROM public.dicom_report
+            JOIN dicom_stow_rs ON dicom_report.dicom_stow_rs_id = dicom_stow_rs.id
+            JOIN series ON dicom_stow_rs.series_id = series.id
+            JOIN study ON series.study_id = study.id
+            JOIN aet ON study.calling_aet_id = aet.id
+            WHERE dicom_stow_rs.created_at > %(from)s AND dicom_stow_rs.created_at <= %(to)s
+            '''
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class BlobDownloadError(Exception):
+    """
+    A blob could not be downloaded for a reason other than not being in the storage.
+    """
+
+
+class PipelineSession:
+    """
+    Configuration and connections shared by all the steps of a run.
+    The environment is loaded once, one Azure client with a pooled HTTP transport is kept per storage
+    account and a single Postgres connection is opened on first use. Close the session (or use it as
+    a context manager) to release them.
+    With `missing_blobs`, blobs known to be missing from the storage are skipped without a request.
+    With `list_blobs`, the containers are listed once and blobs missing from the listing are skipped.
+    With `byte_budget`, the DICOM and PDF downloads of the session share a cap on the bytes held in memory.
+    """
+    def __init__(self, pool_size: int = 16, missing_blobs: MissingBlobCache | None = None, list_blobs: bool = False,
+                 byte_budget: ByteBudget | None = None):
+        load_dotenv()
+        self.pg_host = os.getenv("PG_HOST")
+        self.pg_user = os.getenv("PG_USER")
+        self.pg_port = os.getenv("PG_PORT")
+        self.pg_database = os.getenv("PG_DATABASE")
+        self.pg_password = os.getenv("PG_PASSWORD")
+        self.connection_string = os.getenv("AZURE_CONNECTION_STRING")
+        self.pdf_target_dir = Path(os.getenv("PDF_TARGET_DIR", "pdf_reports"))
+        self.joined_pdf_target_dir = Path(os.getenv("JOINED_PDF_TARGET_DIR", "joined_pdfs"))
+        self.pool_size = pool_size
+        self.missing_blobs = missing_blobs
+        self.byte_budget = byte_budget
+        # per-stage telemetry of everything run with the session
+        self.metrics = RunMetrics()
+        # PDF reports are stored under the /tmp/ prefix, see `download_pdf_from_azure`
+        self.blob_listing = BlobListing(self.blob_service_client, {"pdf-reports": "/tmp/"},
+                                        metrics=self.metrics) if list_blobs else None
+
+        self._lock = threading.Lock()
+        self._exit_stack = ExitStack()
+        self._blob_service_clients = {}
+        self._pg_connection = None
+
+    def blob_service_client(self, connection_string: str | None = None) -> BlobServiceClient:
+        """
+        Return the client of the storage account, created on first use.
+        Defaults to the account configured via the `AZURE_CONNECTION_STRING` environment variable.
+        """
+        connection_string = connection_string or self.connection_string
+        with self._lock:
+            if connection_string not in self._blob_service_clients:
+                # keep up to `pool_size` connections alive, so concurrent workers do not reconnect
+                http_session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                http_session.mount("https://", adapter)
+                http_session.mount("http://", adapter)
+                self._exit_stack.callback(http_session.close)
+
+                client = BlobServiceClient.from_connection_string(
+                    connection_string, transport=RequestsTransport(session=http_session, session_owner=False))
+                self._exit_stack.callback(client.close)
+                self._blob_service_clients[connection_string] = client
+            return self._blob_service_clients[connection_string]
+
+    def pg_connection(self) -> psycopg.Connection:
+        """
+        Return the Postgres connection, connecting on first use with exponential back-off.
+        """
+        if self._pg_connection is not None:
+            return self._pg_connection
+
+        for i in range(MAX_RETRIES):
+            try:
+                self._pg_connection = self._exit_stack.enter_context(
+                    psycopg.connect(user=self.pg_user, password=self.pg_password, host=self.pg_host,
+                                    port=self.pg_port, dbname=self.pg_database, autocommit=True))
+                return self._pg_connection
+            except Exception:
+                print(f"Database unreachable, retrying {i + 1}/{MAX_RETRIES}")
+                if i + 1 != MAX_RETRIES:
+                    sleep(2 ** (i + 1))
+        raise ValueError("Failed to connect to the database after retries.")
+
+    def close(self) -> None:
+        """
+        Close all the connections opened by the session.
+        """
+        self._exit_stack.close()
+        self._blob_service_clients = {}
+        self._pg_connection = None
+
+    def __enter__(self) -> "PipelineSession":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def _session_or_new(session: PipelineSession | None):
+    """
+    Context manager yielding `session`, or a new session closed on exit if none is given.
+    """
+    return nullcontext(session) if session is not None else PipelineSession()
+
+
+def _stage(metrics: RunMetrics | None, stage: str):
+    """
+    Context manager timing the block as a run of `stage` in `metrics`, a no-op without them.
+    """
+    return metrics.stage(stage) if metrics is not None else nullcontext(Span())
+
+
+def _reserve(budget: ByteBudget | None, nbytes: int):
+    """
+    Context manager holding `nbytes` of `budget` for the block, a no-op without a budget.
+    """
+    return budget.reserve(nbytes) if budget is not None else nullcontext()
+
+
+def _download_options(size: int | None) -> dict:
+    """
+    Keyword arguments of `download_blob` planned from the blob size, large blobs are fetched in parallel ranges.
+    """
+    if size is not None and size > LARGE_BLOB_SIZE:
+        return {"max_concurrency": LARGE_BLOB_CONCURRENCY}
+    return {}
+
+
+def _record_missing(missing_blobs: MissingBlobCache | None, metrics: RunMetrics | None,
+                    container: str, blob: str) -> None:
+    """
+    Count a blob found missing from the storage and remember it in `missing_blobs`.
+    """
+    if metrics is not None:
+        metrics.increment("blob_misses")
+    if missing_blobs is not None:
+        missing_blobs.add(container, blob)
+
+
+def _count_failure(metrics: RunMetrics | None) -> None:
+    """
+    Count a blob that could not be downloaded although it may be in the storage.
+    """
+    if metrics is not None:
+        metrics.increment("blob_download_failures")
+
+
+def get_pdf_file_names(from_: datetime, to: datetime, workers: int = 1, header_only: bool = False,
+                       index: MetadataIndex | None = None, session: PipelineSession | None = None,
+                       batch_size: int | None = None, db_index: bool = False, parse_workers: int = 0) -> list[str]:
+    """
+    Retrieve a list of PDF report file names created between `from_` and `to`.
+    Filenames are constructed from DICOM metadata, stored in a DB and Azure.
+    Up to `workers` DICOM files are downloaded and parsed at once, the order of the DB query is kept.
+    With `header_only`, only the beginning of each DICOM file holding the needed tags is downloaded.
+    With `index`, DICOM files parsed in earlier runs are not downloaded again unless they changed.
+    With `batch_size`, the DB rows are streamed through a server-side cursor instead of fetched at once.
+    With `db_index`, metadata backfilled into the DB is used and DICOM files are downloaded only for the rest.
+    With `parse_workers` (at most `workers`), the DICOM files are parsed in a pool of that many processes.
+    """
+    return list(iter_pdf_file_names(from_, to, workers, header_only, index, session, batch_size, db_index,
+                                    parse_workers))
+
+
+def iter_pdf_file_names(from_: datetime, to: datetime, workers: int = 1, header_only: bool = False,
+                        index: MetadataIndex | None = None, session: PipelineSession | None = None,
+                        batch_size: int | None = None, db_index: bool = False,
+                        parse_workers: int = 0, journal: RunJournal | None = None) -> Iterator[str]:
+    """
+    Streaming form of `get_pdf_file_names`, yields every PDF report file name as soon as it is resolved.
+    With `batch_size`, the DB rows are streamed through a server-side cursor `batch_size` rows at a time.
+    With `db_index`, metadata stored in the `dicom_report_metadata` table is used instead of Azure,
+    reports not backfilled yet are resolved from Azure and their metadata is written to the table.
+    With `parse_workers` (at most `workers`), the downloaded DICOM files are parsed in a pool of that many processes.
+    With `journal`, DICOM reports resolved in the journal are not downloaded again and new ones are recorded.
+    """
+    reports = _iter_resolved_reports(from_, to, workers, header_only, index, session, batch_size, db_index,
+                                     parse_workers, journal)
+    for _, pdf_file in reports:
+        yield pdf_file
+
+
+def _iter_resolved_reports(from_: datetime, to: datetime, workers: int = 1, header_only: bool = False,
+                           index: MetadataIndex | None = None, session: PipelineSession | None = None,
+                           batch_size: int | None = None, db_index: bool = False, parse_workers: int = 0,
+                           journal: RunJournal | None = None, shard: Shard | None = None,
+                           ids: tuple[int, int] | None = None, seen_ids: set[int] | None = None,
+                           retry_rows: Iterable[tuple] = (), unresolved: list[tuple] | None = None,
+                           ) -> Iterator[tuple[tuple, str]]:
+    """
+    Yield the DB row and the PDF file name of every resolved report, see `iter_pdf_file_names`.
+    With `shard`, only the rows created within the shard are queried, the DICOM creation dates are still
+    validated against the whole window, as in an unsharded run. With `ids`, only the rows with an id after
+    the first and up to the second one are queried. The rows of a shard or an id range carry the `dicom_report.id`.
+    Queried rows whose id is in `seen_ids` are skipped, the ids of the others are added to it.
+    `retry_rows` are resolved before the queried rows, the rows whose DICOM file could not be downloaded
+    are appended to `unresolved` (the watch mode retries them).
+    Every parse waits in the thread that downloaded the file, so `workers` must be at least `parse_workers`.
+    """
+    # more parse processes than threads handing them work would stay idle
+    if parse_workers > max(workers, 1):
+        raise ValueError("⚠️ --parse-workers cannot exceed --workers, the download threads submit the parses.")
+    with _session_or_new(session) as session, _parse_pool(parse_workers) as parse_pool:
+        # retrieve valid dcm files, the session connects to the database with exponential back-off
+        conn = session.pg_connection()
+        query = DICOM_REPORTS_QUERY
+        if db_index:
+            query = DICOM_REPORTS_INDEXED_QUERY
+        elif shard is not None or ids is not None:
+            query = DICOM_REPORTS_ID_QUERY
+        query_from, query_to = shard or (from_, to)
+        since, until = ids or (0, MAX_REPORT_ID)
+        params = {"from": query_from, "to": query_to, "window_from": from_, "window_to": to,
+                  "since": since, "until": until}
+        result_dcms = _query_dicom_reports(conn, params, batch_size, query, session.metrics)
+        if seen_ids is not None:
+            result_dcms = _unseen_rows(result_dcms, seen_ids)
+        yield from _resolve_reports(session.blob_service_client(), chain(retry_rows, result_dcms), from_, to,
+                                    workers, header_only, index, conn if db_index else None, parse_pool,
+                                    session.metrics, session.missing_blobs, session.blob_listing, journal,
+                                    session.byte_budget, unresolved)
+
+
+def _unseen_rows(rows: Iterable[tuple], seen_ids: set[int]) -> Iterator[tuple]:
+    """
+    Yield the rows whose id (the third column) is not in `seen_ids`, adding it there.
+    """
+    for row in rows:
+        if row[2] not in seen_ids:
+            seen_ids.add(row[2])
+            yield row
+
+
+def _parse_pool(parse_workers: int):
+    """
+    Context manager yielding a pool of `parse_workers` processes for parsing DICOM files, or None if it is 0.
+    The workers are spawned rather than forked, the pipeline threads may hold locks at the time they start.
+    """
+    if not parse_workers:
+        return nullcontext()
+    return ProcessPoolExecutor(max_workers=parse_workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def backfill_db_metadata(from_: datetime, to: datetime, workers: int = 1, header_only: bool = False,
+                         index: MetadataIndex | None = None, session: PipelineSession | None = None,
+                         batch_size: int | None = None, parse_workers: int = 0) -> int:
+    """
+    Store the metadata of all DICOM reports created between `from_` and `to` in the `dicom_report_metadata`
+    table (see sql/dicom_report_metadata.sql), so later runs with `db_index` do not need Azure for them.
+    Returns the number of reports in the time slot with a valid PDF file name.
+    """
+    pdf_file_names = iter_pdf_file_names(from_, to, workers, header_only, index, session, batch_size,
+                                         db_index=True, parse_workers=parse_workers)
+    return sum(1 for _ in pdf_file_names)
+
+
+def _query_dicom_reports(conn: psycopg.Connection, params: dict, batch_size: int | None = None,
+                         query: str = DICOM_REPORTS_QUERY, metrics: RunMetrics | None = None) -> Iterator[tuple]:
+    """
+    Run the query for DICOM reports and yield its rows.
+    Without `batch_size` all rows are fetched at once, otherwise they are fetched lazily through
+    a server-side cursor, `batch_size` rows per round trip.
+    """
+    if batch_size is None:
+        with conn.cursor() as cur:
+            try:
+                with _stage(metrics, "db"):
+                    cur.execute(query, params)
+                    result_dcms = cur.fetchall()
+            except Exception as e:
+                raise ValueError(e)
+        yield from result_dcms
+        return
+
+    # a held cursor outlives the transaction declaring it, so on the autocommit session connection the rows
+    # written through while it is read (--db-index) commit one by one instead of when the query is exhausted
+    with conn.cursor(name="dicom_reports", withhold=True) as cur:
+        cur.itersize = batch_size
+        try:
+            with _stage(metrics, "db"):
+                cur.execute(query, params)
+        except Exception as e:
+            raise ValueError(e)
+        yield from cur
+
+
+def _resolve_reports(blob_service_client: BlobServiceClient, result_dcms: Iterable[tuple],
+                     from_: datetime, to: datetime, workers: int, header_only: bool,
+                     index: MetadataIndex | None, db_conn: psycopg.Connection | None = None,
+                     parse_pool: Executor | None = None, metrics: RunMetrics | None = None,
+                     missing_blobs: MissingBlobCache | None = None, listing: BlobListing | None = None,
+                     journal: RunJournal | None = None, budget: ByteBudget | None = None,
+                     unresolved: list[tuple] | None = None) -> Iterator[tuple[tuple, str]]:
+    """
+    Resolve the PDF file names of the DICOM reports given as (file name, container[, id]) rows.
+    Rows of `DICOM_REPORTS_INDEXED_QUERY` carry the stored metadata after the id, only rows without it are
+    resolved from Azure and their metadata is written through `db_conn`.
+    Rows resolved in `journal` are taken from it, every other row is recorded there unless its download failed.
+    The DICOM downloads wait for room in `budget`, if given. Rows whose DICOM file is not in the storage
+    or could not be downloaded are appended to `unresolved`, if given.
+    Yields the rows and names of the reports that are not skipped, in the order of the rows.
+    """
+    # iterate through all the files, possibly resolving several of them at once
+    def resolve(row: tuple) -> tuple[tuple, DicomMetadata | str | None, bool]:
+        file_name, container, *stored = row
+        # resolved before the run was interrupted
+        if journal is not None and (container, file_name) in journal.resolved:
+            return row, "journaled", False
+        # metadata already stored next to the dicom_report row
+        stored = stored[1:]
+        if stored and stored[0] is not None:
+            if metrics is not None:
+                metrics.increment("db_index_hits")
+            return row, DicomMetadata(*stored), False
+        try:
+            metadata = _get_dicom_metadata(blob_service_client, file_name, container, header_only, index,
+                                           parse_pool, metrics, missing_blobs, listing, budget)
+        except BlobDownloadError:
+            return row, "download_failed", False
+        return row, metadata, bool(stored)
+
+    for row, metadata, write_through in _ordered_map(resolve, result_dcms, workers):
+        if metadata == "journaled":
+            print(row[0] + " Resolved before resuming")
+            if metrics is not None:
+                metrics.increment("journal_hits")
+            pdf_file = journal.resolved[row[1], row[0]]
+            if pdf_file is not None:
+                yield row, pdf_file
+            continue
+
+        if metadata is None:
+            pdf_file, status = None, " not in storage"
+        elif metadata == "download_failed":
+            pdf_file, status = None, " Download failed"
+        else:
+            pdf_file, status = _assemble_pdf_file_name(metadata, from_, to)
+            if write_through and db_conn is not None:
+                _store_db_metadata(db_conn, row[2], metadata)
+
+        print(row[0] + status)
+        if unresolved is not None and metadata in (None, "download_failed"):
+            unresolved.append(row)
+        # a failed download may succeed when resumed, everything else is final
+        if journal is not None and metadata != "download_failed":
+            journal.record_resolved(row[1], row[0], pdf_file)
+        if metrics is not None:
+            if pdf_file is None:
+                metrics.skip(status, row[0])
+            else:
+                metrics.increment("reports_resolved")
+        if pdf_file is not None:
+            yield row, pdf_file
+
+
+def _store_db_metadata(conn: psycopg.Connection, dicom_report_id: int, metadata: DicomMetadata) -> None:
+    """
+    Insert (or replace) the metadata of a DICOM report into the `dicom_report_metadata` table.
+    """
+    conn.execute(DB_METADATA_UPSERT, {
+        "id": dicom_report_id,
+        "readable": metadata.readable,
+        "created": metadata.created,
+        "study": metadata.study_instance_uid,
+        "series": metadata.series_instance_uid,
+        "sop": metadata.referenced_sop_instance_uid,
+        "pdf": metadata.pdf_file_name,
+    })
+
+
+def _get_dicom_metadata(blob_service_client: BlobServiceClient, file_name: str, container: str,
+                        header_only: bool = False, index: MetadataIndex | None = None,
+                        parse_pool: Executor | None = None, metrics: RunMetrics | None = None,
+                        missing_blobs: MissingBlobCache | None = None,
+                        listing: BlobListing | None = None, budget: ByteBudget | None = None) -> DicomMetadata | None:
+    """
+    Download and parse a single DICOM report, returns None if it is not in the storage.
+    Raises `BlobDownloadError` if the report cannot be downloaded for any other reason.
+    If `index` is given, metadata parsed in earlier runs is reused while the blob ETag stays the same.
+    If `missing_blobs` is given, reports known to be missing are not requested at all.
+    If `listing` is given, it decides whether the report is in the storage and provides its ETag and size.
+    If `budget` is given, the download waits until the report fits into it.
+    """
+    info = None
+    if listing is not None:
+        info = listing.get(container, file_name)
+        if info is None:
+            _record_missing(None, metrics, container, file_name)
+            return None
+    elif missing_blobs is not None and missing_blobs.is_missing(container, file_name):
+        if metrics is not None:
+            metrics.increment("blob_misses_cached")
+        return None
+    blob_client = blob_service_client.get_blob_client(container, file_name)
+
+    # look up the metadata of an unchanged blob in the local index
+    etag = info.etag if info is not None else None
+    size = info.size if info is not None else None
+    if index is not None:
+        try:
+            if etag is None:
+                properties = blob_client.get_blob_properties()
+                etag = properties.etag
+                # spares the budget a second lookup of the size
+                if budget is not None:
+                    size = properties.size
+        except azure_exceptions.ResourceNotFoundError:
+            pass
+        except Exception as e:
+            _count_failure(metrics)
+            raise BlobDownloadError(e) from e
+        metadata = index.get(container, file_name, etag) if etag is not None else None
+        if metadata is not None:
+            if metrics is not None:
+                metrics.increment("metadata_index_hits")
+            return metadata
+
+    metadata = None
+    if index is None or etag is not None:
+        metadata = _download_dicom_metadata(blob_client, header_only, parse_pool, metrics, size, budget)
+    if metadata is None:
+        _record_missing(missing_blobs, metrics, container, file_name)
+        return None
+    if missing_blobs is not None:
+        missing_blobs.discard(container, file_name)
+    if index is not None:
+        index.put(container, file_name, etag, metadata)
+    return metadata
+
+
+def _download_dicom_metadata(blob_client, header_only: bool = False, parse_pool: Executor | None = None,
+                             metrics: RunMetrics | None = None, size: int | None = None,
+                             budget: ByteBudget | None = None) -> DicomMetadata | None:
+    """
+    Download a DICOM report (only its header if `header_only`) and parse the metadata of its PDF report.
+    With `parse_pool`, the downloaded bytes are parsed in the pool while this thread waits for the result.
+    The blob `size`, if known, tells when the whole blob was read and plans the download of a large one.
+    With `budget`, the bytes of a download are reserved before the request and held until they are parsed,
+    the size of a whole blob is looked up first if it is not known.
+    Returns None if the blob is not in the storage, raises `BlobDownloadError` if it cannot be downloaded.
+    """
+    def download(**kwargs) -> bytes | None:
+        try:
+            with _stage(metrics, "dicom_fetch") as span:
+                content = blob_client.download_blob(**kwargs).readall()
+                span.bytes = len(content)
+        except azure_exceptions.ResourceNotFoundError:
+            return None
+        except Exception as e:
+            _count_failure(metrics)
+            raise BlobDownloadError(e) from e
+        return content
+
+    def blob_size() -> int | None:
+        try:
+            return blob_client.get_blob_properties().size
+        except azure_exceptions.ResourceNotFoundError:
+            return None
+        except Exception as e:
+            _count_failure(metrics)
+            raise BlobDownloadError(e) from e
+
+    def parse(content: bytes, whole_blob: bool) -> DicomMetadata | None:
+        with _stage(metrics, "parse"):
+            if parse_pool is None:
+                return _parse_dicom_content(content, header_only, whole_blob)
+            return parse_pool.submit(_parse_dicom_content, content, header_only, whole_blob).result()
+
+    if header_only:
+        # download a growing initial range of the blob until the whole header is read
+        length = DICOM_HEADER_CHUNK_SIZE
+        while True:
+            with _reserve(budget, min(length, size) if size is not None else length):
+                content = download(offset=0, length=length)
+                if content is None:
+                    return None
+                metadata = parse(content, whole_blob=len(content) < length or len(content) == size)
+            if metadata is not None:
+                return metadata
+            length *= 2
+
+    if budget is not None and size is None:
+        size = blob_size()
+        if size is None:
+            return None
+
+    # connect to blob storage
+    with _reserve(budget, size or 0):
+        content = download(**_download_options(size))
+        if content is None:
+            return None
+        return parse(content, whole_blob=True)
+
+
+def _parse_dicom_content(content: bytes, header_only: bool, whole_blob: bool) -> DicomMetadata | None:
+    """
+    Parse the metadata of a PDF report from the bytes of a DICOM file, or only of its beginning if `header_only`.
+    Returns None if `content` is not the `whole_blob` and ends before the header does.
+    Takes and returns only picklable values, so it can run in a worker process.
+    """
+    # read the file
+    try:
+        if header_only:
+            dicom_file = _read_dicom_header(content, whole_blob)
+            if dicom_file is None:
+                return None
+        else:
+            dicom_file = pydicom.dcmread(BytesIO(content))
+    except Exception:
+        return DicomMetadata(readable=False)
+    return _parse_dicom_metadata(dicom_file)
+
+
+def _parse_dicom_metadata(dicom_file: pydicom.Dataset) -> DicomMetadata:
+    """
+    Extract the creation datetime and the UIDs forming the PDF file name from a parsed DICOM file.
+    """
+    # Parse datetime
+    try:
+        creation_date = dicom_file.get("InstanceCreationDate", "")
+        creation_time = dicom_file.get("InstanceCreationTime", "000000").split('.')[0]
+        dt = datetime.strptime(creation_date + creation_time, '%Y%m%d%H%M%S')
+    except Exception:
+        dt = None
+
+    # Study UID
+    study_instance_uid = dicom_file.get("StudyInstanceUID")
+
+    # Series UID
+    ref_series_seq = dicom_file.get("ReferencedSeriesSequence", [])
+    if ref_series_seq and 'SeriesInstanceUID' in ref_series_seq[0]:
+        series_instance_uid = ref_series_seq[0].SeriesInstanceUID
+    else:
+        series_instance_uid = dicom_file.get("SeriesInstanceUID", None)
+
+    # SOP UID
+    referenced_sop_instance_uid = None
+    sop_seq = dicom_file.get("ReferencedPerformedProcedureStepSequence", [])
+    if sop_seq and 'ReferencedSOPInstanceUID' in sop_seq[0]:
+        referenced_sop_instance_uid = sop_seq[0].ReferencedSOPInstanceUID
+
+    return DicomMetadata(
+        readable=True,
+        created=dt,
+        study_instance_uid=str(study_instance_uid) if study_instance_uid else None,
+        series_instance_uid=str(series_instance_uid) if series_instance_uid else None,
+        referenced_sop_instance_uid=str(referenced_sop_instance_uid) if referenced_sop_instance_uid else None,
+    )
+
+
+def _assemble_pdf_file_name(metadata: DicomMetadata, from_: datetime, to: datetime) -> tuple[str | None, str]:
+    """
+    Validate the DICOM metadata against the time slot and assemble the PDF file name.
+    Returns the PDF file name (None if the file is skipped) and a status message.
+    """
+    if not metadata.readable:
+        return None, " Read failed"
+    if metadata.created is None:
+        return None, " Invalid creation datetime"
+
+    # validate time slot
+    if not (from_ < metadata.created <= to):
+        return None, f" Date {metadata.created} not in the range"
+
+    if not metadata.study_instance_uid:
+        return None, " Missing StudyInstanceUID"
+    if not metadata.series_instance_uid:
+        return None, " Missing SeriesInstanceUID"
+    if not metadata.referenced_sop_instance_uid:
+        return None, " Missing ReferencedSOPInstanceUID"
+
+    # All values are present, assemble the file name
+    pdf_file = metadata.pdf_file_name
+    return pdf_file, f" file {pdf_file} added"
+
+
+def _read_dicom_header(content: bytes, whole_blob: bool) -> pydicom.Dataset | None:
+    """
+    Parse only the tags of `DICOM_HEADER_KEYWORDS` from the beginning of a DICOM file.
+    Returns None if `content` is a prefix of the blob that ends before all the needed tags were read.
+    """
+    fileobj = BytesIO(content)
+    header_tags = _dicom_header_tags()
+    last_tag = max(header_tags)
+    try:
+        dicom_file = read_partial(fileobj, stop_when=lambda tag, vr, length: tag > last_tag,
+                                  specific_tags=header_tags)
+    except Exception:
+        # a prefix may end inside the file meta information, only a complete file is really unreadable
+        if whole_blob:
+            raise
+        return None
+
+    # parsing stops before the first tag past the header, running into the end of data means it was cut off
+    if fileobj.tell() >= len(content) and not whole_blob:
+        return None
+    return dicom_file
+
+
+@cache
+def _dicom_header_tags() -> list:
+    return [Tag(keyword) for keyword in DICOM_HEADER_KEYWORDS]
+
+
+def _ordered_map(func: Callable[[T], R], items: Iterable[T], workers: int) -> Iterator[R]:
+    """
+    Apply `func` to every item using up to `workers` threads and yield the results in input order.
+    At most `2 * workers` items are in flight at once, so results are never buffered without bound.
+    """
+    if workers <= 1:
+        yield from map(func, items)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _prefetch(items: Iterable[T], queue_size: int) -> Iterator[T]:
+    """
+    Produce `items` in a background thread and hand them over through a queue of at most `queue_size` items.
+    The producing and the consuming stage run at the same time, exceptions are re-raised in the consumer.
+    """
+    queue = Queue(maxsize=queue_size)
+    stop = threading.Event()
+    done = object()
+
+    def produce() -> None:
+        error = None
+        try:
+            for item in items:
+                # wait for free space, but give up once the consumer stopped
+                while not stop.is_set():
+                    try:
+                        queue.put((item, None), timeout=0.1)
+                        break
+                    except Full:
+                        pass
+                if stop.is_set():
+                    return
+        except BaseException as e:
+            error = e
+        queue.put((done, error))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        # unblock a producer waiting to hand over its final marker
+        while producer.is_alive():
+            try:
+                queue.get(timeout=0.1)
+            except Empty:
+                pass
+
+
+def run_pipeline(from_: datetime, to: datetime, workers: int = 1, header_only: bool = False,
+                 index: MetadataIndex | None = None, session: PipelineSession | None = None,
+                 queue_size: int = PIPELINE_QUEUE_SIZE, batch_size: int | None = None,
+                 db_index: bool = False, content_store: ContentStore | None = None,
+                 merge: Callable[..., object] | None = None, stream_to_disk: bool = False,
+                 parse_workers: int = 0, journal: RunJournal | None = None, group_by: str | None = None) -> None:
+    """
+    Resolve, download, store and join the PDF reports created between `from_` and `to` as a stream.
+    Every stage runs in its own thread and starts as soon as the previous one produces its first item,
+    the stages are connected by queues of at most `queue_size` items so memory does not grow with the window.
+    With `content_store`, duplicate names are joined only once and already stored reports are not downloaded.
+    With `stream_to_disk`, reports are streamed straight into files named after them (`download_pdf_to_disk`).
+    The stored paths are passed to `merge` with the session, `join_pdfs` by default.
+    With `journal`, the resolved names and stored paths are recorded as they finish and the work recorded
+    by an interrupted run is not redone, the merged output is the same as that of an uninterrupted run.
+    With `group_by` ("aet" or "study"), `merge` gets (group, path) pairs instead, `join_pdfs_grouped` by default.
+    """
+    with _session_or_new(session) as session:
+        if group_by is None:
+            pdf_file_names = iter_pdf_file_names(from_, to, workers, header_only, index, session, batch_size,
+                                                 db_index, parse_workers, journal)
+        else:
+            # the fetched paths come in the order of the names, the groups are matched to them in the same order
+            groups = deque()
+            pdf_file_names = _iter_grouped_names(groups, group_by, from_, to, workers, header_only, index, session,
+                                                 batch_size, db_index, parse_workers, journal,
+                                                 unique=content_store is not None)
+        pdf_paths = fetch_pdfs(_prefetch(pdf_file_names, queue_size), workers, session, queue_size, content_store,
+                               stream_to_disk, journal)
+        if group_by is None:
+            (merge or join_pdfs)(pdf_paths, session=session)
+        else:
+            grouped_paths = ((groups.popleft(), path) for path in pdf_paths)
+            (merge or partial(join_pdfs_grouped, group_by=group_by))(grouped_paths, session=session)
+
+
+def _iter_grouped_names(groups: deque, group_by: str, from_: datetime, to: datetime, workers: int,
+                        header_only: bool, index: MetadataIndex | None, session: PipelineSession,
+                        batch_size: int | None, db_index: bool, parse_workers: int, journal: RunJournal | None,
+                        unique: bool = False) -> Iterator[str]:
+    """
+    Yield the PDF report names of the window like `iter_pdf_file_names`, appending the group of every yielded
+    name to `groups`: the sending AET of its DICOM report or the StudyInstanceUID its name starts with.
+    With `unique`, repeated names are skipped here, as `fetch_pdfs` skips them with a content store.
+    """
+    aets = None
+    if group_by == "aet":
+        with session.pg_connection().cursor() as cur:
+            with session.metrics.stage("db"):
+                cur.execute(REPORT_AETS_QUERY, {"from": from_, "to": to})
+                aets = {(container, file_name): aet for file_name, container, aet in cur.fetchall()}
+
+    seen = set()
+    for row, pdf_file in _iter_resolved_reports(from_, to, workers, header_only, index, session, batch_size,
+                                                db_index, parse_workers, journal):
+        if unique:
+            if pdf_file in seen:
+                continue
+            seen.add(pdf_file)
+        if aets is not None:
+            groups.append(aets.get((row[1], row[0]), UNKNOWN_GROUP))
+        else:
+            groups.append(pdf_file.split("_", 1)[0])
+        yield pdf_file
+
+
+def fetch_pdfs(pdf_file_names: Iterable[str], workers: int = 1, session: PipelineSession | None = None,
+               queue_size: int = PIPELINE_QUEUE_SIZE, content_store: ContentStore | None = None,
+               stream_to_disk: bool = False, journal: RunJournal | None = None) -> Iterator[str]:
+    """
+    Download and store the PDF reports as a stream, yielding the stored paths (or "download_failed") in order.
+    Up to `workers` reports are downloaded at once and at most `queue_size` downloaded ones wait to be stored.
+    With `content_store`, duplicate names are fetched only once and already stored reports are not downloaded.
+    With `stream_to_disk`, reports are streamed straight into files named after them (`download_pdf_to_disk`).
+    With `journal`, reports stored in the journal are not downloaded again and new ones are recorded.
+    With a byte budget in the session, every report is written to a temporary file by the thread downloading it,
+    so reports waiting for their turn to be stored hold neither memory nor the budget.
+    """
+    def fetch(pdf_file_name: str) -> tuple[str, str | bytes | _SpooledPdf]:
+        path = journal.stored_path(pdf_file_name) if journal is not None else None
+        if path is not None:
+            print(f"✅ Stored before resuming: {pdf_file_name}")
+            session.metrics.increment("journal_hits")
+            return pdf_file_name, path
+        if content_store is not None:
+            return pdf_file_name, fetch_pdf_into_store(pdf_file_name, content_store, session)
+        if stream_to_disk:
+            return pdf_file_name, download_pdf_to_disk(pdf_file_name, session=session)
+        if session.byte_budget is not None:
+            return pdf_file_name, download_pdf_from_azure(pdf_file_name, session=session,
+                                                          spool_dir=session.pdf_target_dir)
+        return pdf_file_name, download_pdf_from_azure(pdf_file_name, session=session)
+
+    with _session_or_new(session) as session:
+        if content_store is not None:
+            pdf_file_names = _unique(pdf_file_names)
+        for pdf_file_name, result in _prefetch(_ordered_map(fetch, pdf_file_names, workers), queue_size):
+            # downloaded bytes are stored here, the numbered file names must be assigned one at a time
+            if isinstance(result, bytes):
+                path = store_pdf_on_disk(result, session=session)
+            elif isinstance(result, _SpooledPdf):
+                path = _store_spooled_pdf(result, session)
+            else:
+                path = result
+            if journal is not None and path != "download_failed" and journal.stored_path(pdf_file_name) != path:
+                journal.record_stored(pdf_file_name, path)
+            yield path
+
+
+def run_shard(from_: datetime, to: datetime, shard: Shard, state_dir: str | Path, workers: int = 1,
+              header_only: bool = False, metadata_index: str | None = None, batch_size: int | None = None,
+              db_index: bool = False, parse_workers: int = 0, list_blobs: bool = False,
+              missing_blob_cache: str | None = None, max_inflight_mb: int | None = None) -> int:
+    """
+    Resolve and fetch the reports of one shard of the window between `from_` and `to`, and write their ids,
+    names and stored paths into the shard file in `state_dir`. The reports are streamed into files named
+    after them, so shards running at the same time on other processes or hosts never write the same file.
+    Takes paths instead of open indexes and caches, so it can be run in a worker process.
+    Returns the number of fetched reports.
+    """
+    with ExitStack() as stack:
+        missing_blobs = stack.enter_context(MissingBlobCache(missing_blob_cache)) if missing_blob_cache else None
+        index = stack.enter_context(MetadataIndex(metadata_index)) if metadata_index else None
+        session = stack.enter_context(PipelineSession(pool_size=max(2 * workers, 16), missing_blobs=missing_blobs,
+                                                      list_blobs=list_blobs, byte_budget=_byte_budget(max_inflight_mb)))
+
+        # the fetched paths come in the order of the names, the ids are matched to them in the same order
+        resolved = deque()
+
+        def pdf_file_names() -> Iterator[str]:
+            for row, pdf_file in _iter_resolved_reports(from_, to, workers, header_only, index, session,
+                                                        batch_size, db_index, parse_workers, shard=shard):
+                resolved.append((row[2], pdf_file))
+                yield pdf_file
+
+        reports = (ShardReport(*resolved.popleft(), path)
+                   for path in fetch_pdfs(pdf_file_names(), workers, session, stream_to_disk=True))
+        count = write_shard(shard_path(state_dir, shard),
+                            (report for report in reports if report.path != "download_failed"))
+        print(f"🧩 Shard {shard.name} finished, {count} reports fetched")
+        return count
+
+
+def run_shards(from_: datetime, to: datetime, shard_size: timedelta, state_dir: str | Path,
+               shard_workers: int = 1, shard_index: int = 0, shard_count: int = 1, **options) -> int:
+    """
+    Process the shards of the window (see `shards.plan_shards`) in up to `shard_workers` processes.
+    Several hosts sharing `state_dir` split the shards among themselves, the host `shard_index` out of
+    `shard_count` takes every `shard_count`-th of them. Shards finished in an earlier run are skipped,
+    `options` are passed to `run_shard`. Returns the number of shards processed.
+    """
+    shards = plan_shards(from_, to, shard_size)[shard_index::shard_count]
+    pending = [shard for shard in shards if not shard_path(state_dir, shard).exists()]
+    print(f"🧩 {len(pending)} of {len(shards)} shards to process")
+    if shard_workers <= 1:
+        for shard in pending:
+            run_shard(from_, to, shard, state_dir, **options)
+        return len(pending)
+
+    # spawned, as the parse pool, so the workers do not inherit locks held by other threads
+    with ProcessPoolExecutor(max_workers=shard_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [pool.submit(run_shard, from_, to, shard, state_dir, **options) for shard in pending]
+        for future in futures:
+            future.result()
+    return len(pending)
+
+
+def reduce_shards(from_: datetime, to: datetime, shard_size: timedelta, state_dir: str | Path,
+                  merge: Callable[..., object] | None = None, session: PipelineSession | None = None) -> int:
+    """
+    Combine the outputs of all the shards of the window into the order of an unsharded run, write the paths
+    into `pdfs.txt` of `state_dir` and pass them to `merge` (`join_pdfs` by default).
+    Raises `ValueError` if a shard is not finished yet. Returns the number of joined reports.
+    """
+    paths = [shard_path(state_dir, shard) for shard in plan_shards(from_, to, shard_size)]
+    unfinished = [path.stem for path in paths if not path.exists()]
+    if unfinished:
+        raise ValueError(f"⚠️ {len(unfinished)} shards are not finished yet: {', '.join(unfinished)}")
+
+    pdf_paths = [report.path for report in merge_shards(paths)]
+    write_lines(Path(state_dir) / PDFS_FILE, pdf_paths)
+    with _session_or_new(session) as session:
+        (merge or join_pdfs)(pdf_paths, session=session)
+    return len(pdf_paths)
+
+
+def watch_reports(delta: timedelta, state_dir: str | Path, poll_interval: float = 60.0, workers: int = 1,
+                  header_only: bool = False, index: MetadataIndex | None = None,
+                  session: PipelineSession | None = None, batch_size: int | None = None, db_index: bool = False,
+                  parse_workers: int = 0, content_store: ContentStore | None = None, stream_to_disk: bool = False,
+                  cycles: int | None = None, on_cycle: Callable[[PipelineSession], object] | None = None) -> None:
+    """
+    Keep the joined report up to date with the reports arriving in the DB, polling it every `poll_interval`
+    seconds (`cycles` times, forever by default). Every cycle resolves and fetches only the reports with a
+    `dicom_report.id` above the high-water mark persisted in `state_dir`, from the DICOM files created within
+    `delta` before now, and appends them to the joined report (`join_pdfs_incremental`).
+    The last `WATCH_RESCAN_IDS` ids below the mark are queried again, a row committed after a row with a higher id
+    is picked up by the next cycle. The first cycle without a persisted mark processes the whole `delta` window.
+    A DICOM file or a PDF report that could not be downloaded (the PDF report is often uploaded after its DICOM file)
+    is retried in the next `WATCH_PDF_RETRIES` cycles. Reports created more than `delta` before now are dropped
+    from the joined report. `on_cycle` is called with the session after every cycle that fetched something.
+    """
+    state_path = Path(state_dir) / WATCH_FILE
+    state = read_json(state_path, {"high_water_mark": 0, "seen_ids": [], "reports": [], "pending": {},
+                                   "pending_dicoms": [], "merged": True})
+    with _session_or_new(session) as session:
+        cycle = 0
+        while True:
+            with _stage(session.metrics, "db"), session.pg_connection().cursor() as cur:
+                cur.execute(DICOM_REPORTS_MAX_ID_QUERY)
+                until = cur.fetchone()[0]
+            since, pending = state["high_water_mark"], state["pending"]
+            pending_dicoms = {(entry["container"], entry["file_name"]): entry for entry in state["pending_dicoms"]}
+            to = datetime.now()
+
+            # rows of the re-scanned ids already seen are skipped before they are resolved
+            seen_ids, unresolved = set(state["seen_ids"]), []
+            retry_rows = [(entry["file_name"], entry["container"], entry["id"]) for entry in pending_dicoms.values()]
+            scanned = (max(0, since - WATCH_RESCAN_IDS), until)
+            reports = list(_iter_resolved_reports(to - delta, to, workers, header_only, index, session, batch_size,
+                                                  db_index, parse_workers, ids=scanned, seen_ids=seen_ids,
+                                                  retry_rows=retry_rows, unresolved=unresolved))
+
+            fetching = bool(reports or unresolved or pending or pending_dicoms)
+            if fetching:
+                created = {entry["id"]: entry["created_at"] for entry in pending_dicoms.values()}
+                if any(row[2] not in created for row, _ in reports) or any(row[2] not in created for row in unresolved):
+                    created.update(_report_creation_times(session, scanned))
+                origins = dict(pending)
+                for row, pdf_file in reports:
+                    origins.setdefault(pdf_file, {"id": row[2], "created_at": created[row[2]], "attempts": 0})
+                pdf_file_names = list(pending) + [pdf_file for _, pdf_file in reports]
+                if content_store is not None:
+                    pdf_file_names = list(_unique(pdf_file_names))
+                pdf_paths = fetch_pdfs(pdf_file_names, workers, session, content_store=content_store,
+                                       stream_to_disk=stream_to_disk)
+
+                new_reports, failed = [], {}
+                for pdf_file_name, path in zip(pdf_file_names, pdf_paths):
+                    origin = origins[pdf_file_name]
+                    if path != "download_failed":
+                        new_reports.append({"id": origin["id"], "created_at": origin["created_at"], "path": path,
+                                            "sha256": _file_sha256(path)})
+                    elif origin["attempts"] < WATCH_PDF_RETRIES:
+                        failed[pdf_file_name] = {**origin, "attempts": origin["attempts"] + 1}
+                failed_dicoms = []
+                for file_name, container, report_id, *_ in unresolved:
+                    attempts = pending_dicoms.get((container, file_name), {}).get("attempts", 0)
+                    if attempts < WATCH_PDF_RETRIES:
+                        failed_dicoms.append({"file_name": file_name, "container": container, "id": report_id,
+                                              "created_at": created[report_id], "attempts": attempts + 1})
+                print(f"👀 {len(new_reports)} new reports up to dicom_report.id {until}, "
+                      f"{len(failed) + len(failed_dicoms)} to retry")
+                state = {**state, "reports": state["reports"] + new_reports, "pending": failed,
+                         "pending_dicoms": failed_dicoms, "merged": state["merged"] and not new_reports}
+
+            # reports that left the window are dropped, the joined report is rebuilt without them
+            current = [report for report in state["reports"]
+                       if datetime.fromisoformat(report["created_at"]) > to - delta]
+            expired = len(current) < len(state["reports"])
+            if expired:
+                state = {**state, "reports": current, "merged": False}
+            mark = max(since, until)
+            seen_ids = sorted(seen_id for seen_id in seen_ids if seen_id > mark - WATCH_RESCAN_IDS)
+            # the mark moves before the merge, an interrupted merge is finished by the next cycle
+            if fetching or expired or mark != since or seen_ids != state["seen_ids"]:
+                state = {**state, "high_water_mark": mark, "seen_ids": seen_ids}
+                write_json(state_path, state)
+
+            if not state["merged"]:
+                join_pdfs_incremental([report["path"] for report in state["reports"]], session=session,
+                                      hashes={report["path"]: report["sha256"] for report in state["reports"]})
+                state["merged"] = True
+                write_json(state_path, state)
+            if fetching and on_cycle is not None:
+                on_cycle(session)
+
+            cycle += 1
+            if cycles is not None and cycle >= cycles:
+                return
+            sleep(poll_interval)
+
+
+def _report_creation_times(session: PipelineSession, ids: tuple[int, int]) -> dict[int, str]:
+    """
+    Return the creation times (ISO formatted) of the DICOM reports with an id after the first and up to the second one.
+    """
+    with _stage(session.metrics, "db"), session.pg_connection().cursor() as cur:
+        cur.execute(DICOM_REPORTS_CREATED_QUERY, {"since": ids[0], "until": ids[1]})
+        return {report_id: created_at.isoformat() for report_id, created_at in cur.fetchall()}
+
+
+def _unique(items: Iterable[T]) -> Iterator[T]:
+    """
+    Yield the items in their order, skipping the ones seen before.
+    """
+    seen = set()
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            yield item
+
+
+def _known_missing(session: PipelineSession, container: str, blob: str) -> bool:
+    """
+    Return True (and count it) if the blob is known to be missing from the storage, so it is not requested.
+    The blob listing of the session decides if there is one, otherwise the cache of missing blobs.
+    """
+    if session.blob_listing is not None:
+        if session.blob_listing.get(container, blob) is not None:
+            return False
+        print(f"❔ Blob not in storage: {blob}")
+        _record_missing(None, session.metrics, container, blob)
+        return True
+    if session.missing_blobs is None or not session.missing_blobs.is_missing(container, blob):
+        return False
+    print(f"⏭️ Known missing blob: {blob}")
+    session.metrics.increment("blob_misses_cached")
+    return True
+
+
+def _blob_size(session: PipelineSession, container: str, blob: str) -> int | None:
+    """
+    Return the size of the blob from the blob listing of the session, None without a listing.
+    """
+    info = session.blob_listing.get(container, blob) if session.blob_listing is not None else None
+    return info.size if info is not None else None
+
+
+def download_pdf_from_azure(pdf_file_name: str, session: PipelineSession | None = None,
+                            spool_dir: Path | None = None) -> bytes | _SpooledPdf:
+    """
+    This function downloads a PDF report from the Azure Blob Storage stored
+    under the given `pdf_file_name`. Uses the 'pdf-reports' container.
+    Returns the downloaded PDF report as bytes.
+    With a byte budget in the session, the download waits until the report fits into it.
+    With `spool_dir`, the report is written into a temporary file there (see `_spool_pdf`) before
+    the reservation is released, and the temporary file is returned instead.
+    """
+    container = "pdf-reports"
+    blob = '/tmp/' + pdf_file_name # this was needed in my case
+
+    # Connect to Azure Blob Service, the session client is reused across downloads
+    with _session_or_new(session) as session:
+        if _known_missing(session, container, blob):
+            return "download_failed"
+        try:
+            blob_client = session.blob_service_client().get_blob_client(container=container, blob=blob)
+
+            size = _blob_size(session, container, blob)
+            if session.byte_budget is not None and size is None:
+                size = blob_client.get_blob_properties().size
+
+            print(f"Downloading: {blob}")
+            with _reserve(session.byte_budget, size or 0), session.metrics.stage("pdf_download") as span:
+                downloader = blob_client.download_blob(**_download_options(size))
+                if spool_dir is not None:
+                    content = _spool_pdf(downloader, spool_dir)
+                    span.bytes = os.path.getsize(content.path)
+                else:
+                    content = downloader.readall()
+                    span.bytes = len(content)
+            print(f"✅ Found matching blob: {blob}")
+        except azure_exceptions.ResourceNotFoundError:
+            print(f"❔ Blob not in storage: {blob}")
+            _record_missing(session.missing_blobs, session.metrics, container, blob)
+            return "download_failed"
+        except Exception as e:
+            print(f"❌ Failed to download blob: {e}")
+            _count_failure(session.metrics)
+            return "download_failed"
+        if session.missing_blobs is not None:
+            session.missing_blobs.discard(container, blob)
+        return content
+
+
+def download_pdf_to_disk(pdf_file_name: str, session: PipelineSession | None = None) -> str:
+    """
+    Streams a PDF report from the Azure Blob Storage straight into `PDF_TARGET_DIR`/`pdf_file_name`.
+    Chunks are written into a temporary file in the target directory as they arrive, the complete file
+    is then atomically renamed into place, so the report is never held in memory as a whole.
+    Returns the path of the stored report or "download_failed".
+    """
+    container = "pdf-reports"
+    blob = '/tmp/' + pdf_file_name # this was needed in my case
+
+    with _session_or_new(session) as session:
+        if _known_missing(session, container, blob):
+            return "download_failed"
+        save_folder = session.pdf_target_dir
+        save_folder.mkdir(parents=True, exist_ok=True)
+        save_path = save_folder / pdf_file_name
+
+        fd, tmp_path = tempfile.mkstemp(dir=save_folder, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                blob_client = session.blob_service_client().get_blob_client(container=container, blob=blob)
+
+                print(f"Downloading: {blob}")
+                with session.metrics.stage("pdf_download") as span:
+                    download_options = _download_options(_blob_size(session, container, blob))
+                    span.bytes = blob_client.download_blob(**download_options).readinto(tmp_file)
+            os.replace(tmp_path, save_path)
+            print(f"✅ Found matching blob: {blob}")
+        except azure_exceptions.ResourceNotFoundError:
+            Path(tmp_path).unlink(missing_ok=True)
+            print(f"❔ Blob not in storage: {blob}")
+            _record_missing(session.missing_blobs, session.metrics, container, blob)
+            return "download_failed"
+        except Exception as e:
+            Path(tmp_path).unlink(missing_ok=True)
+            print(f"❌ Failed to download blob: {e}")
+            _count_failure(session.metrics)
+            return "download_failed"
+        if session.missing_blobs is not None:
+            session.missing_blobs.discard(container, blob)
+        return str(save_path)
+
+
+def store_pdf_on_disk(pdf: bytes, session: PipelineSession | None = None) -> str:
+    """
+    Store the PDF report (received as bytes) on the local file system.
+    The target destination is configured via the `PDF_TARGET_DIR` environment variable.
+    """
+    # if download failed in previous case, return this status instead of relevant string
+    if pdf == "download_failed":
+        return "download_failed"
+    
+    # variables for file handling, the configuration is loaded only without a session
+    session = session or PipelineSession()
+    save_folder = session.pdf_target_dir
+    save_folder.mkdir(parents=True, exist_ok=True)
+
+    # save the pdf file and return the path
+    save_path = _next_report_path(save_folder)
+    with session.metrics.stage("disk_write") as span:
+        save_path.write_bytes(pdf)
+        span.bytes = len(pdf)
+
+    return str(save_path)
+
+
+def _next_report_path(save_folder: Path) -> Path:
+    """
+    Return the path of the next reportxxx.pdf in `save_folder`, numbered after the highest stored one.
+    """
+    base_name = "report{}.pdf"
+    name_template = re.compile(r"^report(\d+)\.pdf$")
+
+    # find reportxxx.pdf with highest number
+    max_num = 0
+    for file in save_folder.iterdir():
+        match = name_template.match(file.name)
+        if match:
+            num = int(match.group(1))
+            if num > max_num:
+                max_num = num
+    return save_folder / base_name.format(max_num + 1)
+
+
+class _SpooledPdf(NamedTuple):
+    """
+    A downloaded PDF report written to a temporary file in `PDF_TARGET_DIR`, not numbered yet.
+    """
+    path: str
+
+
+def _spool_pdf(downloader, save_folder: Path) -> _SpooledPdf:
+    """
+    Stream a report being downloaded into a temporary file in `save_folder`, it is numbered later by
+    `_store_spooled_pdf` (or moved into the content store).
+    """
+    save_folder.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=save_folder, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            downloader.readinto(tmp_file)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+    return _SpooledPdf(tmp_path)
+
+
+def _store_spooled_pdf(spooled: _SpooledPdf, session: PipelineSession) -> str:
+    """
+    Rename a spooled report to the next reportxxx.pdf, the numbers must be assigned one at a time.
+    """
+    save_path = _next_report_path(session.pdf_target_dir)
+    os.replace(spooled.path, save_path)
+    return str(save_path)
+
+
+def fetch_pdf_into_store(pdf_file_name: str, content_store: ContentStore,
+                         session: PipelineSession | None = None) -> str:
+    """
+    Return the path of the PDF report in the content-addressed store, downloading it only if it is not stored yet.
+    Returns "download_failed" if the report is neither stored nor downloadable.
+    """
+    path = content_store.lookup(pdf_file_name)
+    if path is not None:
+        print(f"✅ Already stored: {pdf_file_name}")
+        if session is not None:
+            session.metrics.increment("content_store_hits")
+        return path
+
+    # with a byte budget the report is spooled into the store while it is reserved, it never waits in memory
+    if session is not None and session.byte_budget is not None:
+        spooled = download_pdf_from_azure(pdf_file_name, session=session, spool_dir=content_store.objects_dir)
+        if spooled == "download_failed":
+            return "download_failed"
+        return content_store.store_file(pdf_file_name, spooled.path)
+
+    pdf = download_pdf_from_azure(pdf_file_name, session=session)
+    if pdf == "download_failed":
+        return "download_failed"
+    with _stage(session and session.metrics, "disk_write") as span:
+        span.bytes = len(pdf)
+        return content_store.store(pdf_file_name, pdf)
 
-from datetime import datetime, timedelta
-from dotenv import load_dotenv
-from time import sleep
-from azure.storage.blob import BlobServiceClient
-from io import BytesIO
-from pypdf import PdfWriter
-from pathlib import Path
 
-MAX_RETRIES = 5
+def join_pdfs(pdf_paths: Iterable[str], session: PipelineSession | None = None, use_mmap: bool = False,
+              optimize: bool = False, file_name: str = "joined_report.pdf") -> None:
+    """
+    Joins multiple PDF files into a single PDF file, the paths may be consumed from a stream.
+    The output path is configured via the `JOINED_PDF_TARGET_DIR` environment variable and `file_name`.
+    With `use_mmap`, the inputs are parsed from memory-mapped files instead of being read into memory first.
+    With `optimize`, the joined file is deduplicated and compressed before it is written (`_optimize_merged`).
+    """
+    # read global variables, the configuration is loaded only without a session
+    session = session or PipelineSession()
+    save_folder = session.joined_pdf_target_dir
+    save_file_path = save_folder / file_name
+    save_folder.mkdir(parents=True, exist_ok=True)
+
+    # add all relevant pdfs (download_failed are ommited)
+    merger = PdfWriter()
+    input_bytes = 0
+    for path_str in pdf_paths:
+        if path_str == "download_failed":
+            continue
+        if optimize:
+            input_bytes += os.path.getsize(path_str)
+        with session.metrics.stage("merge"):
+            if use_mmap:
+                # the appended pages are copied into the writer, the mapping is not needed afterwards
+                with open(path_str, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    merger.append(PdfReader(mapped))
+            else:
+                merger.append(Path(path_str))
+
+    if optimize:
+        _optimize_merged(merger, session)
+
+    # write the joined pdf
+    with session.metrics.stage("merge_write"):
+        merger.write(str(save_file_path))
+    merger.close()
+    if optimize:
+        _report_merged_size(save_file_path, input_bytes, session)
 
-def get_pdf_file_names(from_: datetime, to: datetime) -> list[str]:
+
+def _optimize_merged(merger: PdfWriter, session: PipelineSession) -> None:
     """
-    Retrieve a list of PDF report file names created between `from_` and `to`.
-    Filenames are constructed from DICOM metadata, stored in a DB and Azure.
+    Every appended report brings its own copies of the fonts, logos and template XObjects, keep a single copy
+    of every identical object (dropping the ones no longer referenced) and compress the page content streams.
     """
-    # query for retriving dcm files
-    QUERY = '''SELECT dicom_report.file_name, dicom_report.container_name FROM public.dicom_report
-            JOIN dicom_stow_rs ON dicom_report.dicom_stow_rs_id = dicom_stow_rs.id
-            WHERE created_at > %(from)s AND created_at <= %(to)s
-            ORDER BY dicom_report.id DESC
-            '''
-    # obtain global variables
-    load_dotenv()
-    pg_host = os.getenv("PG_HOST")
-    pg_user = os.getenv("PG_USER")
-    pg_port = os.getenv("PG_PORT")
-    pg_database = os.getenv("PG_DATABASE")
-    pg_password = os.getenv("PG_PASSWORD")
-    connection_string = os.getenv("AZURE_CONNECTION_STRING")
-
-    # retrieve valid dcm files, connection to database with exponential back-off
-    result_dcms = []
-    for i in range(MAX_RETRIES):
-        try:
-            with psycopg.connect(user=pg_user, password=pg_password, host=pg_host,
-                                 port=pg_port, dbname=pg_database) as conn:
-                with conn.cursor() as cur:
-                    try:
-                        cur.execute(QUERY, {"from": from_, "to": to})
-                        result_dcms = cur.fetchall()
-                        break
-                    except Exception as e:
-                        raise ValueError(e)
-        except ValueError as e:
-            raise
-        except Exception as e:
-            print(f"Database unreachable, retrying {i + 1}/{MAX_RETRIES}")
-            if i + 1 != MAX_RETRIES:
-                sleep(2 ** (i + 1))
-    else:
-        raise ValueError("Failed to connect to the database after retries.")
+    with session.metrics.stage("merge_optimize"):
+        for page in merger.pages:
+            page.compress_content_streams()
+        # a pass merges objects with identical content, the copies of a template become identical only once
+        # the copies of the fonts and images it references are merged, so repeat until the file stops shrinking
+        size = None
+        while True:
+            merger.compress_identical_objects(remove_duplicates=True, remove_unreferenced=True)
+            counter = _ByteCounter()
+            merger.write_stream(counter)
+            if size is not None and counter.tell() >= size:
+                break
+            size = counter.tell()
 
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
 
-    # iterate through all the files
-    out = []
-    for file_name, container in result_dcms:
-        print(file_name, end="")
+class _ByteCounter:
+    """
+    Write-only stream counting the bytes written to it, measures the size of a PDF without holding it.
+    """
+    def __init__(self):
+        self.size = 0
 
-        # Reset variables each iteration
-        study_instance_uid = None
-        series_instance_uid = None
-        referenced_sop_instance_uid = None
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        return len(data)
 
-        # connect to blob storage
-        try:
-            blob_client = blob_service_client.get_blob_client(container, file_name)
-            content = blob_client.download_blob().readall()
-        except Exception:
-            print(" not in storage")
-            continue
-        
-        # read the file
-        try:
-            dicom_file = pydicom.dcmread(BytesIO(content))
-        except Exception:
-            print(" Read failed")
-            continue
+    def tell(self) -> int:
+        return self.size
 
-        # Parse datetime
-        try:
-            creation_date = dicom_file.get("InstanceCreationDate", "")
-            creation_time = dicom_file.get("InstanceCreationTime", "000000").split('.')[0]
-            dt = datetime.strptime(creation_date + creation_time, '%Y%m%d%H%M%S')
-        except Exception:
-            print(" Invalid creation datetime")
-            continue
+    def flush(self) -> None:
+        pass
 
-        # validate time slot
-        if not (from_ < dt <= to):
-            print(f" Date {dt} not in the range")
-            continue
 
-        # Study UID
-        study_instance_uid = dicom_file.get("StudyInstanceUID")
-        if not study_instance_uid:
-            print(" Missing StudyInstanceUID")
-            continue
+def _report_merged_size(path: Path, input_bytes: int, session: PipelineSession) -> None:
+    """
+    Print and count the size of the optimised joined file against the total size of the merged reports.
+    """
+    size = path.stat().st_size
+    session.metrics.increment("merge_input_bytes", input_bytes)
+    session.metrics.increment("merge_output_bytes", size)
+    ratio = f", {input_bytes / size:.1f}x smaller" if size else ""
+    print(f"📉 {path.name}: {input_bytes / 1e6:.2f} MB of reports -> {size / 1e6:.2f} MB{ratio}")
 
-        # Series UID
-        series_instance_uid = None
-        ref_series_seq = dicom_file.get("ReferencedSeriesSequence", [])
-        if ref_series_seq and 'SeriesInstanceUID' in ref_series_seq[0]:
-            series_instance_uid = ref_series_seq[0].SeriesInstanceUID
-        else:
-            series_instance_uid = dicom_file.get("SeriesInstanceUID", None)
-        if not series_instance_uid:
-            print(" Missing SeriesInstanceUID")
+
+def join_pdfs_incremental(pdf_paths: Iterable[str], session: PipelineSession | None = None,
+                          optimize: bool = False, hashes: dict[str, str] | None = None) -> None:
+    """
+    Keeps `joined_report.pdf` up to date without rebuilding it, a sidecar `joined_report.manifest.json`
+    records the name, SHA-256, path, size and modification time of every report in it.
+    Reports not in the joined file yet are appended as a PDF incremental update written to the end of
+    the existing file, in the order of `pdf_paths` (see `_append_increment`). The file is rebuilt from scratch
+    (in the order of `pdf_paths`) only if one of its reports is no longer in `pdf_paths` or the file does not
+    match the manifest. Reports whose path, size and modification time match the manifest are not hashed again.
+    `optimize` applies to the rebuilds only, an incremental update cannot touch the objects already written.
+    `hashes` are the SHA-256 of reports already known to the caller, by path.
+    """
+    session = session or PipelineSession()
+    save_folder = session.joined_pdf_target_dir
+    save_file_path = save_folder / "joined_report.pdf"
+    manifest_path = save_folder / "joined_report.manifest.json"
+    save_folder.mkdir(parents=True, exist_ok=True)
+
+    try:
+        manifest = json.loads(manifest_path.read_text())
+        known_hashes = {(joined["path"], joined["size"], joined["mtime_ns"]): joined["sha256"]
+                        for joined in manifest["sources"] if "path" in joined}
+        if save_file_path.stat().st_size != manifest["size"]:
+            manifest = None
+    except (OSError, ValueError, KeyError):
+        manifest, known_hashes = None, {}
+
+    # identify the reports by content, the same report is stored under a new name on every run
+    sources = []
+    for path_str in pdf_paths:
+        if path_str == "download_failed":
             continue
+        stat = os.stat(path_str)
+        sha256 = ((hashes or {}).get(path_str) or known_hashes.get((path_str, stat.st_size, stat.st_mtime_ns))
+                  or _file_sha256(path_str))
+        sources.append({"name": Path(path_str).name, "sha256": sha256, "path": path_str, "size": stat.st_size,
+                        "mtime_ns": stat.st_mtime_ns})
+
+    # reports missing from the joined file, an expired report in it means it has to be rebuilt
+    missing = sources
+    if manifest is not None:
+        by_sha256 = {}
+        for source in sources:
+            by_sha256.setdefault(source["sha256"], deque()).append(source)
+        joined_sources = []
+        for joined in manifest["sources"]:
+            matches = by_sha256.get(joined["sha256"])
+            if not matches:
+                manifest = None
+                break
+            joined_sources.append(matches.popleft())
+        matched = {id(source) for source in joined_sources}
+        missing = [source for source in sources if id(source) not in matched]
 
-        # SOP UID
-        sop_seq = dicom_file.get("ReferencedPerformedProcedureStepSequence", [])
-        if sop_seq and 'ReferencedSOPInstanceUID' in sop_seq[0]:
-            referenced_sop_instance_uid = sop_seq[0].ReferencedSOPInstanceUID
+    if manifest is None:
+        join_pdfs([source["path"] for source in sources], session=session, optimize=optimize)
+        joined_sources = sources
+    elif missing:
+        if _append_increment(save_file_path, [source["path"] for source in missing], session):
+            joined_sources += missing
         else:
-            print(" Missing ReferencedSOPInstanceUID")
-            continue
+            join_pdfs([source["path"] for source in sources], session=session, optimize=optimize)
+            joined_sources = sources
+    else:
+        return
+
+    write_json(manifest_path, {"size": save_file_path.stat().st_size, "sources": joined_sources})
+
+
+def _append_increment(save_file_path: Path, pdf_paths: list[str], session: PipelineSession) -> bool:
+    """
+    Append the pages of `pdf_paths` to the joined file as a PDF incremental update: the objects of the new
+    pages, a new revision of the page tree root listing them after the existing pages, and a cross-reference
+    section chained to the previous one. Only the new reports and the cross-reference table of the joined file
+    are parsed, its objects are neither loaded nor rewritten, so an update costs in proportion to the new reports.
+    Returns False if the joined file has no classic cross-reference table to chain to (it has to be rebuilt).
+    """
+    with open(save_file_path, "r+b") as joined_file, \
+            mmap.mmap(joined_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        tail = mapped[max(0, len(mapped) - 1024):]
+        try:
+            startxref = int(tail[tail.rindex(b"startxref") + len(b"startxref"):].split()[0])
+        except (ValueError, IndexError):
+            return False
+        if mapped[startxref:startxref + 4] != b"xref":
+            return False
+        reader = PdfReader(mapped)
+        trailer = reader.trailer
+        pages_ref = trailer["/Root"].raw_get("/Pages")
+        pages = pages_ref.get_object()
+        size = trailer["/Size"]
 
-        # All values are present, assemble the file name
-        pdf_file = f"{study_instance_uid}_{series_instance_uid}_{referenced_sop_instance_uid}.pdf"
-        out.append(pdf_file)
-        print(f" file {pdf_file} added")
+        increment = PdfWriter()
+        for path_str in pdf_paths:
+            with session.metrics.stage("merge"):
+                increment.append(Path(path_str))
 
-    return out
+        # the objects of the new pages are numbered after the existing ones, references into the joined file are kept
+        numbers, queue = {}, deque()
 
+        def renumber(reference):
+            if reference.pdf is not increment:
+                return reference
+            if reference.idnum not in numbers:
+                numbers[reference.idnum] = size + len(numbers)
+                queue.append(reference)
+            return pdf_generic.IndirectObject(numbers[reference.idnum], 0, None)
 
-def download_pdf_from_azure(pdf_file_name: str) -> bytes:
+        kids = []
+        for page in increment.pages:
+            page[pdf_generic.NameObject("/Parent")] = pages_ref
+            kids.append(renumber(page.indirect_reference))
+        objects = []
+        while queue:
+            reference = queue.popleft()
+            objects.append((numbers[reference.idnum], _renumber_references(reference.get_object(), renumber)))
+
+        root = pdf_generic.DictionaryObject(pages)
+        root[pdf_generic.NameObject("/Kids")] = pdf_generic.ArrayObject(list(pages["/Kids"]) + kids)
+        root[pdf_generic.NameObject("/Count")] = pdf_generic.NumberObject(pages["/Count"] + len(kids))
+        new_trailer = pdf_generic.DictionaryObject({
+            pdf_generic.NameObject(key): value for key, value in trailer.items() if key not in ("/Prev", "/XRefStm")
+        })
+        new_trailer[pdf_generic.NameObject("/Size")] = pdf_generic.NumberObject(size + len(objects))
+        new_trailer[pdf_generic.NameObject("/Prev")] = pdf_generic.NumberObject(startxref)
+
+        with session.metrics.stage("merge_write"):
+            joined_file.seek(len(mapped))
+            joined_file.write(b"\n")
+            offsets = []
+            for number, generation, obj in [(pages_ref.idnum, pages_ref.generation, root)] + \
+                    [(number, 0, obj) for number, obj in objects]:
+                offsets.append(joined_file.tell())
+                joined_file.write(f"{number} {generation} obj\n".encode())
+                obj.write_to_stream(joined_file)
+                joined_file.write(b"\nendobj\n")
+            xref = joined_file.tell()
+            # a subsection starting at object 0, as in the original table, other readers expect it first
+            joined_file.write(b"xref\n0 1\n0000000000 65535 f\r\n")
+            joined_file.write(f"{pages_ref.idnum} 1\n{offsets[0]:010d} {pages_ref.generation:05d} n\r\n".encode())
+            joined_file.write(f"{size} {len(objects)}\n".encode())
+            for offset in offsets[1:]:
+                joined_file.write(f"{offset:010d} 00000 n\r\n".encode())
+            joined_file.write(b"trailer\n")
+            new_trailer.write_to_stream(joined_file)
+            joined_file.write(f"\nstartxref\n{xref}\n%%EOF\n".encode())
+            joined_file.flush()
+            os.fsync(joined_file.fileno())
+    return True
+
+
+def _renumber_references(obj, renumber: Callable):
     """
-    This function downloads a PDF report from the Azure Blob Storage stored
-    under the given `pdf_file_name`. Uses the 'pdf-reports' container.
-    Returns the downloaded PDF report as bytes.
+    Replace the indirect references in the direct objects nested in `obj` by `renumber` of them, in place.
     """
-    # Load environment variables
-    load_dotenv()
-    connection_string = os.getenv("AZURE_CONNECTION_STRING")
-    container = "pdf-reports"
-    blob = '/tmp/' + pdf_file_name # this was needed in my case
+    if isinstance(obj, pdf_generic.IndirectObject):
+        return renumber(obj)
+    if isinstance(obj, dict):
+        for key, value in list(obj.items()):
+            obj[key] = _renumber_references(value, renumber)
+    elif isinstance(obj, list):
+        for i, value in enumerate(obj):
+            obj[i] = _renumber_references(value, renumber)
+    return obj
 
-    # Connect to Azure Blob Service
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    try:
-        blob_client = blob_service_client.get_blob_client(container=container, blob=blob)
 
-        print(f"Downloading: {blob}")
-        content = blob_client.download_blob().readall()
-        print(f"✅ Found matching blob: {blob}")
-        return content
-    except Exception as e:
-        print(f"❌ Failed to download blob: {e}")
-        return "download_failed"
+def _file_sha256(path: str | Path) -> str:
+    """
+    Return the hex SHA-256 digest of the file content.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
 
 
-def store_pdf_on_disk(pdf: bytes) -> str:
+def join_pdfs_split(pdf_paths: Iterable[str], max_pages: int | None = JOINED_PART_MAX_PAGES,
+                    max_bytes: int | None = JOINED_PART_MAX_BYTES, session: PipelineSession | None = None,
+                    optimize: bool = False) -> list[str]:
     """
-    Store the PDF report (received as bytes) on the local file system.
-    The target destination is configured via the `PDF_TARGET_DIR` environment variable.
+    Joins multiple PDF files into `joined_report_partNNN.pdf` files of at most `max_pages` pages and about
+    `max_bytes` bytes (estimated from the input sizes), a single larger input gets a part of its own.
+    Every part is written and released before the next one starts, so memory is bounded by the part size
+    regardless of the number of inputs. The parts and their source reports are listed in `joined_report_index.json`.
+    With `optimize`, every part is deduplicated and compressed on its own. Returns the paths of the written parts.
     """
-    # if download failed in previous case, return this status instead of relevant string
-    if pdf == "download_failed":
-        return "download_failed"
-    
-    # variables for file handling
-    load_dotenv()
-    save_folder = Path(os.getenv("PDF_TARGET_DIR", "pdf_reports"))
-    base_name = "report{}.pdf"
-    name_template = re.compile(r"^report(\d+)\.pdf$")
+    session = session or PipelineSession()
+    save_folder = session.joined_pdf_target_dir
     save_folder.mkdir(parents=True, exist_ok=True)
+    # parts left over from a previous, longer run would be mistaken for a part of this one
+    for old_part in save_folder.glob("joined_report_part*.pdf"):
+        old_part.unlink()
 
-    # find reportxxx.pdf with highest number
-    max_num = 0
-    for file in save_folder.iterdir():
-        match = name_template.match(file.name)
-        if match:
-            num = int(match.group(1))
-            if num > max_num:
-                max_num = num
+    parts = []
+    merger, sources, pages, size = None, [], 0, 0
 
-    # save the pdf file and return the path
-    save_path = save_folder / base_name.format(max_num + 1)
-    save_path.write_bytes(pdf)
+    def write_part() -> None:
+        part_path = save_folder / f"joined_report_part{len(parts) + 1:03d}.pdf"
+        if optimize:
+            _optimize_merged(merger, session)
+        with session.metrics.stage("merge_write"):
+            merger.write(str(part_path))
+        merger.close()
+        if optimize:
+            _report_merged_size(part_path, size, session)
+        parts.append({"file": part_path.name, "pages": pages, "bytes": part_path.stat().st_size, "sources": sources})
 
-    return str(save_path)
+    # add all relevant pdfs (download_failed are ommited)
+    for path_str in pdf_paths:
+        if path_str == "download_failed":
+            continue
+        reader = PdfReader(path_str)
+        source_pages = len(reader.pages)
+        source_size = os.path.getsize(path_str)
+
+        # start a new part when this report would not fit into the current one
+        if merger is not None and ((max_pages and pages + source_pages > max_pages)
+                                   or (max_bytes and size + source_size > max_bytes)):
+            write_part()
+            merger = None
+        if merger is None:
+            merger, sources, pages, size = PdfWriter(), [], 0, 0
 
+        with session.metrics.stage("merge"):
+            merger.append(reader)
+        sources.append(path_str)
+        pages += source_pages
+        size += source_size
 
-def join_pdfs(pdf_paths: list[str]) -> None:
+    if merger is not None:
+        write_part()
+
+    index_path = save_folder / "joined_report_index.json"
+    write_json(index_path, {"parts": parts})
+    return [str(save_folder / part["file"]) for part in parts]
+
+
+def join_pdfs_grouped(grouped_paths: Iterable[tuple[str, str]], group_by: str,
+                      session: PipelineSession | None = None, processes: int = 1,
+                      optimize: bool = False) -> list[str]:
     """
-    Joins multiple PDF files into a single PDF file.
-    The output path is configured via the `JOINED_PDF_TARGET_DIR` environment variable.
+    Joins the PDF files given as (group, path) pairs into one `joined_report_<group_by>_<group>.pdf` per group,
+    every group keeps the order of its paths. Up to `processes` groups are merged at once in worker processes,
+    the largest first. The groups, their files and source reports are listed in `joined_report_groups.json`.
+    Returns the paths of the written files.
     """
-    # read global variables
-    load_dotenv()
-    save_folder = Path(os.getenv("JOINED_PDF_TARGET_DIR", "joined_pdfs"))
-    save_file_path = save_folder / "joined_report.pdf"
+    session = session or PipelineSession()
+    save_folder = session.joined_pdf_target_dir
     save_folder.mkdir(parents=True, exist_ok=True)
+    # groups left over from a previous run would be mistaken for groups of this one
+    for old_group in save_folder.glob(f"joined_report_{group_by}_*.pdf"):
+        old_group.unlink()
 
-    # add all relevant pdfs (download_failed are ommited)
-    merger = PdfWriter()
-    for path_str in pdf_paths:
+    groups = {}
+    for group, path_str in grouped_paths:
         if path_str != "download_failed":
-            merger.append(Path(path_str))
+            groups.setdefault(group, []).append(path_str)
 
-    # write the joined pdf
-    merger.write(str(save_file_path))
-    merger.close()
+    # the group keys come from the DB and the DICOM files, keep only characters safe in a file name
+    file_names, used = {}, set()
+    for group in groups:
+        base_name = f"joined_report_{group_by}_{re.sub(r'[^A-Za-z0-9.-]', '_', group)}"
+        file_name, n = f"{base_name}.pdf", 1
+        while file_name in used:
+            n += 1
+            file_name = f"{base_name}_{n}.pdf"
+        used.add(file_name)
+        file_names[group] = file_name
 
-if __name__ == '__main__':
-    # --- Argument Parsing ---
-    parser = argparse.ArgumentParser(description="Download and merge PDFs from Azure by date.")
-    parser.add_argument(
+    largest_first = sorted(groups, key=lambda group: len(groups[group]), reverse=True)
+    if processes <= 1 or len(groups) <= 1:
+        for group in largest_first:
+            join_pdfs(groups[group], session=session, optimize=optimize, file_name=file_names[group])
+    else:
+        with ProcessPoolExecutor(max_workers=min(processes, len(groups)),
+                                 mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = [pool.submit(_join_group, groups[group], str(save_folder), file_names[group], optimize)
+                       for group in largest_first]
+            for future in futures:
+                session.metrics.merge(*future.result())
+    print(f"📎 {len(groups)} groups by {group_by} joined")
+
+    write_json(save_folder / "joined_report_groups.json", {
+        "group_by": group_by,
+        "groups": [{"group": group, "file": file_names[group], "reports": len(paths), "sources": paths}
+                   for group, paths in groups.items()],
+    })
+    return [str(save_folder / file_names[group]) for group in groups]
+
+
+def _join_group(pdf_paths: list[str], save_folder: str, file_name: str,
+                optimize: bool) -> tuple[list[tuple[str, float, int, bool]], dict[str, int]]:
+    """
+    Join the reports of one group in a worker process, which has no session of its own.
+    Returns the stage observations and counters of the merge, for the metrics of the parent session.
+    """
+    with PipelineSession() as session:
+        session.metrics = RunMetrics(record=True)
+        session.joined_pdf_target_dir = Path(save_folder)
+        join_pdfs(pdf_paths, session=session, optimize=optimize, file_name=file_name)
+        return session.metrics.observations, dict(session.metrics.counters)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """
+    Command line of the pipeline, every stage is a command that reads the state of the previous one from
+    `--state-dir` and writes its own there. `run` runs all the stages at once without the intermediate files.
+    """
+    telemetry = argparse.ArgumentParser(add_help=False)
+    telemetry.add_argument(
+        "--log-level",
+        choices=["DEBUG", "INFO", "WARNING"],
+        default="INFO",
+        help="Level of the telemetry logs, DEBUG logs every stage run and skipped report (default: INFO).",
+    )
+    telemetry.add_argument(
+        "--log-json",
+        action="store_true",
+        help="Write the telemetry logs as JSON lines.",
+    )
+    telemetry.add_argument(
+        "--metrics-json",
+        type=str,
+        help="Optional path to write the end-of-run metrics summary to as JSON.",
+    )
+    telemetry.add_argument(
+        "--metrics-prom",
+        type=str,
+        help="Optional path to write the end-of-run metrics to in the Prometheus textfile format.",
+    )
+
+    state = argparse.ArgumentParser(add_help=False)
+    state.add_argument(
+        "--state-dir",
+        type=str,
+        default=DEFAULT_STATE_DIR,
+        help=f"Directory of the intermediate state passed between the commands (default: {DEFAULT_STATE_DIR}).",
+    )
+
+    workers = argparse.ArgumentParser(add_help=False)
+    workers.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of DICOM files and PDFs downloaded concurrently (default: 1).",
+    )
+    workers.add_argument(
+        "--max-inflight-mb",
+        type=int,
+        help="Cap on the megabytes of DICOM files and PDFs held in memory at once, new downloads wait for room.",
+    )
+
+    storage = argparse.ArgumentParser(add_help=False)
+    storage.add_argument(
+        "--list-blobs",
+        action="store_true",
+        help="List the containers once per run and skip blobs missing from the listing instead of probing each one.",
+    )
+    storage.add_argument(
+        "--missing-blob-cache",
+        type=str,
+        help="Optional path of a local SQLite cache of blobs missing from Azure, skipped until due for a re-probe.",
+    )
+
+    dates = argparse.ArgumentParser(add_help=False)
+    dates.add_argument(
         "--date",
         type=str,
         help="Optional start date in format YYYY-MM-DD. If not set, defaults to today.",
     )
-    parser.add_argument(
+    dates.add_argument(
         "--delta",
         type=int,
         default=14,
         help="Number of days forward from the start date (default: 14).",
     )
-    args = parser.parse_args()
 
-    # --- Date Handling ---
+    sharding = argparse.ArgumentParser(add_help=False)
+    sharding.add_argument(
+        "--shard-days",
+        type=int,
+        help="Split the window into shards of this many days, processed independently and joined in the DB order.",
+    )
+    sharding.add_argument(
+        "--shard-workers",
+        type=int,
+        default=1,
+        help="Number of shards processed at once in separate processes (default: 1).",
+    )
+
+    window = argparse.ArgumentParser(add_help=False)
+    window.add_argument(
+        "--batch-size",
+        type=int,
+        help="Stream the DB rows through a server-side cursor, fetching this many rows at a time.",
+    )
+    window.add_argument(
+        "--db-index",
+        action="store_true",
+        help="Use the DICOM metadata backfilled into the dicom_report_metadata table, write through new ones.",
+    )
+    window.add_argument(
+        "--header-only",
+        action="store_true",
+        help="Download and parse only the header of each DICOM file instead of the whole file.",
+    )
+    window.add_argument(
+        "--metadata-index",
+        type=str,
+        help="Optional path of a local SQLite index of already parsed DICOM metadata, reused across runs.",
+    )
+    window.add_argument(
+        "--parse-workers",
+        type=int,
+        default=0,
+        help="Parse DICOM files in a pool of this many processes, at most --workers "
+             "(default: 0, parse in the download threads).",
+    )
+
+    fetching = argparse.ArgumentParser(add_help=False)
+    fetching.add_argument(
+        "--content-store",
+        action="store_true",
+        help="Store PDFs content-addressed in PDF_TARGET_DIR, skipping duplicates and already stored reports.",
+    )
+    fetching.add_argument(
+        "--stream-to-disk",
+        action="store_true",
+        help="Stream PDFs straight into PDF_TARGET_DIR under their own names and join them memory-mapped.",
+    )
+
+    merging = argparse.ArgumentParser(add_help=False)
+    merging.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Append only new reports to the existing joined report instead of rebuilding it.",
+    )
+    merging.add_argument(
+        "--max-part-pages",
+        type=int,
+        help="Split the joined report into parts of at most this many pages.",
+    )
+    merging.add_argument(
+        "--max-part-mb",
+        type=int,
+        help="Split the joined report into parts of at most about this many megabytes.",
+    )
+    merging.add_argument(
+        "--optimize",
+        action="store_true",
+        help="Deduplicate the fonts, images and other objects shared by the reports and compress the joined report.",
+    )
+
+    parser = argparse.ArgumentParser(description="Download and merge PDFs from Azure by date.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser(
+        "resolve",
+        parents=[telemetry, state, workers, storage, dates, window],
+        help="Resolve the PDF report names of the window from the DB and the DICOM files.",
+    )
+    commands.add_parser(
+        "fetch",
+        parents=[telemetry, state, workers, storage, fetching],
+        help="Download and store the PDF reports resolved by `resolve`.",
+    )
+    merge = commands.add_parser(
+        "merge",
+        parents=[telemetry, state, merging],
+        help="Join the PDF reports stored by `fetch`.",
+    )
+    merge.add_argument(
+        "--mmap",
+        action="store_true",
+        help="Parse the stored reports memory-mapped instead of reading them into memory first.",
+    )
+    shard = commands.add_parser(
+        "shard",
+        parents=[telemetry, state, workers, storage, dates, window, sharding],
+        help="Resolve and fetch the shards of the window, on several hosts sharing --state-dir (--date is required).",
+    )
+    shard.add_argument(
+        "--shard-of",
+        type=str,
+        default="0/1",
+        help="Process only the shards of this host, I/N takes every N-th shard starting with the I-th (default: 0/1).",
+    )
+    reduce = commands.add_parser(
+        "reduce",
+        parents=[telemetry, state, dates, sharding, merging],
+        help="Join the reports of all the shards of the window in the order of an unsharded run.",
+    )
+    watch = commands.add_parser(
+        "watch",
+        parents=[telemetry, state, workers, window, fetching],
+        help="Keep polling the DB and append the reports of new rows to the joined report.",
+    )
+    watch.add_argument(
+        "--delta",
+        type=int,
+        default=14,
+        help="Accept reports of DICOM files created up to this many days before now (default: 14).",
+    )
+    watch.add_argument(
+        "--poll-interval",
+        type=float,
+        default=60.0,
+        help="Seconds between two polls of the DB (default: 60).",
+    )
+    watch.add_argument(
+        "--cycles",
+        type=int,
+        help="Stop after this many polls instead of running until interrupted.",
+    )
+    watch.add_argument(
+        "--missing-blob-cache",
+        type=str,
+        help="Optional path of a local SQLite cache of blobs missing from Azure, skipped until due for a re-probe.",
+    )
+    # the listing of a long-running session would never see the new blobs
+    watch.set_defaults(list_blobs=False)
+    run = commands.add_parser(
+        "run",
+        parents=[telemetry, state, workers, storage, dates, window, fetching, merging, sharding],
+        help="Run all the stages at once, the default without a command.",
+    )
+    run.add_argument(
+        "--backfill-db-index",
+        action="store_true",
+        help="Only store the DICOM metadata of the window into the dicom_report_metadata table and exit.",
+    )
+    run.add_argument(
+        "--journal",
+        type=str,
+        help="Optional path of a SQLite journal recording the resolved names and stored PDFs as they finish.",
+    )
+    run.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the run recorded in --journal (and its window) instead of starting over.",
+    )
+    run.add_argument(
+        "--engine",
+        choices=["sync", "async"],
+        default="sync",
+        help="Run the pipeline on threads (sync, default) or on asyncio with the async Azure and Postgres clients.",
+    )
+    run.add_argument(
+        "--group-by",
+        choices=GROUP_BY,
+        help="Write one joined report per sending AET or per study instead of a single one.",
+    )
+    run.add_argument(
+        "--group-workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of groups joined at once in worker processes (default: number of CPUs).",
+    )
+    return parser
+
+
+def _date_window(args: argparse.Namespace) -> tuple[datetime, datetime]:
+    """
+    Return the `from_` and `to` of the window given by `--date` and `--delta`.
+    """
     if args.date:
         try:
             to_date = datetime.strptime(args.date, "%Y-%m-%d")
@@ -236,15 +2018,253 @@ if __name__ == '__main__':
         to_date = datetime.now()
 
     from_date = to_date - timedelta(days=args.delta)
-
     print(f"📅 Filtering PDFs from {from_date.date()} to {to_date.date()}")
+    return from_date, to_date
+
+
+def _open_session(args: argparse.Namespace, stack: ExitStack) -> PipelineSession:
+    """
+    Open the session of a command with the blob options of `args`, closed with `stack`.
+    """
+    missing_blobs = None
+    if args.missing_blob_cache:
+        missing_blobs = stack.enter_context(MissingBlobCache(args.missing_blob_cache))
+    return stack.enter_context(PipelineSession(pool_size=max(2 * args.workers, 16), missing_blobs=missing_blobs,
+                                               list_blobs=args.list_blobs,
+                                               byte_budget=_byte_budget(args.max_inflight_mb)))
+
+
+def _byte_budget(max_inflight_mb: int | None) -> ByteBudget | None:
+    """
+    Return the byte budget of `--max-inflight-mb`, None without a cap.
+    """
+    return ByteBudget(max_inflight_mb * 1024 * 1024) if max_inflight_mb else None
+
+
+def _merge_function(args: argparse.Namespace, use_mmap: bool) -> Callable[..., object]:
+    """
+    Return the merge step selected by the merge options of `args`.
+    """
+    if args.incremental:
+        return partial(join_pdfs_incremental, optimize=args.optimize)
+    if args.max_part_pages or args.max_part_mb:
+        return partial(join_pdfs_split, max_pages=args.max_part_pages,
+                       max_bytes=args.max_part_mb and args.max_part_mb * 1024 * 1024, optimize=args.optimize)
+    return partial(join_pdfs, use_mmap=use_mmap, optimize=args.optimize)
+
+
+def _report_metrics(metrics: RunMetrics, args: argparse.Namespace) -> None:
+    metrics.log_summary()
+    if args.metrics_json:
+        metrics.write_json(args.metrics_json)
+    if args.metrics_prom:
+        metrics.write_prometheus(args.metrics_prom)
+
+
+def resolve_command(args: argparse.Namespace) -> None:
+    """
+    Resolve the PDF report names of the window and write them into `names.txt` of the state directory.
+    """
+    from_date, to_date = _date_window(args)
+    with ExitStack() as stack:
+        session = _open_session(args, stack)
+        index = stack.enter_context(MetadataIndex(args.metadata_index)) if args.metadata_index else None
+        pdf_file_names = iter_pdf_file_names(from_date, to_date, args.workers, args.header_only, index, session,
+                                             args.batch_size, args.db_index, args.parse_workers)
+        count = write_lines(Path(args.state_dir) / NAMES_FILE, pdf_file_names)
+        print(f"📝 {count} PDF report names written to {args.state_dir}")
+        _report_metrics(session.metrics, args)
+
+
+def fetch_command(args: argparse.Namespace) -> None:
+    """
+    Download and store the PDF reports named in `names.txt`, write the stored paths into `pdfs.txt`.
+    """
+    pdf_file_names = read_lines(Path(args.state_dir) / NAMES_FILE)
+    with ExitStack() as stack:
+        session = _open_session(args, stack)
+        store = stack.enter_context(ContentStore(session.pdf_target_dir)) if args.content_store else None
+        pdf_paths = fetch_pdfs(pdf_file_names, args.workers, session, content_store=store,
+                               stream_to_disk=args.stream_to_disk)
+        count = write_lines(Path(args.state_dir) / PDFS_FILE,
+                            (path for path in pdf_paths if path != "download_failed"))
+        print(f"📝 {count} of {len(pdf_file_names)} PDF reports stored")
+        _report_metrics(session.metrics, args)
+
+
+def merge_command(args: argparse.Namespace) -> None:
+    """
+    Join the PDF reports listed in `pdfs.txt`.
+    """
+    pdf_paths = read_lines(Path(args.state_dir) / PDFS_FILE)
+    with PipelineSession() as session:
+        _merge_function(args, args.mmap)(pdf_paths, session=session)
+        _report_metrics(session.metrics, args)
+
 
-    # --- Execution ---
-    pdf_file_names = get_pdf_file_names(from_=from_date, to=to_date)
-    pdf_paths = []
-    for pdf_file_name in pdf_file_names:
-        pdf = download_pdf_from_azure(pdf_file_name)
-        pdf_path = store_pdf_on_disk(pdf)
-        pdf_paths.append(pdf_path)
+def _shard_options(args: argparse.Namespace) -> dict:
+    """
+    Keyword arguments of `run_shard` given by `args`.
+    """
+    return {
+        "workers": args.workers,
+        "header_only": args.header_only,
+        "metadata_index": args.metadata_index,
+        "batch_size": args.batch_size,
+        "db_index": args.db_index,
+        "parse_workers": args.parse_workers,
+        "list_blobs": args.list_blobs,
+        "missing_blob_cache": args.missing_blob_cache,
+        "max_inflight_mb": args.max_inflight_mb,
+    }
+
+
+def shard_command(args: argparse.Namespace) -> None:
+    """
+    Process the shards of the window assigned to this host by `--shard-of`.
+    """
+    if not args.shard_days:
+        raise ValueError("⚠️ --shard-days is required to shard the window.")
+    # without a fixed date every call would plan the shards of a different window
+    if not args.date:
+        raise ValueError("⚠️ --date is required to shard the window.")
+    try:
+        shard_index, shard_count = (int(part) for part in args.shard_of.split("/"))
+    except ValueError:
+        raise ValueError("⚠️ Invalid --shard-of. Use I/N.")
+    from_date, to_date = _date_window(args)
+    run_shards(from_date, to_date, timedelta(days=args.shard_days), args.state_dir, args.shard_workers,
+               shard_index, shard_count, **_shard_options(args))
+
+
+def reduce_command(args: argparse.Namespace) -> None:
+    """
+    Join the reports of the finished shards of the window.
+    """
+    if not args.shard_days:
+        raise ValueError("⚠️ --shard-days is required to reduce the shards of the window.")
+    if not args.date:
+        raise ValueError("⚠️ --date is required to reduce the shards of the window.")
+    _reduce_window(args, *_date_window(args))
+
+
+def _reduce_window(args: argparse.Namespace, from_date: datetime, to_date: datetime) -> None:
+    with PipelineSession() as session:
+        # the shards stream the reports into files, they are joined memory-mapped
+        count = reduce_shards(from_date, to_date, timedelta(days=args.shard_days), args.state_dir,
+                              _merge_function(args, use_mmap=True), session)
+        print(f"📎 {count} reports of the shards joined")
+        _report_metrics(session.metrics, args)
+
+
+def watch_command(args: argparse.Namespace) -> None:
+    """
+    Poll the DB for new reports until interrupted (or for `--cycles` polls), see `watch_reports`.
+    """
+    with ExitStack() as stack:
+        session = _open_session(args, stack)
+        index = stack.enter_context(MetadataIndex(args.metadata_index)) if args.metadata_index else None
+        store = stack.enter_context(ContentStore(session.pdf_target_dir)) if args.content_store else None
+        watch_reports(timedelta(days=args.delta), args.state_dir, args.poll_interval, args.workers,
+                      args.header_only, index, session, args.batch_size, args.db_index, args.parse_workers, store,
+                      args.stream_to_disk, args.cycles, on_cycle=lambda session: _report_metrics(session.metrics, args))
+
+
+def run_command(args: argparse.Namespace) -> None:
+    """
+    Run all the stages of the window at once, or only backfill its DICOM metadata with `--backfill-db-index`.
+    """
+    if args.resume and not args.journal:
+        raise ValueError("⚠️ --resume needs the --journal of the run to resume.")
+    if (args.journal or args.shard_days or args.group_by) and (args.engine == "async" or args.backfill_db_index):
+        raise ValueError("⚠️ --journal, --shard-days and --group-by are supported only by the sync engine run.")
+    if args.engine == "async":
+        # the async engine has its own session and downloads, without these options
+        unsupported = [flag for flag, value in (
+            ("--max-inflight-mb", args.max_inflight_mb), ("--list-blobs", args.list_blobs),
+            ("--missing-blob-cache", args.missing_blob_cache), ("--parse-workers", args.parse_workers),
+            ("--db-index", args.db_index), ("--content-store", args.content_store),
+            ("--stream-to-disk", args.stream_to_disk)) if value]
+        if unsupported:
+            raise ValueError(f"⚠️ {', '.join(unsupported)} not supported by the async engine.")
+    if args.group_by and (args.shard_days or args.incremental or args.max_part_pages or args.max_part_mb):
+        raise ValueError("⚠️ --group-by cannot be combined with --shard-days, --incremental or --max-part-*.")
+    # the shards stream every report into a file named after it
+    if args.shard_days and args.content_store:
+        raise ValueError("⚠️ --content-store cannot be combined with --shard-days.")
+    from_date, to_date = _date_window(args)
+    if args.shard_days:
+        # finished shards are skipped, so a sharded run with the same --date is resumed by running it again
+        run_shards(from_date, to_date, timedelta(days=args.shard_days), args.state_dir, args.shard_workers,
+                   **_shard_options(args))
+        _reduce_window(args, from_date, to_date)
+        return
+    if args.engine == "async":
+        import asyncio
+
+        from aggregate_pdf_reports_async import AsyncPipelineSession, run_pipeline_async
+
+        async def run_async() -> None:
+            async with AsyncPipelineSession() as session:
+                with MetadataIndex(args.metadata_index) if args.metadata_index else nullcontext() as index:
+                    await run_pipeline_async(from_=from_date, to=to_date, session=session,
+                                             concurrency=args.workers, header_only=args.header_only, index=index,
+                                             batch_size=args.batch_size, merge=_merge_function(args, use_mmap=False))
+                _report_metrics(session.config.metrics, args)
+
+        asyncio.run(run_async())
+        return
 
-    join_pdfs(pdf_paths)
+    with ExitStack() as stack:
+        session = _open_session(args, stack)
+        index = stack.enter_context(MetadataIndex(args.metadata_index)) if args.metadata_index else None
+        journal = stack.enter_context(RunJournal(args.journal, resume=args.resume)) if args.journal else None
+        if journal is not None and journal.window is not None:
+            # the window of a resumed run does not move with today's date
+            from_date, to_date = journal.window
+            print(f"⏯️ Resuming the run of PDFs from {from_date.date()} to {to_date.date()}")
+        elif journal is not None:
+            journal.start(from_date, to_date)
+        if args.backfill_db_index:
+            count = backfill_db_metadata(from_=from_date, to=to_date, workers=args.workers,
+                                         header_only=args.header_only, index=index, session=session,
+                                         batch_size=args.batch_size, parse_workers=args.parse_workers)
+            print(f"Metadata of {count} reports in the window stored in the DB")
+        else:
+            store = stack.enter_context(ContentStore(session.pdf_target_dir)) if args.content_store else None
+            if args.group_by:
+                merge = partial(join_pdfs_grouped, group_by=args.group_by, processes=args.group_workers,
+                                optimize=args.optimize)
+            else:
+                merge = _merge_function(args, args.stream_to_disk)
+            run_pipeline(from_=from_date, to=to_date, workers=args.workers,
+                         header_only=args.header_only, index=index, session=session,
+                         batch_size=args.batch_size, db_index=args.db_index, content_store=store,
+                         merge=merge, stream_to_disk=args.stream_to_disk,
+                         parse_workers=args.parse_workers, journal=journal, group_by=args.group_by)
+        _report_metrics(session.metrics, args)
+
+
+COMMANDS = {
+    "resolve": resolve_command,
+    "fetch": fetch_command,
+    "merge": merge_command,
+    "shard": shard_command,
+    "reduce": reduce_command,
+    "watch": watch_command,
+    "run": run_command,
+}
+
+
+def main(argv: list[str] | None = None) -> None:
+    argv = list(sys.argv[1:] if argv is None else argv)
+    # without a command the whole pipeline is run, as before the commands existed
+    if not argv or (argv[0] not in COMMANDS and argv[0] not in ("-h", "--help")):
+        argv.insert(0, "run")
+    args = build_parser().parse_args(argv)
+    configure_logging(args.log_level, args.log_json)
+    COMMANDS[args.command](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+import asyncio
+import psycopg
+import pydicom
+
+from collections import deque
+from contextlib import AsyncExitStack
+from datetime import datetime
+from io import BytesIO
+from typing import AsyncIterator, Awaitable, Callable, TypeVar
+
+from azure.storage.blob.aio import BlobServiceClient
+
+from aggregate_pdf_reports import (
+    DICOM_HEADER_CHUNK_SIZE, DICOM_REPORTS_QUERY, MAX_RETRIES, PipelineSession, _assemble_pdf_file_name,
+    _parse_dicom_metadata, _read_dicom_header, join_pdfs, store_pdf_on_disk,
+)
+from metadata_index import DicomMetadata, MetadataIndex
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class AsyncPipelineSession:
+    """
+    Asyncio counterpart of `PipelineSession`, shares its configuration loaded from the environment.
+    Holds one async Azure client per storage account and a single async Postgres connection,
+    close the session (or use it as an async context manager) to release them.
+    """
+    def __init__(self, pool_size: int = 16):
+        # configuration and local target directories, the sync session opens no connections by itself
+        self.config = PipelineSession(pool_size=pool_size)
+        self._exit_stack = AsyncExitStack()
+        self._blob_service_clients = {}
+        self._pg_connection = None
+        self._pg_lock = asyncio.Lock()
+
+    def blob_service_client(self, connection_string: str | None = None) -> BlobServiceClient:
+        """
+        Return the async client of the storage account, created on first use.
+        """
+        connection_string = connection_string or self.config.connection_string
+        if connection_string not in self._blob_service_clients:
+            client = BlobServiceClient.from_connection_string(connection_string)
+            self._exit_stack.push_async_callback(client.close)
+            self._blob_service_clients[connection_string] = client
+        return self._blob_service_clients[connection_string]
+
+    async def pg_connection(self) -> psycopg.AsyncConnection:
+        """
+        Return the async Postgres connection, connecting on first use with exponential back-off.
+        """
+        async with self._pg_lock:
+            if self._pg_connection is not None:
+                return self._pg_connection
+
+            config = self.config
+            for i in range(MAX_RETRIES):
+                try:
+                    connection = await psycopg.AsyncConnection.connect(
+                        user=config.pg_user, password=config.pg_password, host=config.pg_host,
+                        port=config.pg_port, dbname=config.pg_database, autocommit=True)
+                    self._pg_connection = await self._exit_stack.enter_async_context(connection)
+                    return self._pg_connection
+                except Exception:
+                    print(f"Database unreachable, retrying {i + 1}/{MAX_RETRIES}")
+                    if i + 1 != MAX_RETRIES:
+                        await asyncio.sleep(2 ** (i + 1))
+            raise ValueError("Failed to connect to the database after retries.")
+
+    async def aclose(self) -> None:
+        """
+        Close all the connections opened by the session.
+        """
+        await self._exit_stack.aclose()
+        self._blob_service_clients = {}
+        self._pg_connection = None
+
+    async def __aenter__(self) -> "AsyncPipelineSession":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+
+async def get_pdf_file_names_async(from_: datetime, to: datetime, session: AsyncPipelineSession,
+                                   concurrency: int = 32, header_only: bool = False,
+                                   index: MetadataIndex | None = None, batch_size: int | None = None) -> list[str]:
+    """
+    Asyncio version of `get_pdf_file_names`, fetches up to `concurrency` DICOM files at once.
+    """
+    pdf_file_names = _iter_pdf_file_names(from_, to, session, concurrency, header_only, index, batch_size)
+    return [pdf_file async for pdf_file in pdf_file_names]
+
+
+async def _iter_pdf_file_names(from_: datetime, to: datetime, session: AsyncPipelineSession,
+                               concurrency: int, header_only: bool, index: MetadataIndex | None,
+                               batch_size: int | None = None) -> AsyncIterator[str]:
+    """
+    Yield the resolved PDF file names in the order of the DB query, fetching up to `concurrency` DICOM files at once.
+    """
+    conn = await session.pg_connection()
+    result_dcms = _query_dicom_reports(conn, {"from": from_, "to": to}, batch_size)
+
+    blob_service_client = session.blob_service_client()
+    fetch_limit = asyncio.Semaphore(concurrency)
+
+    async def resolve(row: tuple[str, str]) -> tuple[str, str | None, str]:
+        file_name, container = row
+        async with fetch_limit:
+            return file_name, *await _resolve_pdf_file_name(blob_service_client, file_name, container,
+                                                            from_, to, header_only, index)
+
+    metrics = session.config.metrics
+    async for file_name, pdf_file, status in _ordered_gather(resolve, result_dcms, concurrency):
+        print(file_name + status)
+        if pdf_file is None:
+            metrics.skip(status, file_name)
+        else:
+            metrics.increment("reports_resolved")
+            yield pdf_file
+
+
+async def _query_dicom_reports(conn: psycopg.AsyncConnection, params: dict,
+                               batch_size: int | None = None) -> AsyncIterator[tuple]:
+    """
+    Asyncio version of `aggregate_pdf_reports._query_dicom_reports`.
+    """
+    if batch_size is None:
+        async with conn.cursor() as cur:
+            try:
+                await cur.execute(DICOM_REPORTS_QUERY, params)
+                result_dcms = await cur.fetchall()
+            except Exception as e:
+                raise ValueError(e)
+        for row in result_dcms:
+            yield row
+        return
+
+    # server-side cursors live inside a transaction, the session connection is in autocommit mode
+    async with conn.transaction(), conn.cursor(name="dicom_reports") as cur:
+        cur.itersize = batch_size
+        try:
+            await cur.execute(DICOM_REPORTS_QUERY, params)
+        except Exception as e:
+            raise ValueError(e)
+        async for row in cur:
+            yield row
+
+
+async def _resolve_pdf_file_name(blob_service_client: BlobServiceClient, file_name: str, container: str,
+                                 from_: datetime, to: datetime, header_only: bool,
+                                 index: MetadataIndex | None) -> tuple[str | None, str]:
+    """
+    Asyncio version of `aggregate_pdf_reports._get_dicom_metadata`, also assembles the PDF file name.
+    """
+    blob_client = blob_service_client.get_blob_client(container, file_name)
+
+    # look up the metadata of an unchanged blob in the local index
+    if index is not None:
+        try:
+            etag = (await blob_client.get_blob_properties()).etag
+        except Exception:
+            return None, " not in storage"
+        metadata = index.get(container, file_name, etag)
+        if metadata is not None:
+            return _assemble_pdf_file_name(metadata, from_, to)
+
+    metadata = await _download_dicom_metadata(blob_client, header_only)
+    if metadata is None:
+        return None, " not in storage"
+    if index is not None:
+        index.put(container, file_name, etag, metadata)
+    return _assemble_pdf_file_name(metadata, from_, to)
+
+
+async def _download_dicom_metadata(blob_client, header_only: bool) -> DicomMetadata | None:
+    """
+    Asyncio version of `aggregate_pdf_reports._download_dicom_metadata`.
+    Whole files are parsed in a worker thread so the event loop is not blocked.
+    """
+    if header_only:
+        # download a growing initial range of the blob until the whole header is read
+        length = DICOM_HEADER_CHUNK_SIZE
+        while True:
+            try:
+                content = await (await blob_client.download_blob(offset=0, length=length)).readall()
+            except Exception:
+                return None
+            try:
+                dicom_file = _read_dicom_header(content, whole_blob=len(content) < length)
+            except Exception:
+                return DicomMetadata(readable=False)
+            if dicom_file is not None:
+                return _parse_dicom_metadata(dicom_file)
+            length *= 2
+
+    # connect to blob storage
+    try:
+        content = await (await blob_client.download_blob()).readall()
+    except Exception:
+        return None
+
+    # read the file
+    try:
+        dicom_file = await asyncio.to_thread(pydicom.dcmread, BytesIO(content))
+    except Exception:
+        return DicomMetadata(readable=False)
+    return _parse_dicom_metadata(dicom_file)
+
+
+async def download_pdf_from_azure_async(pdf_file_name: str, session: AsyncPipelineSession) -> bytes:
+    """
+    Asyncio version of `download_pdf_from_azure`, returns "download_failed" if the blob cannot be downloaded.
+    """
+    container = "pdf-reports"
+    blob = '/tmp/' + pdf_file_name # this was needed in my case
+
+    try:
+        blob_client = session.blob_service_client().get_blob_client(container=container, blob=blob)
+
+        print(f"Downloading: {blob}")
+        with session.config.metrics.stage("pdf_download") as span:
+            content = await (await blob_client.download_blob()).readall()
+            span.bytes = len(content)
+        print(f"✅ Found matching blob: {blob}")
+        return content
+    except Exception as e:
+        print(f"❌ Failed to download blob: {e}")
+        return "download_failed"
+
+
+async def run_pipeline_async(from_: datetime, to: datetime, session: AsyncPipelineSession,
+                             concurrency: int = 32, header_only: bool = False,
+                             index: MetadataIndex | None = None, batch_size: int | None = None,
+                             merge: Callable[..., object] | None = None) -> None:
+    """
+    Asyncio version of `run_pipeline`. DICOM fetches and PDF downloads are each bounded by `concurrency`,
+    PDFs are stored and joined in the order of the DB query in worker threads.
+    The stored paths are passed to `merge` with the session configuration, `join_pdfs` by default.
+    """
+    download_limit = asyncio.Semaphore(concurrency)
+
+    async def download(pdf_file_name: str) -> bytes:
+        async with download_limit:
+            return await download_pdf_from_azure_async(pdf_file_name, session)
+
+    pdf_file_names = _iter_pdf_file_names(from_, to, session, concurrency, header_only, index, batch_size)
+    pdf_paths = []
+    async for pdf in _ordered_gather(download, pdf_file_names, concurrency):
+        pdf_paths.append(await asyncio.to_thread(store_pdf_on_disk, pdf, session.config))
+
+    await asyncio.to_thread(merge or join_pdfs, pdf_paths, session=session.config)
+
+
+async def _ordered_gather(func: Callable[[T], Awaitable[R]], items: AsyncIterator[T],
+                          concurrency: int) -> AsyncIterator[R]:
+    """
+    Run `func` on every item as a task and yield the results in input order.
+    At most `2 * concurrency` tasks are scheduled ahead of the consumer, so results are never buffered without bound.
+    """
+    pending = deque()
+    try:
+        async for item in items:
+            pending.append(asyncio.ensure_future(func(item)))
+            if len(pending) >= 2 * concurrency:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for task in pending:
+            task.cancel()
@@ -0,0 +1,78 @@
+import threading
+
+from time import perf_counter
+from typing import TYPE_CHECKING, Callable, NamedTuple
+
+from telemetry import RunMetrics
+
+if TYPE_CHECKING:
+    from azure.storage.blob import BlobServiceClient
+
+# blobs listed per request, the maximum the service returns in one page
+LIST_PAGE_SIZE = 5000
+
+
+class BlobInfo(NamedTuple):
+    """
+    Properties of a listed blob.
+    """
+    size: int
+    etag: str
+
+
+class BlobListing:
+    """
+    Index of the names, sizes and ETags of the blobs of a storage account, built by listing whole containers
+    with paged `list_blobs` calls instead of probing the blobs one by one. Every container is listed once,
+    on its first lookup, only the blobs under `prefixes[container]` if a prefix is given for it.
+    A blob missing from the listing is not in the storage (as of the listing).
+    """
+    def __init__(self, blob_service_client: Callable[[], "BlobServiceClient"], prefixes: dict[str, str] | None = None,
+                 page_size: int = LIST_PAGE_SIZE, metrics: RunMetrics | None = None):
+        self._blob_service_client = blob_service_client
+        self.prefixes = prefixes or {}
+        self.page_size = page_size
+        self.metrics = metrics
+        self._containers: dict[str, dict[str, BlobInfo]] = {}
+        self._locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, container: str, name: str) -> BlobInfo | None:
+        """
+        Return the properties of the blob, None if it is not in the storage.
+        """
+        return self.container(container).get(name)
+
+    def container(self, container: str) -> dict[str, BlobInfo]:
+        """
+        Return the listed blobs of the container by name, listing it on first use.
+        """
+        blobs = self._containers.get(container)
+        if blobs is not None:
+            return blobs
+
+        # list every container once, lookups of other containers are not blocked meanwhile
+        with self._lock:
+            lock = self._locks.setdefault(container, threading.Lock())
+        with lock:
+            if container not in self._containers:
+                self._containers[container] = self._list(container)
+        return self._containers[container]
+
+    def _list(self, container: str) -> dict[str, BlobInfo]:
+        container_client = self._blob_service_client().get_container_client(container)
+        pages = container_client.list_blobs(name_starts_with=self.prefixes.get(container),
+                                            results_per_page=self.page_size).by_page()
+        blobs = {}
+        while True:
+            start = perf_counter()
+            page = next(pages, None)
+            if page is None:
+                break
+            page = list(page)
+            if self.metrics is not None:
+                self.metrics.observe("blob_list", perf_counter() - start)
+            for blob in page:
+                blobs[blob.name] = BlobInfo(blob.size, blob.etag)
+        print(f"Listed {len(blobs)} blobs in {container}")
+        return blobs
@@ -0,0 +1,45 @@
+import threading
+
+from contextlib import contextmanager
+from typing import Iterator
+
+
+class ByteBudget:
+    """
+    A cap on the bytes of blobs held in memory at once, shared by all the download threads of a run.
+    A download reserves the size of its blob before the request is sent and waits while the reservation
+    would exceed the limit, so the memory held by downloads stays within `limit` regardless of the blob sizes.
+    A single blob larger than the limit is let through only once nothing else is reserved.
+    """
+    def __init__(self, limit: int):
+        if limit <= 0:
+            raise ValueError("Byte budget must be positive")
+        self.limit = limit
+        self.in_flight = 0
+        self.peak = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, nbytes: int) -> None:
+        """
+        Reserve `nbytes`, waiting until they fit into the budget.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_flight == 0 or self.in_flight + nbytes <= self.limit)
+            self.in_flight += nbytes
+            self.peak = max(self.peak, self.in_flight)
+
+    def release(self, nbytes: int) -> None:
+        with self._condition:
+            self.in_flight -= nbytes
+            self._condition.notify_all()
+
+    @contextmanager
+    def reserve(self, nbytes: int) -> Iterator[None]:
+        """
+        Context manager holding a reservation of `nbytes` for the duration of the block.
+        """
+        self.acquire(nbytes)
+        try:
+            yield
+        finally:
+            self.release(nbytes)
@@ -0,0 +1,139 @@
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import NamedTuple
+
+from sqlite_store import SqliteStore
+
+DEFAULT_MAX_ENTRIES = 200_000
+DEFAULT_MAX_AGE = timedelta(days=90)
+
+
+class DicomMetadata(NamedTuple):
+    """
+    Values parsed from a DICOM report that are needed to assemble the name of its PDF report.
+    Missing or invalid values are None, `readable` is False if the file could not be parsed at all.
+    """
+    readable: bool
+    created: datetime | None = None
+    study_instance_uid: str | None = None
+    series_instance_uid: str | None = None
+    referenced_sop_instance_uid: str | None = None
+
+    @property
+    def pdf_file_name(self) -> str | None:
+        """The PDF report name, None if any of the UIDs is missing."""
+        if not (self.study_instance_uid and self.series_instance_uid and self.referenced_sop_instance_uid):
+            return None
+        return f"{self.study_instance_uid}_{self.series_instance_uid}_{self.referenced_sop_instance_uid}.pdf"
+
+    @property
+    def skip_reason(self) -> str | None:
+        """The reason the report is skipped regardless of the requested time slot, None if it is not."""
+        if not self.readable:
+            return "Read failed"
+        if self.created is None:
+            return "Invalid creation datetime"
+        if not self.study_instance_uid:
+            return "Missing StudyInstanceUID"
+        if not self.series_instance_uid:
+            return "Missing SeriesInstanceUID"
+        if not self.referenced_sop_instance_uid:
+            return "Missing ReferencedSOPInstanceUID"
+        return None
+
+
+class MetadataIndex(SqliteStore):
+    """
+    Persistent SQLite index of metadata parsed from DICOM reports, keyed by container, blob name and ETag.
+    An entry is only returned while the blob ETag matches, a changed blob is parsed and stored again.
+    Entries not used for `max_age` are evicted, as are the least recently used ones above `max_entries`.
+    """
+    SCHEMA = '''CREATE TABLE IF NOT EXISTS dicom_metadata (
+            container TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            etag TEXT NOT NULL,
+            readable INTEGER NOT NULL,
+            created TEXT,
+            study_instance_uid TEXT,
+            series_instance_uid TEXT,
+            referenced_sop_instance_uid TEXT,
+            pdf_file_name TEXT,
+            skip_reason TEXT,
+            last_used REAL NOT NULL,
+            PRIMARY KEY (container, file_name)
+        );
+        CREATE INDEX IF NOT EXISTS dicom_metadata_last_used ON dicom_metadata (last_used)'''
+    PRAGMAS = ("synchronous=NORMAL",)
+
+    def __init__(self, path: str | Path, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 max_age: timedelta = DEFAULT_MAX_AGE):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.max_age = max_age
+        super().__init__(self.path)
+
+    def get(self, container: str, file_name: str, etag: str) -> DicomMetadata | None:
+        """
+        Return the metadata stored for the blob, None if it is unknown or the blob changed since.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                '''SELECT etag, readable, created, study_instance_uid, series_instance_uid,
+                       referenced_sop_instance_uid FROM dicom_metadata
+                   WHERE container = ? AND file_name = ?''',
+                (container, file_name),
+            ).fetchone()
+            if row is None or row[0] != etag:
+                return None
+            self._conn.execute(
+                "UPDATE dicom_metadata SET last_used = ? WHERE container = ? AND file_name = ?",
+                (datetime.now().timestamp(), container, file_name),
+            )
+            self._conn.commit()
+
+        _, readable, created, study, series, sop = row
+        return DicomMetadata(
+            readable=bool(readable),
+            created=datetime.fromisoformat(created) if created else None,
+            study_instance_uid=study,
+            series_instance_uid=series,
+            referenced_sop_instance_uid=sop,
+        )
+
+    def put(self, container: str, file_name: str, etag: str, metadata: DicomMetadata) -> None:
+        """
+        Store the metadata of the blob, replacing an entry stored for an older ETag.
+        """
+        with self._lock:
+            self._conn.execute(
+                '''INSERT OR REPLACE INTO dicom_metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (container, file_name, etag, int(metadata.readable),
+                 metadata.created.isoformat() if metadata.created else None,
+                 metadata.study_instance_uid, metadata.series_instance_uid, metadata.referenced_sop_instance_uid,
+                 metadata.pdf_file_name, metadata.skip_reason, datetime.now().timestamp()),
+            )
+            self._conn.commit()
+
+    def evict(self) -> int:
+        """
+        Remove entries not used for `max_age` and the least recently used ones above `max_entries`.
+        Returns the number of removed entries.
+        """
+        oldest = (datetime.now() - self.max_age).timestamp()
+        with self._lock:
+            removed = self._conn.execute("DELETE FROM dicom_metadata WHERE last_used < ?", (oldest,)).rowcount
+            removed += self._conn.execute(
+                '''DELETE FROM dicom_metadata WHERE rowid IN (
+                       SELECT rowid FROM dicom_metadata ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                   )''',
+                (self.max_entries,),
+            ).rowcount
+            self._conn.commit()
+        return removed
+
+    def close(self) -> None:
+        """
+        Apply the eviction policy and close the index.
+        """
+        self.evict()
+        super().close()
@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlite_store import SqliteStore
+
+DEFAULT_TTL = timedelta(hours=6)
+DEFAULT_MAX_TTL = timedelta(days=7)
+
+
+class MissingBlobCache(SqliteStore):
+    """
+    Persistent SQLite cache of blobs known to be missing from the storage, keyed by container and blob name.
+    A blob found missing is skipped for `ttl` and then probed again, every further miss in a row doubles the
+    time until the next probe up to `max_ttl`. A blob that turns up is dropped from the cache once it is downloaded.
+    Entries are kept in memory as well, so checking a blob never touches the database.
+    """
+    SCHEMA = '''CREATE TABLE IF NOT EXISTS missing_blobs (
+            container TEXT NOT NULL,
+            blob TEXT NOT NULL,
+            misses INTEGER NOT NULL,
+            first_missed REAL NOT NULL,
+            last_probed REAL NOT NULL,
+            reprobe_at REAL NOT NULL,
+            PRIMARY KEY (container, blob)
+        )'''
+
+    def __init__(self, path: str | Path, ttl: timedelta = DEFAULT_TTL, max_ttl: timedelta = DEFAULT_MAX_TTL):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_ttl = max_ttl
+        super().__init__(self.path)
+        rows = self._conn.execute("SELECT container, blob, reprobe_at FROM missing_blobs")
+        self._reprobe_at = {(container, blob): reprobe_at for container, blob, reprobe_at in rows}
+
+    def is_missing(self, container: str, blob: str) -> bool:
+        """
+        Return True if the blob is known to be missing and is not due to be probed again yet.
+        """
+        reprobe_at = self._reprobe_at.get((container, blob))
+        return reprobe_at is not None and datetime.now().timestamp() < reprobe_at
+
+    def add(self, container: str, blob: str) -> None:
+        """
+        Record a failed probe of the blob, postponing the next one.
+        """
+        now = datetime.now().timestamp()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT misses, first_missed FROM missing_blobs WHERE container = ? AND blob = ?", (container, blob),
+            ).fetchone()
+            misses, first_missed = (row[0] + 1, row[1]) if row is not None else (1, now)
+            reprobe_at = now + min(self.ttl * 2 ** (misses - 1), self.max_ttl).total_seconds()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO missing_blobs VALUES (?, ?, ?, ?, ?, ?)",
+                (container, blob, misses, first_missed, now, reprobe_at),
+            )
+            self._conn.commit()
+            self._reprobe_at[container, blob] = reprobe_at
+
+    def discard(self, container: str, blob: str) -> None:
+        """
+        Forget the blob after it was found in the storage, a no-op for blobs not in the cache.
+        """
+        if (container, blob) not in self._reprobe_at:
+            return
+        with self._lock:
+            self._conn.execute("DELETE FROM missing_blobs WHERE container = ? AND blob = ?", (container, blob))
+            self._conn.commit()
+            self._reprobe_at.pop((container, blob), None)
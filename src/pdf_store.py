@@ -0,0 +1,92 @@
+import hashlib
+import os
+import tempfile
+
+from datetime import datetime
+from pathlib import Path
+
+from sqlite_store import SqliteStore
+
+
+class ContentStore(SqliteStore):
+    """
+    Content-addressed store of PDF reports with a manifest mapping PDF names to their hash and path.
+    Every distinct content is written exactly once as `objects/<hash[:2]>/<hash>.pdf`, files are written to
+    a temporary file and renamed into place, and the manifest is a SQLite database, so several threads or
+    processes can store into the same directory at once.
+    """
+    SCHEMA = '''CREATE TABLE IF NOT EXISTS pdfs (
+            name TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            stored_at REAL NOT NULL
+        )'''
+    # several processes may store into the same directory
+    TIMEOUT = 30.0
+
+    def __init__(self, root: str | Path):
+        self.root = Path(root)
+        self.objects_dir = self.root / "objects"
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        super().__init__(self.root / "manifest.sqlite")
+
+    def lookup(self, name: str) -> str | None:
+        """
+        Return the path of the PDF report stored under `name`, None if it is not stored.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT path FROM pdfs WHERE name = ?", (name,)).fetchone()
+        if row is None or not Path(row[0]).exists():
+            return None
+        return row[0]
+
+    def store(self, name: str, pdf: bytes) -> str:
+        """
+        Store the PDF report under `name` and return its path.
+        Content that is already stored (under any name) is not written again.
+        """
+        sha256 = hashlib.sha256(pdf).hexdigest()
+        path = self._object_path(sha256)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as tmp_file:
+                    tmp_file.write(pdf)
+                os.replace(tmp_path, path)
+            except BaseException:
+                Path(tmp_path).unlink(missing_ok=True)
+                raise
+        return self._record(name, sha256, path, len(pdf))
+
+    def store_file(self, name: str, file_path: str | Path) -> str:
+        """
+        Store the PDF report written to `file_path` (on the file system of the store) under `name` and return
+        its path. The file is moved into the store, or removed if its content is already stored.
+        """
+        sha256 = hashlib.sha256()
+        with open(file_path, "rb") as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                sha256.update(chunk)
+        sha256 = sha256.hexdigest()
+        size = os.path.getsize(file_path)
+        path = self._object_path(sha256)
+        if path.exists():
+            Path(file_path).unlink()
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(file_path, path)
+        return self._record(name, sha256, path, size)
+
+    def _object_path(self, sha256: str) -> Path:
+        return self.objects_dir / sha256[:2] / f"{sha256}.pdf"
+
+    def _record(self, name: str, sha256: str, path: Path, size: int) -> str:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pdfs VALUES (?, ?, ?, ?, ?)",
+                (name, sha256, str(path), size, datetime.now().timestamp()),
+            )
+            self._conn.commit()
+        return str(path)
@@ -0,0 +1,76 @@
+import json
+import os
+import tempfile
+
+from pathlib import Path
+from typing import Iterable, Iterator
+
+# intermediate state of the pipeline stages, one item per line, see the `resolve`, `fetch` and `merge` commands
+DEFAULT_STATE_DIR = "pipeline_state"
+NAMES_FILE = "names.txt"
+PDFS_FILE = "pdfs.txt"
+WATCH_FILE = "watch.json"
+
+
+def write_lines(path: str | Path, lines: Iterable[str]) -> int:
+    """
+    Write `lines` into the file, one per line, replacing it atomically once all of them are written.
+    A stage interrupted half-way never leaves a partial file for the next stage. Returns the number of lines.
+    """
+    count = 0
+
+    def chunks() -> Iterator[str]:
+        nonlocal count
+        for line in lines:
+            yield line + "\n"
+            count += 1
+
+    write_atomically(path, chunks())
+    return count
+
+
+def read_lines(path: str | Path) -> list[str]:
+    """
+    Read the lines written by `write_lines`, a missing file means the previous stage has not run yet.
+    """
+    path = Path(path)
+    if not path.exists():
+        raise FileNotFoundError(f"{path} not found, run the previous stage first")
+    return [line for line in path.read_text().splitlines() if line]
+
+
+def write_json(path: str | Path, value: object) -> None:
+    """
+    Write `value` as JSON, replacing the file atomically.
+    """
+    write_atomically(path, [json.dumps(value, indent=2)])
+
+
+def read_json(path: str | Path, default: object = None) -> object:
+    """
+    Read the JSON written by `write_json`, `default` if the file does not exist yet.
+    """
+    path = Path(path)
+    if not path.exists():
+        return default
+    return json.loads(path.read_text())
+
+
+def write_atomically(path: str | Path, chunks: Iterable[str]) -> None:
+    """
+    Write the text `chunks` into a temporary file next to `path` and rename it into place,
+    readers never see a partial file.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as tmp_file:
+            for chunk in chunks:
+                tmp_file.write(chunk)
+        # readable by other users (e.g. the metrics collector), mkstemp creates the file private to the user
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
@@ -0,0 +1,91 @@
+import os
+
+from datetime import datetime
+from pathlib import Path
+
+from sqlite_store import SqliteStore
+
+
+class RunJournal(SqliteStore):
+    """
+    Persistent SQLite journal of a run, so an interrupted run can be resumed without redoing finished work.
+    It records the time window of the run, the PDF report name resolved for every DICOM report (None if the
+    report was skipped) and the path every PDF report was stored under, each as soon as it is finished.
+    Without `resume` the journal of a previous run is cleared, with `resume` it is continued.
+    Entries are kept in memory as well, so lookups never touch the database.
+    """
+    SCHEMA = '''CREATE TABLE IF NOT EXISTS run (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS resolved (
+            container TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            pdf_file_name TEXT,
+            PRIMARY KEY (container, file_name)
+        );
+        CREATE TABLE IF NOT EXISTS stored (
+            pdf_file_name TEXT PRIMARY KEY,
+            path TEXT NOT NULL
+        )'''
+
+    def __init__(self, path: str | Path, resume: bool = False):
+        self.path = Path(path)
+        super().__init__(self.path)
+        if not resume:
+            self._conn.executescript("DELETE FROM run; DELETE FROM resolved; DELETE FROM stored;")
+        self._conn.commit()
+
+        self.resolved: dict[tuple[str, str], str | None] = {
+            (container, file_name): pdf_file_name
+            for container, file_name, pdf_file_name in self._conn.execute("SELECT * FROM resolved")
+        }
+        self._stored = dict(self._conn.execute("SELECT pdf_file_name, path FROM stored"))
+        self._run = dict(self._conn.execute("SELECT key, value FROM run"))
+
+    @property
+    def window(self) -> tuple[datetime, datetime] | None:
+        """
+        The `from_` and `to` of the journaled run, None if no run was started yet.
+        """
+        if "from" not in self._run:
+            return None
+        return datetime.fromisoformat(self._run["from"]), datetime.fromisoformat(self._run["to"])
+
+    def start(self, from_: datetime, to: datetime) -> None:
+        """
+        Record the window of the run, a resumed run keeps the window it was started with.
+        """
+        self._set({"from": from_.isoformat(), "to": to.isoformat()})
+
+    def record_resolved(self, container: str, file_name: str, pdf_file_name: str | None) -> None:
+        """
+        Record the PDF report name of a DICOM report, None if it does not give one.
+        """
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO resolved VALUES (?, ?, ?)",
+                               (container, file_name, pdf_file_name))
+            self._conn.commit()
+            self.resolved[container, file_name] = pdf_file_name
+
+    def stored_path(self, pdf_file_name: str) -> str | None:
+        """
+        Return the path the PDF report was stored under, None if it was not stored yet or the file is gone.
+        """
+        path = self._stored.get(pdf_file_name)
+        return path if path is not None and os.path.exists(path) else None
+
+    def record_stored(self, pdf_file_name: str, path: str) -> None:
+        """
+        Record the path a PDF report was stored under.
+        """
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO stored VALUES (?, ?)", (pdf_file_name, path))
+            self._conn.commit()
+            self._stored[pdf_file_name] = path
+
+    def _set(self, values: dict[str, str]) -> None:
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO run VALUES (?, ?)", values.items())
+            self._conn.commit()
+            self._run.update(values)
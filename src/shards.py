@@ -0,0 +1,75 @@
+import heapq
+
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple
+
+from pipeline_state import read_lines, write_lines
+
+SHARDS_DIR = "shards"
+
+
+class Shard(NamedTuple):
+    """
+    A sub-window of the run, the DICOM reports created after `from_` and up to `to`.
+    """
+    from_: datetime
+    to: datetime
+
+    @property
+    def name(self) -> str:
+        return f"{self.from_:%Y%m%dT%H%M%S}_{self.to:%Y%m%dT%H%M%S}"
+
+
+class ShardReport(NamedTuple):
+    """
+    A report fetched by a shard: its `dicom_report.id`, PDF report name and stored path.
+    """
+    id: int
+    pdf_file_name: str
+    path: str
+
+
+def plan_shards(from_: datetime, to: datetime, size: timedelta) -> list[Shard]:
+    """
+    Split the window into consecutive shards of `size`, the last one is shorter if `size` does not divide it.
+    The same window and size give the same shards on every host.
+    """
+    if size <= timedelta(0):
+        raise ValueError("Shard size must be positive")
+    shards = []
+    start = from_
+    while start < to:
+        shards.append(Shard(start, min(start + size, to)))
+        start += size
+    return shards
+
+
+def shard_path(state_dir: str | Path, shard: Shard) -> Path:
+    """
+    Path of the output of the shard, it exists only once the shard is finished.
+    """
+    return Path(state_dir) / SHARDS_DIR / f"{shard.name}.tsv"
+
+
+def write_shard(path: str | Path, reports: Iterable[ShardReport]) -> int:
+    """
+    Write the reports of a finished shard, in the order of the DB query (`dicom_report.id` descending).
+    """
+    return write_lines(path, (f"{report.id}\t{report.pdf_file_name}\t{report.path}" for report in reports))
+
+
+def read_shard(path: str | Path) -> list[ShardReport]:
+    reports = []
+    for line in read_lines(path):
+        report_id, pdf_file_name, report_path = line.split("\t")
+        reports.append(ShardReport(int(report_id), pdf_file_name, report_path))
+    return reports
+
+
+def merge_shards(paths: Iterable[str | Path]) -> Iterator[ShardReport]:
+    """
+    Merge the outputs of the shards into the order of an unsharded run, `dicom_report.id` descending.
+    Every shard is already in that order, so they are merged without sorting them again.
+    """
+    return heapq.merge(*(read_shard(path) for path in paths), key=lambda report: -report.id)
@@ -0,0 +1,36 @@
+import sqlite3
+import threading
+
+from pathlib import Path
+
+
+class SqliteStore:
+    """
+    Base of the persistent SQLite stores shared by the pipeline threads: one connection in WAL mode whose access
+    is serialized by `_lock`, with `SCHEMA` (one or more statements) created when the store is opened.
+    """
+    SCHEMA = ""
+    PRAGMAS: tuple[str, ...] = ()
+    # seconds to wait for a lock held by another process
+    TIMEOUT = 5.0
+
+    def __init__(self, path: str | Path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=self.TIMEOUT, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        for pragma in self.PRAGMAS:
+            self._conn.execute(f"PRAGMA {pragma}")
+        self._conn.executescript(self.SCHEMA)
+        self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
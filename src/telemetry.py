@@ -0,0 +1,250 @@
+import json
+import logging
+import math
+import re
+import threading
+
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+from typing import Iterator
+
+from pipeline_state import write_atomically
+
+logger = logging.getLogger("aggregate_pdf_reports")
+
+# upper bounds of the latency histogram buckets in seconds, as the Prometheus client defaults
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, math.inf)
+
+# attributes every `logging.LogRecord` has, anything else was passed as `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class StageMetrics:
+    """
+    Counts, bytes, errors and the latency histogram of one pipeline stage.
+    """
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def observe(self, seconds: float, nbytes: int = 0, error: bool = False) -> None:
+        self.count += 1
+        self.errors += error
+        self.bytes += nbytes
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+    def quantile(self, fraction: float) -> float | None:
+        """
+        Estimate the quantile as the upper bound of the bucket it falls into, None without observations.
+        """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max_seconds)
+        return self.max_seconds
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "bytes": self.bytes,
+            "seconds": round(self.seconds, 6),
+            "p50_seconds": self.quantile(0.5),
+            "p99_seconds": self.quantile(0.99),
+            "max_seconds": round(self.max_seconds, 6),
+            "buckets": {_bucket_label(bound): count for bound, count in zip(LATENCY_BUCKETS, self.buckets)},
+        }
+
+
+class Span:
+    """
+    A single timed run of a stage, set `bytes` to the amount of data it transferred.
+    """
+    def __init__(self):
+        self.bytes = 0
+        self.error = False
+
+
+class RunMetrics:
+    """
+    Telemetry of a single run: per-stage metrics, skip reasons and free-form counters.
+    Every observation is also logged as a structured DEBUG record, `log_summary` logs the totals.
+    Safe to use from the pipeline threads. With `record`, every observation is also kept in `observations`,
+    so a worker process can hand them over to the metrics of the parent (see `merge`).
+    """
+    def __init__(self, record: bool = False):
+        self.started = datetime.now()
+        self.stages: dict[str, StageMetrics] = {}
+        self.skips = Counter()
+        self.counters = Counter()
+        self.observations: list[tuple[str, float, int, bool]] | None = [] if record else None
+        self._start = perf_counter()
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float, nbytes: int = 0, error: bool = False) -> None:
+        """
+        Record one run of `stage` that took `seconds` and transferred `nbytes`.
+        """
+        with self._lock:
+            self.stages.setdefault(stage, StageMetrics()).observe(seconds, nbytes, error)
+            if self.observations is not None:
+                self.observations.append((stage, seconds, nbytes, error))
+        logger.debug("stage %s took %.3f s", stage, seconds,
+                     extra={"stage": stage, "seconds": round(seconds, 6), "bytes": nbytes, "error": error})
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[Span]:
+        """
+        Time the block as one run of `stage`, an exception raised from the block is counted as an error.
+        """
+        span = Span()
+        start = perf_counter()
+        try:
+            yield span
+        except BaseException:
+            span.error = True
+            raise
+        finally:
+            self.observe(stage, perf_counter() - start, span.bytes, span.error)
+
+    def skip(self, reason: str, file_name: str | None = None) -> None:
+        """
+        Count a report skipped for `reason`, a status message such as " Missing StudyInstanceUID".
+        """
+        reason = skip_label(reason)
+        with self._lock:
+            self.skips[reason] += 1
+        logger.debug("skipped %s: %s", file_name, reason, extra={"skip_reason": reason, "file_name": file_name})
+
+    def increment(self, counter: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[counter] += value
+
+    def merge(self, observations: list[tuple[str, float, int, bool]], counters: dict[str, int]) -> None:
+        """
+        Add the stage observations and counters recorded by the metrics of another process.
+        """
+        for observation in observations:
+            self.observe(*observation)
+        for counter, value in counters.items():
+            self.increment(counter, value)
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "started": self.started.isoformat(),
+                "duration_seconds": round(perf_counter() - self._start, 6),
+                "stages": {stage: metrics.as_dict() for stage, metrics in self.stages.items()},
+                "skipped": dict(self.skips),
+                "counters": dict(self.counters),
+            }
+
+    def log_summary(self) -> dict:
+        """
+        Log the end-of-run summary as a single INFO record and return it.
+        """
+        summary = self.summary()
+        stages = ", ".join(f"{stage} {metrics['count']}x {metrics['seconds']:.2f} s"
+                           for stage, metrics in summary["stages"].items())
+        logger.info("run finished in %.2f s (%s), skipped %d", summary["duration_seconds"], stages,
+                    sum(summary["skipped"].values()), extra={"summary": summary})
+        return summary
+
+    def write_json(self, path: str | Path) -> None:
+        """
+        Write the summary as JSON, replacing the file atomically.
+        """
+        write_atomically(path, [json.dumps(self.summary(), indent=2)])
+
+    def write_prometheus(self, path: str | Path, prefix: str = "pdf_reports") -> None:
+        """
+        Write the metrics in the Prometheus text format, for the node exporter textfile collector.
+        The file is replaced atomically, so the collector never reads a partial file.
+        """
+        summary = self.summary()
+        lines = [
+            f"# HELP {prefix}_stage_seconds Latency of the pipeline stages.",
+            f"# TYPE {prefix}_stage_seconds histogram",
+        ]
+        for stage, metrics in summary["stages"].items():
+            cumulative = 0
+            for bucket, count in metrics["buckets"].items():
+                cumulative += count
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{bucket}"}} {cumulative}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {metrics["seconds"]}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {metrics["count"]}')
+        for name, key, help_text in (("stage_bytes_total", "bytes", "Bytes transferred by the pipeline stages."),
+                                     ("stage_errors_total", "errors", "Failed runs of the pipeline stages.")):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} counter")
+            for stage, metrics in summary["stages"].items():
+                lines.append(f'{prefix}_{name}{{stage="{stage}"}} {metrics[key]}')
+        lines.append(f"# HELP {prefix}_skipped_total Reports skipped, by reason.")
+        lines.append(f"# TYPE {prefix}_skipped_total counter")
+        for reason, count in summary["skipped"].items():
+            lines.append(f'{prefix}_skipped_total{{reason="{reason}"}} {count}')
+        for counter, value in summary["counters"].items():
+            lines.append(f"# TYPE {prefix}_{counter}_total counter")
+            lines.append(f"{prefix}_{counter}_total {value}")
+        lines.append(f"# HELP {prefix}_run_duration_seconds Duration of the last run.")
+        lines.append(f"# TYPE {prefix}_run_duration_seconds gauge")
+        lines.append(f"{prefix}_run_duration_seconds {summary['duration_seconds']}")
+        lines.append(f"# HELP {prefix}_run_timestamp_seconds Start of the last run.")
+        lines.append(f"# TYPE {prefix}_run_timestamp_seconds gauge")
+        lines.append(f"{prefix}_run_timestamp_seconds {self.started.timestamp()}")
+        write_atomically(path, [line + "\n" for line in lines])
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format log records as JSON lines, fields passed as `extra` included.
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES})
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level: str = "INFO", json_format: bool = False) -> None:
+    """
+    Send the pipeline logs to stderr, as JSON lines if `json_format`.
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if json_format else logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+
+
+def skip_label(reason: str) -> str:
+    """
+    Turn a skip status message into a label, " Date 2025-01-01 00:00:00 not in the range" into "not_in_range".
+    """
+    reason = reason.strip()
+    if reason.startswith("Date "):
+        return "not_in_range"
+    return re.sub(r"\W+", "_", reason).strip("_").lower()
+
+
+def _bucket_label(bound: float) -> str:
+    return "+Inf" if bound == math.inf else repr(bound)
@@ -0,0 +1,174 @@
+import re
+import sqlite3
+from contextlib import contextmanager
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import aet_analytics
+
+SOURCE_SCHEMA = """
+CREATE TABLE aet (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE study (id INTEGER PRIMARY KEY, calling_aet_id INTEGER);
+CREATE TABLE series (id INTEGER PRIMARY KEY, study_id INTEGER);
+CREATE TABLE dicom_stow_rs (id INTEGER PRIMARY KEY, series_id INTEGER, created_at TIMESTAMP);
+CREATE TABLE prediction (id INTEGER PRIMARY KEY, dicom_stow_rs_id INTEGER, prediction_string TEXT);
+INSERT INTO aet VALUES (1, 'CT1'), (2, 'MR1');
+INSERT INTO study VALUES (1, 1), (2, 2);
+INSERT INTO series VALUES (1, 1), (2, 2);
+"""
+
+# the few Postgres constructs of the rollup queries, rewritten for SQLite
+POSTGRES_TO_SQLITE = [
+    (" FOR UPDATE", ""),
+    ("LEAST(", "MIN("),
+    ("TO_CHAR(dicom_stow_rs.created_at, 'YYYY-MM')", "strftime('%Y-%m', dicom_stow_rs.created_at)"),
+    ("now()", "CURRENT_TIMESTAMP"),
+]
+
+
+class RollupDatabase:
+    # Helper running the rollup queries on an in-memory SQLite database in place of a psycopg connection
+    def __init__(self):
+        self.db = sqlite3.connect(":memory:", isolation_level=None)
+        self.db.executescript(SOURCE_SCHEMA)
+        self.db.executescript(self.translate(Path("sql/aet_rollups.sql").read_text()))
+
+    @staticmethod
+    def translate(query: str) -> str:
+        for postgres, sqlite in POSTGRES_TO_SQLITE:
+            query = query.replace(postgres, sqlite)
+        return re.sub(r"%\((\w+)\)s", r":\1", query)
+
+    def execute(self, query: str, params: dict | None = None) -> sqlite3.Cursor:
+        if query.startswith("SET TRANSACTION"):
+            return self.db.cursor()
+        if query.startswith("TRUNCATE "):
+            for table in query.removeprefix("TRUNCATE ").split(", "):
+                self.db.execute(f"DELETE FROM {table}")
+            return self.db.cursor()
+        return self.db.execute(self.translate(query), params or {})
+
+    @contextmanager
+    def cursor(self):
+        yield RollupCursor(self)
+
+    @contextmanager
+    def transaction(self):
+        self.db.execute("SAVEPOINT rollups")
+        try:
+            yield
+        except BaseException:
+            self.db.execute("ROLLBACK TO rollups")
+            raise
+        finally:
+            self.db.execute("RELEASE rollups")
+
+    def add_scan(self, scan_id: int, aet_id: int, created_at: str, severity: str | None = None) -> None:
+        self.db.execute("INSERT INTO dicom_stow_rs VALUES (?, ?, ?)", (scan_id, aet_id, created_at))
+        if severity:
+            self.db.execute("INSERT INTO prediction VALUES (?, ?, ?)", (scan_id, scan_id, severity))
+
+
+class RollupCursor:
+    def __init__(self, conn: RollupDatabase):
+        self.conn = conn
+        self.result = None
+
+    def execute(self, query: str, params: dict | None = None) -> None:
+        self.result = self.conn.execute(query, params)
+
+    def fetchone(self):
+        return self.result.fetchone()
+
+    def fetchall(self):
+        return self.result.fetchall()
+
+    @property
+    def rowcount(self) -> int:
+        return self.result.rowcount
+
+
+def make_connection(fetchall=()):
+    # Helper building a psycopg connection mock whose cursor returns the given rows in order
+    conn = MagicMock()
+    cursor = conn.cursor.return_value.__enter__.return_value
+    cursor.fetchall.side_effect = list(fetchall)
+    return conn, cursor
+
+def test_refresh_folds_only_rows_after_watermark():
+    conn = RollupDatabase()
+    conn.add_scan(1, 1, "2024-01-05 10:00:00", "high")
+    conn.add_scan(2, 2, "2024-02-01 08:00:00")
+    assert aet_analytics.refresh_rollups(conn) == {"dicom_stow_rs": 2, "prediction": 1}
+
+    conn.add_scan(3, 1, "2024-01-02 09:00:00", "high")
+    assert aet_analytics.refresh_rollups(conn) == {"dicom_stow_rs": 1, "prediction": 1}
+    assert aet_analytics.refresh_rollups(conn) == {}
+
+    assert aet_analytics.report(conn, "first-scan") == [("CT1", "2024-01-02"), ("MR1", "2024-02-01")]
+    assert aet_analytics.report(conn, "severity") == [("CT1", "high", 2)]
+    assert aet_analytics.report(conn, "monthly") == [("CT1", "2024-01", 2, 2), ("MR1", "2024-02", 1, 1)]
+    assert aet_analytics.verify_rollups(conn) == []
+
+def test_refresh_folds_rows_committed_after_higher_ids():
+    # id 10 belongs to a transaction still in progress while id 11 commits and is folded
+    conn = RollupDatabase()
+    conn.add_scan(11, 1, "2024-01-05 10:00:00", "low")
+    assert aet_analytics.refresh_rollups(conn) == {"dicom_stow_rs": 1, "prediction": 1}
+
+    conn.add_scan(10, 2, "2024-01-03 10:00:00", "high")
+    assert aet_analytics.refresh_rollups(conn) == {"dicom_stow_rs": 1, "prediction": 1}
+    assert aet_analytics.refresh_rollups(conn) == {}
+
+    assert aet_analytics.report(conn, "severity") == [("CT1", "low", 1), ("MR1", "high", 1)]
+    assert aet_analytics.report(conn, "monthly") == [("CT1", "2024-01", 1, 1), ("MR1", "2024-01", 1, 1)]
+    assert aet_analytics.verify_rollups(conn) == []
+
+def test_refresh_prunes_folded_ids_below_late_commit_band():
+    conn = RollupDatabase()
+    conn.add_scan(1, 1, "2024-01-05 10:00:00")
+    conn.add_scan(aet_analytics.LATE_COMMIT_IDS + 2, 1, "2024-01-06 10:00:00")
+    aet_analytics.refresh_rollups(conn)
+
+    folded = conn.db.execute("SELECT source, id FROM aet_rollup_folded").fetchall()
+    assert folded == [("dicom_stow_rs", aet_analytics.LATE_COMMIT_IDS + 2)]
+    assert aet_analytics.report(conn, "monthly") == [("CT1", "2024-01", 2, 2)]
+    assert aet_analytics.verify_rollups(conn) == []
+
+def test_verify_leaves_out_rows_not_folded_yet():
+    conn = RollupDatabase()
+    conn.add_scan(11, 1, "2024-01-05 10:00:00")
+    aet_analytics.refresh_rollups(conn)
+    conn.add_scan(10, 2, "2024-01-03 10:00:00")
+    conn.add_scan(12, 2, "2024-01-04 10:00:00")
+
+    assert aet_analytics.verify_rollups(conn) == []
+
+def test_rebuild_recomputes_rollups():
+    conn = RollupDatabase()
+    conn.add_scan(1, 1, "2024-01-05 10:00:00", "high")
+    aet_analytics.refresh_rollups(conn)
+    conn.db.execute("UPDATE aet_severity_counts SET count = 5")
+    assert aet_analytics.verify_rollups(conn) == ["severity"]
+
+    assert aet_analytics.rebuild_rollups(conn) == {"dicom_stow_rs": 1, "prediction": 1}
+    assert aet_analytics.report(conn, "severity") == [("CT1", "high", 1)]
+    assert aet_analytics.verify_rollups(conn) == []
+
+def test_report_reads_rollup_table():
+    conn, cursor = make_connection(fetchall=[[("CT1", "2024-01", 3, 3)]])
+
+    assert aet_analytics.report(conn, "monthly") == [("CT1", "2024-01", 3, 3)]
+    query = cursor.execute.call_args.args[0]
+    assert "FROM aet_monthly_counts" in query and "dicom_stow_rs" not in query
+
+def test_verify_reports_mismatched_rollups():
+    # direct query, then rollup, for first-scan, severity and monthly
+    conn, _ = make_connection(fetchall=[
+        [("dicom_stow_rs", 9), ("prediction", 4)],
+        [("CT1", "2024-01-02")], [("CT1", "2024-01-02")],
+        [("CT1", "high", 2)], [("CT1", "high", 1)],
+        [], [],
+    ])
+
+    assert aet_analytics.verify_rollups(conn) == ["severity"]
@@ -0,0 +1,84 @@
+import asyncio
+from datetime import datetime
+from unittest.mock import patch, MagicMock, AsyncMock
+import aggregate_pdf_reports_async
+from aggregate_pdf_reports_async import AsyncPipelineSession, download_pdf_from_azure_async, get_pdf_file_names_async
+
+class AttrDict:
+    def __init__(self, d):
+        self.__dict__.update(d)
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+class FakeDicom:
+    def __init__(self, attrs):
+        self.attrs = attrs
+    def get(self, key, default=None):
+        return self.attrs.get(key, default)
+
+def fake_async_blob_client(content=None, error=None):
+    # Helper returning an async blob client whose download yields `content` or raises `error`
+    downloader = MagicMock()
+    downloader.readall = AsyncMock(return_value=content)
+    blob_client = MagicMock()
+    blob_client.download_blob = AsyncMock(return_value=downloader, side_effect=error)
+    return blob_client
+
+@patch("aggregate_pdf_reports.load_dotenv")
+@patch("aggregate_pdf_reports_async.psycopg.AsyncConnection.connect", new_callable=AsyncMock)
+@patch("aggregate_pdf_reports_async.BlobServiceClient")
+@patch("aggregate_pdf_reports_async.pydicom.dcmread")
+def test_get_pdf_file_names_async(mock_dcmread, mock_blob_service_client, mock_connect, mock_load_dotenv):
+    fake_db_rows = [(f"file{i}.dcm", "dicoms") for i in range(10)]
+    mock_cursor = MagicMock()
+    mock_cursor.execute = AsyncMock()
+    mock_cursor.fetchall = AsyncMock(return_value=fake_db_rows)
+    mock_conn = MagicMock()
+    mock_conn.cursor.return_value.__aenter__.return_value = mock_cursor
+    mock_connect.return_value.__aenter__.return_value = mock_conn
+
+    def fake_get_blob_client(container, file_name):
+        if file_name == "file3.dcm":
+            return fake_async_blob_client(error=Exception("Blob not found"))
+        return fake_async_blob_client(file_name.encode())
+    mock_blob_service_client.from_connection_string.return_value.get_blob_client.side_effect = fake_get_blob_client
+    mock_blob_service_client.from_connection_string.return_value.close = AsyncMock()
+
+    def fake_dcmread(fileobj):
+        return FakeDicom({
+            "InstanceCreationDate": "20250115",
+            "InstanceCreationTime": "120000",
+            "StudyInstanceUID": fileobj.read().decode(),
+            "ReferencedSeriesSequence": [AttrDict({"SeriesInstanceUID": "4.5.6"})],
+            "ReferencedPerformedProcedureStepSequence": [AttrDict({"ReferencedSOPInstanceUID": "7.8.9"})]
+        })
+    mock_dcmread.side_effect = fake_dcmread
+
+    async def run():
+        async with AsyncPipelineSession() as session:
+            return await get_pdf_file_names_async(datetime(2025, 1, 14), datetime(2025, 1, 16), session, concurrency=3)
+
+    result = asyncio.run(run())
+
+    assert result == [f"file{i}.dcm_4.5.6_7.8.9.pdf" for i in range(10) if i != 3]
+    mock_connect.assert_awaited_once()
+    mock_blob_service_client.from_connection_string.return_value.close.assert_awaited_once()
+
+@patch("aggregate_pdf_reports.load_dotenv")
+@patch("aggregate_pdf_reports_async.BlobServiceClient")
+def test_download_pdf_from_azure_async(mock_blob_service_client, mock_load_dotenv):
+    mock_blob_service_client.from_connection_string.return_value.close = AsyncMock()
+    get_blob_client = mock_blob_service_client.from_connection_string.return_value.get_blob_client
+
+    async def run():
+        async with AsyncPipelineSession() as session:
+            get_blob_client.return_value = fake_async_blob_client(b"%PDF-1.4")
+            found = await download_pdf_from_azure_async("test.pdf", session)
+            get_blob_client.return_value = fake_async_blob_client(error=Exception("Blob not found"))
+            missing = await download_pdf_from_azure_async("test.pdf", session)
+            return found, missing
+
+    assert asyncio.run(run()) == (b"%PDF-1.4", "download_failed")
+    get_blob_client.assert_called_with(container="pdf-reports", blob="/tmp/test.pdf")
+    mock_blob_service_client.from_connection_string.assert_called_once()
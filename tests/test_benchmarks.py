@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta
+from azure.core.exceptions import ResourceNotFoundError
+import pytest
+import aggregate_pdf_reports
+from local_services import LocalBlobService, LocalPostgres
+from synthetic import generate_reports
+import run_benchmarks
+
+def test_local_services_serve_synthetic_reports():
+    # Test case: The stand-ins answer the pipeline query and serve DICOM files whose metadata names the PDF
+    reports = generate_reports(5, datetime(2025, 1, 15), timedelta(days=14), pixel_bytes=4096)
+    database = LocalPostgres()
+    database.add_reports(reports)
+    blob_service = LocalBlobService()
+    blob_service.add_reports(reports, pixel_bytes=4096)
+
+    with database.cursor() as cur:
+        cur.execute(aggregate_pdf_reports.DICOM_REPORTS_QUERY, {"from": datetime(2025, 1, 1), "to": datetime(2025, 1, 15)})
+        rows = cur.fetchall()
+    assert rows == [(report.file_name, report.container) for report in reversed(reports)]
+
+    content = blob_service.get_blob_client(reports[0].container, reports[0].file_name).download_blob().readall()
+    assert len(content) == len(reports[0].dicom_header) + 4096
+    metadata = aggregate_pdf_reports._parse_dicom_content(content, header_only=False, whole_blob=True)
+    assert metadata.pdf_file_name == reports[0].pdf_file_name
+
+def test_local_blob_service_miss_rate():
+    # Test case: Missing blobs raise the same error as Azure, consistently on every request
+    blob_service = LocalBlobService(miss_rate=1.0)
+    blob_service.add("dicoms", "file1.dcm", b"content")
+    with pytest.raises(ResourceNotFoundError):
+        blob_service.get_blob_client("dicoms", "file1.dcm").download_blob()
+    assert blob_service.requests == 1
+
+def test_run_scenario_small():
+    # Test case: A small scenario runs the whole pipeline against the stand-ins and reports every stage
+    args = run_benchmarks.parse_args(["--reports", "10", "--latency", "0", "--db-latency", "0", "--miss-rate", "0",
+                                      "--pixel-bytes", "1024", "--workers", "2"])
+    result = run_benchmarks.run_scenario(10, args)
+
+    assert result["reports"] == 10
+    assert result["stages"]["resolve"]["count"] == 10
+    assert result["stages"]["download"]["count"] == 10
+    assert result["stages"]["merge"]["count"] == 1
+    assert result["joined_report_bytes"] > 0
+    assert result["peak_rss_mb"] > 0
@@ -0,0 +1,36 @@
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+from blob_listing import BlobInfo, BlobListing
+from telemetry import RunMetrics
+
+def make_blob_service_client(containers):
+    # Helper building a blob service client listing the given {container: [(name, size, etag)]} in pages of two
+    def get_container_client(container):
+        def list_blobs(name_starts_with=None, results_per_page=None):
+            blobs = [SimpleNamespace(name=name, size=size, etag=etag) for name, size, etag in containers[container]
+                     if name.startswith(name_starts_with or "")]
+            pager = MagicMock()
+            pager.by_page.return_value = iter([iter(blobs[i:i + 2]) for i in range(0, len(blobs), 2)])
+            return pager
+        container_client = MagicMock()
+        container_client.list_blobs.side_effect = list_blobs
+        return container_client
+    blob_service_client = MagicMock()
+    blob_service_client.get_container_client.side_effect = get_container_client
+    return blob_service_client
+
+def test_blob_listing_lists_every_container_once():
+    blob_service_client = make_blob_service_client({
+        "dicoms": [("a.dcm", 10, "e1"), ("b.dcm", 20, "e2"), ("c.dcm", 30, "e3")],
+        "pdf-reports": [("/tmp/a.pdf", 5, "e4"), ("other/b.pdf", 6, "e5")],
+    })
+    metrics = RunMetrics()
+    listing = BlobListing(lambda: blob_service_client, {"pdf-reports": "/tmp/"}, metrics=metrics)
+
+    assert listing.get("dicoms", "c.dcm") == BlobInfo(30, "e3")
+    assert listing.get("dicoms", "missing.dcm") is None
+    assert listing.get("pdf-reports", "/tmp/a.pdf") == BlobInfo(5, "e4")
+    assert listing.get("pdf-reports", "other/b.pdf") is None
+
+    assert blob_service_client.get_container_client.call_count == 2
+    assert metrics.summary()["stages"]["blob_list"]["count"] == 3
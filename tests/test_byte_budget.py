@@ -0,0 +1,106 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest.mock import patch
+import pytest
+import aggregate_pdf_reports
+from byte_budget import ByteBudget
+from local_services import LocalBlobService, LocalPostgres
+from synthetic import generate_reports
+
+def test_acquire_waits_for_room():
+    budget = ByteBudget(100)
+    budget.acquire(60)
+    acquired = threading.Event()
+
+    def acquire():
+        budget.acquire(60)
+        acquired.set()
+    thread = threading.Thread(target=acquire)
+    thread.start()
+
+    # the second reservation does not fit until the first one is released
+    assert not acquired.wait(timeout=0.1)
+    budget.release(60)
+    assert acquired.wait(timeout=5)
+    thread.join()
+    assert budget.in_flight == 60 and budget.peak == 60
+
+def test_oversized_reservation_waits_until_alone():
+    budget = ByteBudget(100)
+    budget.acquire(10)
+    thread = threading.Thread(target=budget.acquire, args=(500,))
+    thread.start()
+
+    thread.join(timeout=0.1)
+    assert thread.is_alive()
+    budget.release(10)
+    thread.join(timeout=5)
+    assert budget.in_flight == 500
+
+def test_budget_must_be_positive():
+    with pytest.raises(ValueError):
+        ByteBudget(0)
+
+def test_run_pipeline_within_budget(tmp_path):
+    reports = generate_reports(20, datetime.now(), timedelta(days=2), pixel_bytes=100_000)
+    database = LocalPostgres()
+    database.add_reports(reports)
+    blob_service = LocalBlobService(latency=0.005)
+    blob_service.add_reports(reports, pixel_bytes=100_000)
+    budget = ByteBudget(300_000)
+    joined = []
+
+    with patch.dict(os.environ, {"AZURE_CONNECTION_STRING": "local", "PDF_TARGET_DIR": str(tmp_path / "pdfs")}), \
+            patch("aggregate_pdf_reports.load_dotenv"), \
+            patch("aggregate_pdf_reports.BlobServiceClient", blob_service), \
+            patch("aggregate_pdf_reports.psycopg.connect", database):
+        with aggregate_pdf_reports.PipelineSession(byte_budget=budget) as session:
+            aggregate_pdf_reports.run_pipeline(datetime.now() - timedelta(days=3), datetime.now(), workers=8,
+                                               session=session, merge=lambda paths, session: joined.extend(paths))
+
+    assert len(joined) == 20
+    # eight concurrent DICOM downloads would hold about 800 kB without the budget
+    assert 0 < budget.peak <= 300_000
+    assert budget.in_flight == 0
+
+def test_fetch_pdfs_larger_than_budget_left(tmp_path):
+    # the first report waits for room while the later ones are already downloaded, they must not hold the budget
+    blob_service = LocalBlobService(latency=0.01)
+    sizes = {"a.pdf": 6, "b.pdf": 5, "c.pdf": 5, "d.pdf": 1}
+    for name, size in sizes.items():
+        blob_service.add("pdf-reports", "/tmp/" + name, name[0].encode() * size)
+    budget = ByteBudget(10)
+    paths, spooled = [], []
+    download_pdf_from_azure = aggregate_pdf_reports.download_pdf_from_azure
+    spool_pdf = aggregate_pdf_reports._spool_pdf
+
+    def download_first_last(pdf_file_name, **kwargs):
+        if pdf_file_name == "a.pdf":
+            time.sleep(0.2)
+        return download_pdf_from_azure(pdf_file_name, **kwargs)
+
+    def spool_reserved(downloader, save_folder):
+        # the report is still reserved once its temporary file is written
+        result = spool_pdf(downloader, save_folder)
+        spooled.append((os.path.getsize(result.path), budget.in_flight))
+        return result
+
+    with patch.dict(os.environ, {"AZURE_CONNECTION_STRING": "local", "PDF_TARGET_DIR": str(tmp_path / "pdfs")}), \
+            patch("aggregate_pdf_reports.load_dotenv"), \
+            patch("aggregate_pdf_reports.BlobServiceClient", blob_service), \
+            patch("aggregate_pdf_reports.download_pdf_from_azure", side_effect=download_first_last), \
+            patch("aggregate_pdf_reports._spool_pdf", side_effect=spool_reserved):
+        with aggregate_pdf_reports.PipelineSession(byte_budget=budget) as session:
+            fetching = threading.Thread(target=lambda: paths.extend(
+                aggregate_pdf_reports.fetch_pdfs(list(sizes), workers=4, session=session)), daemon=True)
+            fetching.start()
+            fetching.join(timeout=10)
+
+    assert not fetching.is_alive()
+    assert [open(path, "rb").read() for path in paths] == [name[0].encode() * size for name, size in sizes.items()]
+    assert budget.in_flight == 0 and budget.peak <= 10
+    assert sorted(size for size, _ in spooled) == [1, 5, 5, 6]
+    assert all(in_flight >= size for size, in_flight in spooled)
+    assert sorted(os.listdir(tmp_path / "pdfs")) == [f"report{i}.pdf" for i in range(1, 5)]
@@ -0,0 +1,114 @@
+import os
+import subprocess
+import sys
+
+from io import BytesIO
+from pathlib import Path
+from unittest.mock import patch, MagicMock
+
+import pytest
+from pypdf import PdfReader, PdfWriter
+
+import aggregate_pdf_reports
+from pipeline_state import read_lines, write_lines
+
+SRC_DIR = Path(__file__).resolve().parents[1] / "src"
+
+def make_pdf_bytes():
+    # Helper building a valid single-page PDF
+    writer = PdfWriter()
+    writer.add_blank_page(width=72, height=72)
+    buffer = BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+@pytest.fixture
+def env(tmp_path):
+    with patch.dict(os.environ, {"AZURE_CONNECTION_STRING": "test", "PDF_TARGET_DIR": str(tmp_path / "pdfs"),
+                                 "JOINED_PDF_TARGET_DIR": str(tmp_path / "joined")}), \
+            patch("aggregate_pdf_reports.load_dotenv"):
+        yield tmp_path
+
+def test_help_and_merge_import_no_heavy_libraries():
+    code = (
+        "import sys, aggregate_pdf_reports\n"
+        "try:\n"
+        "    aggregate_pdf_reports.main(['merge', '--help'])\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        "print(sorted({m.split('.')[0] for m in sys.modules} & {'psycopg', 'pydicom', 'azure', 'pypdf', 'requests'}))"
+    )
+    completed = subprocess.run([sys.executable, "-c", code], cwd=SRC_DIR, capture_output=True, text=True, check=True)
+    assert completed.stdout.strip().splitlines()[-1] == "[]"
+
+def test_main_without_command_runs_whole_pipeline():
+    run = MagicMock()
+    with patch.dict(aggregate_pdf_reports.COMMANDS, {"run": run}):
+        aggregate_pdf_reports.main(["--delta", "7", "--workers", "4"])
+
+    args = run.call_args.args[0]
+    assert args.command == "run"
+    assert args.delta == 7 and args.workers == 4
+
+def test_resolve_writes_names_into_state_dir(env):
+    state_dir = env / "state"
+    with patch("aggregate_pdf_reports.iter_pdf_file_names", return_value=iter(["a.pdf", "b.pdf"])) as mock_iter:
+        aggregate_pdf_reports.main(["resolve", "--date", "2025-01-15", "--state-dir", str(state_dir)])
+
+    mock_iter.assert_called_once()
+    assert read_lines(state_dir / "names.txt") == ["a.pdf", "b.pdf"]
+
+def test_fetch_and_merge_run_from_state_dir(env):
+    state_dir = env / "state"
+    write_lines(state_dir / "names.txt", ["a.pdf", "missing.pdf", "b.pdf"])
+    pdf = make_pdf_bytes()
+
+    def get_blob_client(container, blob):
+        blob_client = MagicMock()
+        if blob == "/tmp/missing.pdf":
+            blob_client.download_blob.side_effect = Exception("Blob not found")
+        blob_client.download_blob.return_value.readall.return_value = pdf
+        return blob_client
+
+    with patch("aggregate_pdf_reports.BlobServiceClient") as mock_blob_service_client:
+        mock_blob_service_client.from_connection_string.return_value.get_blob_client.side_effect = get_blob_client
+        aggregate_pdf_reports.main(["fetch", "--state-dir", str(state_dir), "--workers", "2"])
+
+    pdf_paths = read_lines(state_dir / "pdfs.txt")
+    assert [Path(path).name for path in pdf_paths] == ["report1.pdf", "report2.pdf"]
+
+    aggregate_pdf_reports.main(["merge", "--state-dir", str(state_dir), "--mmap"])
+
+    assert len(PdfReader(env / "joined" / "joined_report.pdf").pages) == 2
+
+def test_fetch_requires_resolved_names(env):
+    with pytest.raises(FileNotFoundError):
+        aggregate_pdf_reports.main(["fetch", "--state-dir", str(env / "state")])
+
+def test_run_resume_requires_journal():
+    with pytest.raises(ValueError, match="--journal"):
+        aggregate_pdf_reports.main(["run", "--resume"])
+
+@pytest.mark.parametrize("command", ["shard", "reduce"])
+def test_shards_require_date(command, tmp_path):
+    # the window of every call would end at a different "now"
+    with pytest.raises(ValueError, match="--date"):
+        aggregate_pdf_reports.main([command, "--shard-days", "1", "--state-dir", str(tmp_path)])
+
+def test_run_shards_reject_content_store(tmp_path):
+    with pytest.raises(ValueError, match="--content-store"):
+        aggregate_pdf_reports.main(["run", "--shard-days", "1", "--content-store", "--state-dir", str(tmp_path)])
+
+def test_run_async_rejects_unsupported_options():
+    with pytest.raises(ValueError, match="--max-inflight-mb, --list-blobs"):
+        aggregate_pdf_reports.main(["run", "--engine", "async", "--max-inflight-mb", "64", "--list-blobs"])
+
+def test_run_async_uses_selected_merge():
+    with patch("aggregate_pdf_reports_async.AsyncPipelineSession") as mock_session, \
+            patch("aggregate_pdf_reports_async.run_pipeline_async") as mock_run:
+        mock_session.return_value.__aenter__.return_value.config = MagicMock()
+        aggregate_pdf_reports.main(["run", "--engine", "async", "--max-part-mb", "50", "--optimize"])
+
+    merge = mock_run.call_args.kwargs["merge"]
+    assert merge.func is aggregate_pdf_reports.join_pdfs_split
+    assert merge.keywords["max_bytes"] == 50 * 1024 * 1024 and merge.keywords["optimize"]
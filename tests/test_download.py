@@ -1,6 +1,8 @@
 import pytest
+from azure.core.exceptions import ResourceNotFoundError
 from unittest.mock import patch, MagicMock
 import aggregate_pdf_reports  # replace with the actual module name where download_pdf_from_azure is defined
+from missing_blobs import MissingBlobCache
 
 def test_download_pdf_success():
     pdf_file_name = "test.pdf"
@@ -31,3 +33,75 @@ def test_download_pdf_failure():
         content = aggregate_pdf_reports.download_pdf_from_azure(pdf_file_name)
 
         assert content == "download_failed"
+
+def test_download_pdf_to_disk_success(tmp_path):
+    session = MagicMock()
+    session.pdf_target_dir = tmp_path
+    session.missing_blobs = None
+    session.blob_listing = None
+    mock_blob_client = session.blob_service_client.return_value.get_blob_client.return_value
+    mock_blob_client.download_blob.return_value.readinto.side_effect = lambda stream: stream.write(b"%PDF-1.4 content")
+
+    path = aggregate_pdf_reports.download_pdf_to_disk("test.pdf", session=session)
+
+    assert path == str(tmp_path / "test.pdf")
+    assert (tmp_path / "test.pdf").read_bytes() == b"%PDF-1.4 content"
+    session.blob_service_client.return_value.get_blob_client.assert_called_once_with(
+        container="pdf-reports", blob="/tmp/test.pdf"
+    )
+    assert list(tmp_path.iterdir()) == [tmp_path / "test.pdf"]
+
+def test_download_pdf_to_disk_failure(tmp_path):
+    session = MagicMock()
+    session.pdf_target_dir = tmp_path
+    session.missing_blobs = None
+    session.blob_listing = None
+    mock_blob_client = session.blob_service_client.return_value.get_blob_client.return_value
+    mock_blob_client.download_blob.return_value.readinto.side_effect = Exception("Connection reset")
+
+    assert aggregate_pdf_reports.download_pdf_to_disk("test.pdf", session=session) == "download_failed"
+    # the partially written temporary file is removed
+    assert list(tmp_path.iterdir()) == []
+
+@patch("aggregate_pdf_reports.load_dotenv")
+@patch("aggregate_pdf_reports.BlobServiceClient")
+def test_download_pdf_missing_blob_cache(mock_blob_service_client, mock_load_dotenv, tmp_path):
+    # Test case: A missing blob is requested once and then skipped, other failures are not cached
+    mock_get_blob_client = mock_blob_service_client.from_connection_string.return_value.get_blob_client
+    mock_get_blob_client.return_value.download_blob.side_effect = ResourceNotFoundError("Blob not found")
+
+    with MissingBlobCache(tmp_path / "missing.sqlite") as missing_blobs, \
+            aggregate_pdf_reports.PipelineSession(missing_blobs=missing_blobs) as session:
+        assert aggregate_pdf_reports.download_pdf_from_azure("missing.pdf", session=session) == "download_failed"
+        assert aggregate_pdf_reports.download_pdf_from_azure("missing.pdf", session=session) == "download_failed"
+        assert mock_get_blob_client.call_count == 1
+
+        mock_get_blob_client.return_value.download_blob.side_effect = Exception("Connection reset")
+        assert aggregate_pdf_reports.download_pdf_to_disk("flaky.pdf", session=session) == "download_failed"
+        assert not missing_blobs.is_missing("pdf-reports", "/tmp/flaky.pdf")
+
+        assert session.metrics.counters == {"blob_misses": 1, "blob_misses_cached": 1, "blob_download_failures": 1}
+
+@patch("aggregate_pdf_reports.load_dotenv")
+@patch("aggregate_pdf_reports.BlobServiceClient")
+def test_download_pdf_list_blobs(mock_blob_service_client, mock_load_dotenv):
+    # Test case: PDFs missing from the listing are not requested, large PDFs are downloaded in parallel ranges
+    from test_blob_listing import make_blob_service_client
+    blob_service_client = make_blob_service_client({"pdf-reports": [
+        ("/tmp/small.pdf", 1000, "e1"), ("/tmp/large.pdf", aggregate_pdf_reports.LARGE_BLOB_SIZE + 1, "e2"),
+    ]})
+    mock_blob_client = blob_service_client.get_blob_client.return_value
+    mock_blob_client.download_blob.return_value.readall.return_value = b"%PDF"
+    mock_blob_service_client.from_connection_string.return_value = blob_service_client
+
+    with aggregate_pdf_reports.PipelineSession(list_blobs=True) as session:
+        assert aggregate_pdf_reports.download_pdf_from_azure("missing.pdf", session=session) == "download_failed"
+        blob_service_client.get_blob_client.assert_not_called()
+        assert aggregate_pdf_reports.download_pdf_from_azure("small.pdf", session=session) == b"%PDF"
+        mock_blob_client.download_blob.assert_called_once_with()
+        assert aggregate_pdf_reports.download_pdf_from_azure("large.pdf", session=session) == b"%PDF"
+        mock_blob_client.download_blob.assert_called_with(
+            max_concurrency=aggregate_pdf_reports.LARGE_BLOB_CONCURRENCY)
+
+    # the container is listed once, under the prefix of the PDF reports
+    blob_service_client.get_container_client.assert_called_once_with("pdf-reports")
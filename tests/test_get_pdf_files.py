@@ -1,9 +1,12 @@
 import pytest
+from azure.core.exceptions import ResourceNotFoundError
 from unittest.mock import patch, MagicMock
-from datetime import datetime
+from datetime import datetime, timedelta
 from io import BytesIO
 import aggregate_pdf_reports  # replace with your actual module
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 # import time # No need to import time directly in the test if patching from aggregate_pdf_reports
 
 # Define MAX_RETRIES for the test environment, as it's used in the function
@@ -361,4 +364,469 @@ def test_get_pdf_file_names_missing_referenced_sop_instance_uid(mock_dcmread, mo
     to_date = datetime(2025, 1, 16)
 
     result = aggregate_pdf_reports.get_pdf_file_names(from_date, to_date)
-    assert result == []
\ No newline at end of file
+    assert result == []
+@patch("aggregate_pdf_reports.load_dotenv")
+@patch("aggregate_pdf_reports.psycopg.connect")
+@patch("aggregate_pdf_reports.BlobServiceClient")
+@patch("aggregate_pdf_reports.pydicom.dcmread")
+def test_get_pdf_file_names_concurrent_keeps_order(mock_dcmread, mock_blob_service_client, mock_psycopg_connect, mock_load_dotenv):
+    # Test case: Concurrent resolution returns names in the DB order and keeps skipping failed files
+    fake_db_rows = [(f"file{i}.dcm", "pdf-reports") for i in range(20)]
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = fake_db_rows
+    mock_conn = MagicMock()
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_psycopg_connect.return_value.__enter__.return_value = mock_conn
+
+    def fake_get_blob_client(container, file_name):
+        blob_client = MagicMock()
+        if file_name == "file3.dcm":
+            blob_client.download_blob.side_effect = Exception("Blob not found")
+        else:
+            blob_client.download_blob.return_value.readall.return_value = file_name.encode()
+        return blob_client
+    mock_blob_service_client.from_connection_string.return_value.get_blob_client.side_effect = fake_get_blob_client
+
+    def fake_dcmread(fileobj):
+        index = fileobj.read().decode().removeprefix("file").removesuffix(".dcm")
+        return FakeDicom({
+            "InstanceCreationDate": "20250115",
+            "InstanceCreationTime": "120000",
+            "StudyInstanceUID": index,
+            "ReferencedSeriesSequence": [AttrDict({"SeriesInstanceUID": "4.5.6"})],
+            "ReferencedPerformedProcedureStepSequence": [AttrDict({"ReferencedSOPInstanceUID": "7.8.9"})]
+        })
+    mock_dcmread.side_effect = fake_dcmread
+
+    from_date = datetime(2025, 1, 14)
+    to_date = datetime(2025, 1, 16)
+
+    result = aggregate_pdf_reports.get_pdf_file_names(from_date, to_date, workers=4)
+    assert result == [f"{i}_4.5.6_7.8.9.pdf" for i in range(20) if i != 3]
+
+def make_dicom_bytes(pixel_bytes):
+    # Helper building a real DICOM file with the tags needed for the PDF name followed by pixel data
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian
+
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.7"
+    file_meta.MediaStorageSOPInstanceUID = "1.2.3.4"
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.InstanceCreationDate = "20250115"
+    ds.InstanceCreationTime = "120000.000"
+    ds.StudyInstanceUID = "1.2.3"
+    ds.SeriesInstanceUID = "9.9.9"
+    series = Dataset()
+    series.SeriesInstanceUID = "4.5.6"
+    ds.ReferencedSeriesSequence = [series]
+    step = Dataset()
+    step.ReferencedSOPInstanceUID = "7.8.9"
+    ds.ReferencedPerformedProcedureStepSequence = [step]
+    ds.BitsAllocated = 8
+    ds.PixelData = bytes(pixel_bytes)
+    buffer = BytesIO()
+    ds.save_as(buffer, enforce_file_format=True)
+    return buffer.getvalue()
+
+@patch("aggregate_pdf_reports.DICOM_HEADER_CHUNK_SIZE", 64)
+@patch("aggregate_pdf_reports.load_dotenv")
+@patch("aggregate_pdf_reports.psycopg.connect")
+@patch("aggregate_pdf_reports.BlobServiceClient")
+def test_get_pdf_file_names_header_only(mock_blob_service_client, mock_psycopg_connect, mock_load_dotenv):
+    # Test case: Only a growing prefix of the DICOM file is downloaded, never the pixel data
+    content = make_dicom_bytes(1_000_000)
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = [("file1.dcm", "dicoms")]
+    mock_conn = MagicMock()
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_psycopg_connect.return_value.__enter__.return_value = mock_conn
+
+    requested = []
+    def fake_download_blob(offset=None, length=None):
+        requested.append(length)
+        downloader = MagicMock()
+        downloader.readall.return_value = content[offset:offset + length]
+        return downloader
+    mock_blob_client = MagicMock()
+    mock_blob_client.download_blob.side_effect = fake_download_blob
+    mock_blob_service_client.from_connection_string.return_value.get_blob_client.return_value = mock_blob_client
+
+    result = aggregate_pdf_reports.get_pdf_file_names(datetime(2025, 1, 14), datetime(2025, 1, 16), header_only=True)
+
+    assert result == ["1.2.3_4.5.6_7.8.9.pdf"]
+    assert requested[0] == 64
+    assert len(requested) > 1
+    assert requested[-1] < 10_000
+
+@patch("aggregate_pdf_reports.DICOM_HEADER_CHUNK_SIZE", 64)
+@patch("aggregate_pdf_reports.load_dotenv")
+@patch("aggregate_pdf_reports.psycopg.connect")
+@patch("aggregate_pdf_reports.BlobServiceClient")
+def test_get_pdf_file_names_parse_workers(mock_blob_service_client, mock_psycopg_connect, mock_load_dotenv):
+    # Test case: DICOM files are parsed in worker processes, skipped files keep their reason and the order is kept
+    content = make_dicom_bytes(100_000)
+    blobs = {"file1.dcm": content, "file2.dcm": b"not a dicom file", "file3.dcm": content}
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = [(name, "dicoms") for name in blobs]
+    mock_conn = MagicMock()
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_psycopg_connect.return_value.__enter__.return_value = mock_conn
+
+    def fake_get_blob_client(container, file_name):
+        def fake_download_blob(offset=None, length=None):
+            downloader = MagicMock()
+            downloader.readall.return_value = blobs[file_name][offset:offset + length]
+            return downloader
+        mock_blob_client = MagicMock()
+        mock_blob_client.download_blob.side_effect = fake_download_blob
+        return mock_blob_client
+    mock_blob_service_client.from_connection_string.return_value.get_blob_client.side_effect = fake_get_blob_client
+
+    with patch("builtins.print") as mock_print:
+        result = aggregate_pdf_reports.get_pdf_file_names(datetime(2025, 1, 14), datetime(2025, 1, 16), workers=2,
+                                                          header_only=True, parse_workers=2)
+
+    assert result == ["1.2.3_4.5.6_7.8.9.pdf", "1.2.3_4.5.6_7.8.9.pdf"]
+    mock_print.assert_any_call("file2.dcm Read failed")
+
+@patch("aggregate_pdf_reports.load_dotenv")
+@patch("aggregate_pdf_reports.psycopg.connect")
+@patch("aggregate_pdf_reports.BlobServiceClient")
+def test_get_pdf_file_names_parses_overlap(mock_blob_service_client, mock_psycopg_connect, mock_load_dotenv):
+    # Test case: With as many download threads as parse workers, the parses of different files run at once
+    content = make_dicom_bytes(16)
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = [(f"file{i}.dcm", "dicoms") for i in range(3)]
+    mock_conn = MagicMock()
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_psycopg_connect.return_value.__enter__.return_value = mock_conn
+    mock_blob_service_client.from_connection_string.return_value.get_blob_client.return_value \
+        .download_blob.return_value.readall.return_value = content
+
+    # every parse waits for another one to start, the pool runs in threads so the patched parser is used
+    overlap = threading.Barrier(3, timeout=5)
+    parse = aggregate_pdf_reports._parse_dicom_content
+    def overlapping_parse(*args):
+        overlap.wait()
+        return parse(*args)
+    parse_pool = lambda parse_workers: ThreadPoolExecutor(max_workers=parse_workers)
+    with patch("aggregate_pdf_reports._parse_dicom_content", side_effect=overlapping_parse), \
+            patch("aggregate_pdf_reports._parse_pool", side_effect=parse_pool):
+        result = aggregate_pdf_reports.get_pdf_file_names(datetime(2025, 1, 14), datetime(2025, 1, 16), workers=3,
+                                                          parse_workers=3)
+
+    assert result == ["1.2.3_4.5.6_7.8.9.pdf"] * 3
+
+def test_get_pdf_file_names_parse_workers_above_workers():
+    # Test case: Parse workers the download threads cannot keep busy are rejected before anything runs
+    with pytest.raises(ValueError, match="--parse-workers"):
+        aggregate_pdf_reports.get_pdf_file_names(datetime(2025, 1, 14), datetime(2025, 1, 16), workers=1,
+                                                 parse_workers=4)
+
+@patch("aggregate_pdf_reports.load_dotenv")
+@patch("aggregate_pdf_reports.psycopg.connect")
+@patch("aggregate_pdf_reports.BlobServiceClient")
+def test_get_pdf_file_names_header_only_small_blob(mock_blob_service_client, mock_psycopg_connect, mock_load_dotenv):
+    # Test case: Blob shorter than the first ranged read is parsed from the single response
+    content = make_dicom_bytes(16)
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = [("file1.dcm", "dicoms")]
+    mock_conn = MagicMock()
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_psycopg_connect.return_value.__enter__.return_value = mock_conn
+
+    mock_blob_client = MagicMock()
+    mock_blob_client.download_blob.return_value.readall.return_value = content
+    mock_blob_service_client.from_connection_string.return_value.get_blob_client.return_value = mock_blob_client
+
+    result = aggregate_pdf_reports.get_pdf_file_names(datetime(2025, 1, 14), datetime(2025, 1, 16), header_only=True)
+
+    assert result == ["1.2.3_4.5.6_7.8.9.pdf"]
+    mock_blob_client.download_blob.assert_called_once_with(offset=0, length=aggregate_pdf_reports.DICOM_HEADER_CHUNK_SIZE)
+
+@patch("aggregate_pdf_reports.load_dotenv")
+@patch("aggregate_pdf_reports.psycopg.connect")
+@patch("aggregate_pdf_reports.BlobServiceClient")
+@patch("aggregate_pdf_reports.pydicom.dcmread")
+def test_get_pdf_file_names_metadata_index(mock_dcmread, mock_blob_service_client, mock_psycopg_connect, mock_load_dotenv, tmp_path):
+    # Test case: Second run reuses the indexed metadata and downloads only the changed blob
+    fake_db_rows = [
+        ("file1.dcm", "dicoms"),
+        ("file2.dcm", "dicoms"),
+    ]
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = fake_db_rows
+    mock_conn = MagicMock()
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_psycopg_connect.return_value.__enter__.return_value = mock_conn
+
+    etags = {"file1.dcm": "etag1", "file2.dcm": "etag1"}
+    def fake_get_blob_client(container, file_name):
+        blob_client = MagicMock()
+        blob_client.get_blob_properties.return_value.etag = etags[file_name]
+        blob_client.download_blob.return_value.readall.return_value = file_name.encode()
+        return blob_client
+    mock_blob_service_client.from_connection_string.return_value.get_blob_client.side_effect = fake_get_blob_client
+
+    def fake_dcmread(fileobj):
+        return FakeDicom({
+            "InstanceCreationDate": "20250115",
+            "InstanceCreationTime": "120000",
+            "StudyInstanceUID": fileobj.read().decode(),
+            "ReferencedSeriesSequence": [AttrDict({"SeriesInstanceUID": "4.5.6"})],
+            "ReferencedPerformedProcedureStepSequence": [AttrDict({"ReferencedSOPInstanceUID": "7.8.9"})]
+        })
+    mock_dcmread.side_effect = fake_dcmread
+
+    from_date = datetime(2025, 1, 14)
+    to_date = datetime(2025, 1, 16)
+    expected = ["file1.dcm_4.5.6_7.8.9.pdf", "file2.dcm_4.5.6_7.8.9.pdf"]
+
+    with aggregate_pdf_reports.MetadataIndex(tmp_path / "index.sqlite") as index:
+        assert aggregate_pdf_reports.get_pdf_file_names(from_date, to_date, index=index) == expected
+    assert mock_dcmread.call_count == 2
+
+    etags["file2.dcm"] = "etag2"
+    with aggregate_pdf_reports.MetadataIndex(tmp_path / "index.sqlite") as index:
+        assert aggregate_pdf_reports.get_pdf_file_names(from_date, to_date, index=index) == expected
+        # the time slot is validated again for indexed metadata
+        assert aggregate_pdf_reports.get_pdf_file_names(to_date, to_date + timedelta(days=1), index=index) == []
+    assert mock_dcmread.call_count == 3
+
+@patch("aggregate_pdf_reports.load_dotenv")
+@patch("aggregate_pdf_reports.psycopg.connect")
+@patch("aggregate_pdf_reports.BlobServiceClient")
+@patch("aggregate_pdf_reports.pydicom.dcmread")
+def test_get_pdf_file_names_server_side_cursor(mock_dcmread, mock_blob_service_client, mock_psycopg_connect, mock_load_dotenv):
+    # Test case: With batch_size the rows are streamed from a held named cursor outside of a transaction
+    fake_db_rows = [
+        ("file1.dcm", "pdf-reports"),
+        ("file2.dcm", "pdf-reports"),
+    ]
+    mock_cursor = MagicMock()
+    mock_cursor.__iter__.return_value = iter(fake_db_rows)
+    mock_conn = MagicMock()
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_psycopg_connect.return_value.__enter__.return_value = mock_conn
+
+    mock_blob_client = MagicMock()
+    mock_blob_client.download_blob.return_value.readall.return_value = b"FAKEDICOMDATA"
+    mock_blob_service_client.from_connection_string.return_value.get_blob_client.return_value = mock_blob_client
+
+    mock_dcmread.return_value = FakeDicom({
+        "InstanceCreationDate": "20250115",
+        "InstanceCreationTime": "120000",
+        "StudyInstanceUID": "1.2.3",
+        "ReferencedSeriesSequence": [AttrDict({"SeriesInstanceUID": "4.5.6"})],
+        "ReferencedPerformedProcedureStepSequence": [AttrDict({"ReferencedSOPInstanceUID": "7.8.9"})]
+    })
+
+    result = aggregate_pdf_reports.get_pdf_file_names(datetime(2025, 1, 14), datetime(2025, 1, 16), batch_size=500)
+
+    assert result == ["1.2.3_4.5.6_7.8.9.pdf", "1.2.3_4.5.6_7.8.9.pdf"]
+    mock_conn.cursor.assert_called_once_with(name="dicom_reports", withhold=True)
+    mock_conn.transaction.assert_not_called()
+    assert mock_cursor.itersize == 500
+    mock_cursor.fetchall.assert_not_called()
+
+@patch("aggregate_pdf_reports.load_dotenv")
+@patch("aggregate_pdf_reports.psycopg.connect")
+@patch("aggregate_pdf_reports.BlobServiceClient")
+@patch("aggregate_pdf_reports.pydicom.dcmread")
+def test_get_pdf_file_names_db_index(mock_dcmread, mock_blob_service_client, mock_psycopg_connect, mock_load_dotenv):
+    # Test case: Backfilled rows are answered from the DB, the rest is resolved from Azure and written through
+    fake_db_rows = [
+        ("file2.dcm", "dicoms", 2, None, None, None, None, None),
+        ("file1.dcm", "dicoms", 1, True, datetime(2025, 1, 15, 10), "1.1.1", "2.2.2", "3.3.3"),
+    ]
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = fake_db_rows
+    mock_conn = MagicMock()
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_psycopg_connect.return_value.__enter__.return_value = mock_conn
+
+    mock_blob_client = MagicMock()
+    mock_blob_client.download_blob.return_value.readall.return_value = b"FAKEDICOMDATA"
+    mock_blob_service_client.from_connection_string.return_value.get_blob_client.return_value = mock_blob_client
+
+    mock_dcmread.return_value = FakeDicom({
+        "InstanceCreationDate": "20250115",
+        "InstanceCreationTime": "120000",
+        "StudyInstanceUID": "1.2.3",
+        "ReferencedSeriesSequence": [AttrDict({"SeriesInstanceUID": "4.5.6"})],
+        "ReferencedPerformedProcedureStepSequence": [AttrDict({"ReferencedSOPInstanceUID": "7.8.9"})]
+    })
+
+    result = aggregate_pdf_reports.get_pdf_file_names(datetime(2025, 1, 14), datetime(2025, 1, 16), db_index=True)
+
+    assert result == ["1.2.3_4.5.6_7.8.9.pdf", "1.1.1_2.2.2_3.3.3.pdf"]
+    assert mock_cursor.execute.call_args[0][0] == aggregate_pdf_reports.DICOM_REPORTS_INDEXED_QUERY
+    mock_dcmread.assert_called_once()
+    mock_blob_service_client.from_connection_string.return_value.get_blob_client.assert_called_once_with("dicoms", "file2.dcm")
+
+    # metadata of the row resolved from Azure is written through to the DB
+    mock_conn.execute.assert_called_once()
+    query, params = mock_conn.execute.call_args[0]
+    assert query == aggregate_pdf_reports.DB_METADATA_UPSERT
+    assert params["id"] == 2
+    assert params["created"] == datetime(2025, 1, 15, 12)
+    assert params["pdf"] == "1.2.3_4.5.6_7.8.9.pdf"
+
+@patch("aggregate_pdf_reports.load_dotenv")
+@patch("aggregate_pdf_reports.psycopg.connect")
+@patch("aggregate_pdf_reports.BlobServiceClient")
+@patch("aggregate_pdf_reports.pydicom.dcmread")
+def test_get_pdf_file_names_db_index_batches_write_through(mock_dcmread, mock_blob_service_client, mock_psycopg_connect,
+                                                           mock_load_dotenv):
+    # Test case: With batch_size the metadata is written through while the cursor is still read, outside a transaction
+    written_before = []
+    def fake_rows():
+        yield ("file1.dcm", "dicoms", 1, None, None, None, None, None)
+        written_before.append(mock_conn.execute.call_count)
+        yield ("file2.dcm", "dicoms", 2, None, None, None, None, None)
+    mock_cursor = MagicMock()
+    mock_cursor.__iter__.return_value = fake_rows()
+    mock_conn = MagicMock()
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_psycopg_connect.return_value.__enter__.return_value = mock_conn
+
+    mock_blob_client = MagicMock()
+    mock_blob_client.download_blob.return_value.readall.return_value = b"FAKEDICOMDATA"
+    mock_blob_service_client.from_connection_string.return_value.get_blob_client.return_value = mock_blob_client
+    mock_dcmread.return_value = FakeDicom({
+        "InstanceCreationDate": "20250115",
+        "InstanceCreationTime": "120000",
+        "StudyInstanceUID": "1.2.3",
+        "ReferencedSeriesSequence": [AttrDict({"SeriesInstanceUID": "4.5.6"})],
+        "ReferencedPerformedProcedureStepSequence": [AttrDict({"ReferencedSOPInstanceUID": "7.8.9"})]
+    })
+
+    result = aggregate_pdf_reports.get_pdf_file_names(datetime(2025, 1, 14), datetime(2025, 1, 16), batch_size=1,
+                                                      db_index=True)
+
+    assert result == ["1.2.3_4.5.6_7.8.9.pdf"] * 2
+    assert written_before == [1]
+    assert mock_conn.execute.call_count == 2
+    mock_conn.cursor.assert_called_once_with(name="dicom_reports", withhold=True)
+    mock_conn.transaction.assert_not_called()
+
+@patch("aggregate_pdf_reports.load_dotenv")
+@patch("aggregate_pdf_reports.psycopg.connect")
+@patch("aggregate_pdf_reports.BlobServiceClient")
+@patch("aggregate_pdf_reports.pydicom.dcmread")
+def test_get_pdf_file_names_records_metrics(mock_dcmread, mock_blob_service_client, mock_psycopg_connect, mock_load_dotenv):
+    # Test case: The session metrics count the DB query, DICOM fetches and parses, and skipped reports by reason
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = [("file1.dcm", "dicoms"), ("file2.dcm", "dicoms"), ("file3.dcm", "dicoms")]
+    mock_conn = MagicMock()
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_psycopg_connect.return_value.__enter__.return_value = mock_conn
+
+    def fake_get_blob_client(container, file_name):
+        mock_blob_client = MagicMock()
+        if file_name == "file2.dcm":
+            mock_blob_client.download_blob.side_effect = ResourceNotFoundError("Blob not found")
+        else:
+            mock_blob_client.download_blob.return_value.readall.return_value = b"dicom"
+        return mock_blob_client
+    mock_blob_service_client.from_connection_string.return_value.get_blob_client.side_effect = fake_get_blob_client
+
+    mock_dcmread.side_effect = [FakeDicom({
+        "InstanceCreationDate": "20250115",
+        "InstanceCreationTime": "120000",
+        "StudyInstanceUID": "1.2.3",
+        "ReferencedSeriesSequence": [AttrDict({"SeriesInstanceUID": "4.5.6"})],
+        "ReferencedPerformedProcedureStepSequence": [AttrDict({"ReferencedSOPInstanceUID": "7.8.9"})]
+    }), Exception("Read failed")]
+
+    with aggregate_pdf_reports.PipelineSession() as session:
+        result = aggregate_pdf_reports.get_pdf_file_names(datetime(2025, 1, 14), datetime(2025, 1, 16), session=session)
+        summary = session.metrics.summary()
+
+    assert result == ["1.2.3_4.5.6_7.8.9.pdf"]
+    assert summary["stages"]["db"]["count"] == 1
+    assert summary["stages"]["dicom_fetch"]["count"] == 3
+    assert summary["stages"]["dicom_fetch"]["errors"] == 1
+    assert summary["stages"]["dicom_fetch"]["bytes"] == 10
+    assert summary["stages"]["parse"]["count"] == 2
+    assert summary["skipped"] == {"not_in_storage": 1, "read_failed": 1}
+    assert summary["counters"] == {"reports_resolved": 1, "blob_misses": 1}
+
+@patch("aggregate_pdf_reports.load_dotenv")
+@patch("aggregate_pdf_reports.psycopg.connect")
+@patch("aggregate_pdf_reports.BlobServiceClient")
+@patch("aggregate_pdf_reports.pydicom.dcmread")
+def test_get_pdf_file_names_missing_blob_cache(mock_dcmread, mock_blob_service_client, mock_psycopg_connect, mock_load_dotenv, tmp_path):
+    # Test case: DICOM files missing from the storage are requested in the first run only,
+    # download failures are reported separately and probed again
+    from missing_blobs import MissingBlobCache
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = [("missing.dcm", "dicoms"), ("flaky.dcm", "dicoms")]
+    mock_conn = MagicMock()
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_psycopg_connect.return_value.__enter__.return_value = mock_conn
+
+    requested = []
+    def fake_get_blob_client(container, file_name):
+        requested.append(file_name)
+        mock_blob_client = MagicMock()
+        if file_name == "missing.dcm":
+            mock_blob_client.download_blob.side_effect = ResourceNotFoundError("Blob not found")
+        else:
+            mock_blob_client.download_blob.side_effect = Exception("Connection reset")
+        return mock_blob_client
+    mock_blob_service_client.from_connection_string.return_value.get_blob_client.side_effect = fake_get_blob_client
+
+    for _ in range(2):
+        with MissingBlobCache(tmp_path / "missing.sqlite") as missing_blobs, \
+                aggregate_pdf_reports.PipelineSession(missing_blobs=missing_blobs) as session, \
+                patch("builtins.print") as mock_print:
+            assert aggregate_pdf_reports.get_pdf_file_names(datetime(2025, 1, 14), datetime(2025, 1, 16),
+                                                            session=session) == []
+        mock_print.assert_any_call("missing.dcm not in storage")
+        mock_print.assert_any_call("flaky.dcm Download failed")
+
+    assert requested == ["missing.dcm", "flaky.dcm", "flaky.dcm"]
+    assert session.metrics.skips == {"not_in_storage": 1, "download_failed": 1}
+    assert session.metrics.counters == {"blob_misses_cached": 1, "blob_download_failures": 1}
+    mock_dcmread.assert_not_called()
+
+@patch("aggregate_pdf_reports.load_dotenv")
+@patch("aggregate_pdf_reports.psycopg.connect")
+@patch("aggregate_pdf_reports.BlobServiceClient")
+@patch("aggregate_pdf_reports.pydicom.dcmread")
+def test_get_pdf_file_names_list_blobs(mock_dcmread, mock_blob_service_client, mock_psycopg_connect, mock_load_dotenv, tmp_path):
+    # Test case: Rows missing from the container listing are skipped without a request,
+    # the ETag of the listing is used for the metadata index instead of a properties request
+    from test_blob_listing import make_blob_service_client
+    from metadata_index import MetadataIndex
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = [("file1.dcm", "dicoms"), ("missing.dcm", "dicoms")]
+    mock_conn = MagicMock()
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_psycopg_connect.return_value.__enter__.return_value = mock_conn
+
+    blob_service_client = make_blob_service_client({"dicoms": [("file1.dcm", 100, "etag1")]})
+    blob_service_client.get_blob_client.return_value.download_blob.return_value.readall.return_value = b"dicom"
+    mock_blob_service_client.from_connection_string.return_value = blob_service_client
+    mock_dcmread.return_value = FakeDicom({
+        "InstanceCreationDate": "20250115",
+        "InstanceCreationTime": "120000",
+        "StudyInstanceUID": "1.2.3",
+        "ReferencedSeriesSequence": [AttrDict({"SeriesInstanceUID": "4.5.6"})],
+        "ReferencedPerformedProcedureStepSequence": [AttrDict({"ReferencedSOPInstanceUID": "7.8.9"})]
+    })
+
+    with aggregate_pdf_reports.PipelineSession(list_blobs=True) as session, \
+            MetadataIndex(tmp_path / "index.sqlite") as index:
+        result = aggregate_pdf_reports.get_pdf_file_names(datetime(2025, 1, 14), datetime(2025, 1, 16),
+                                                          index=index, session=session)
+        assert index.get("dicoms", "file1.dcm", "etag1") is not None
+
+    assert result == ["1.2.3_4.5.6_7.8.9.pdf"]
+    blob_service_client.get_blob_client.assert_called_once_with("dicoms", "file1.dcm")
+    blob_service_client.get_blob_client.return_value.get_blob_properties.assert_not_called()
+    assert session.metrics.counters["blob_misses"] == 1
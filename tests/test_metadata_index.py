@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+from metadata_index import DicomMetadata, MetadataIndex
+
+METADATA = DicomMetadata(
+    readable=True,
+    created=datetime(2025, 1, 15, 12),
+    study_instance_uid="1.2.3",
+    series_instance_uid="4.5.6",
+    referenced_sop_instance_uid="7.8.9",
+)
+
+def test_metadata_index_roundtrip(tmp_path):
+    with MetadataIndex(tmp_path / "index.sqlite") as index:
+        index.put("dicoms", "file1.dcm", "etag1", METADATA)
+        index.put("dicoms", "file2.dcm", "etag1", DicomMetadata(readable=False))
+
+    # the index is persisted across runs
+    with MetadataIndex(tmp_path / "index.sqlite") as index:
+        assert index.get("dicoms", "file1.dcm", "etag1") == METADATA
+        assert index.get("dicoms", "file2.dcm", "etag1") == DicomMetadata(readable=False)
+        assert index.get("dicoms", "file3.dcm", "etag1") is None
+
+def test_metadata_index_etag_changed(tmp_path):
+    with MetadataIndex(tmp_path / "index.sqlite") as index:
+        index.put("dicoms", "file1.dcm", "etag1", METADATA)
+        assert index.get("dicoms", "file1.dcm", "etag2") is None
+
+        index.put("dicoms", "file1.dcm", "etag2", DicomMetadata(readable=False))
+        assert index.get("dicoms", "file1.dcm", "etag2") == DicomMetadata(readable=False)
+        assert index.get("dicoms", "file1.dcm", "etag1") is None
+
+def test_metadata_index_eviction(tmp_path):
+    with MetadataIndex(tmp_path / "index.sqlite", max_entries=2) as index:
+        for i in range(3):
+            index.put("dicoms", f"file{i}.dcm", "etag", METADATA)
+        assert index.evict() == 1
+        assert index.get("dicoms", "file0.dcm", "etag") is None
+        assert index.get("dicoms", "file2.dcm", "etag") == METADATA
+
+    with MetadataIndex(tmp_path / "index.sqlite", max_age=timedelta(days=-1)) as index:
+        assert index.evict() == 2
+
+def test_dicom_metadata_pdf_file_name():
+    assert METADATA.pdf_file_name == "1.2.3_4.5.6_7.8.9.pdf"
+    assert METADATA.skip_reason is None
+    assert METADATA._replace(series_instance_uid=None).pdf_file_name is None
+    assert METADATA._replace(series_instance_uid=None).skip_reason == "Missing SeriesInstanceUID"
@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from missing_blobs import MissingBlobCache
+
+def test_missing_blob_cache_persists(tmp_path):
+    with MissingBlobCache(tmp_path / "missing.sqlite") as cache:
+        cache.add("pdf-reports", "/tmp/a.pdf")
+        assert cache.is_missing("pdf-reports", "/tmp/a.pdf")
+        assert not cache.is_missing("pdf-reports", "/tmp/b.pdf")
+
+    # the cache is persisted across runs
+    with MissingBlobCache(tmp_path / "missing.sqlite") as cache:
+        assert cache.is_missing("pdf-reports", "/tmp/a.pdf")
+
+def test_missing_blob_cache_reprobe_backoff(tmp_path):
+    now = datetime(2025, 1, 15, 12)
+    with MissingBlobCache(tmp_path / "missing.sqlite", ttl=timedelta(hours=1), max_ttl=timedelta(hours=3)) as cache, \
+            patch("missing_blobs.datetime") as mock_datetime:
+        mock_datetime.now.return_value = now
+        cache.add("dicoms", "file1.dcm")
+
+        # due for a re-probe after the TTL, every further miss doubles the wait up to the maximum
+        mock_datetime.now.return_value = now + timedelta(minutes=59)
+        assert cache.is_missing("dicoms", "file1.dcm")
+        mock_datetime.now.return_value = now + timedelta(hours=1)
+        assert not cache.is_missing("dicoms", "file1.dcm")
+
+        cache.add("dicoms", "file1.dcm")
+        mock_datetime.now.return_value = now + timedelta(hours=2, minutes=59)
+        assert cache.is_missing("dicoms", "file1.dcm")
+        mock_datetime.now.return_value = now + timedelta(hours=3)
+        assert not cache.is_missing("dicoms", "file1.dcm")
+
+        cache.add("dicoms", "file1.dcm")
+        cache.add("dicoms", "file1.dcm")
+        mock_datetime.now.return_value = now + timedelta(hours=6)
+        assert not cache.is_missing("dicoms", "file1.dcm")
+
+def test_missing_blob_cache_discard(tmp_path):
+    with MissingBlobCache(tmp_path / "missing.sqlite") as cache:
+        cache.add("dicoms", "file1.dcm")
+        cache.discard("dicoms", "file1.dcm")
+        cache.discard("dicoms", "file2.dcm")
+        assert not cache.is_missing("dicoms", "file1.dcm")
+
+    with MissingBlobCache(tmp_path / "missing.sqlite") as cache:
+        assert not cache.is_missing("dicoms", "file1.dcm")
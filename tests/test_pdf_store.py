@@ -0,0 +1,56 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest.mock import patch
+from aggregate_pdf_reports import fetch_pdf_into_store
+from pdf_store import ContentStore
+
+def test_content_store_dedupes_content(tmp_path):
+    with ContentStore(tmp_path) as store:
+        path_a = store.store("a.pdf", b"%PDF same")
+        path_b = store.store("b.pdf", b"%PDF same")
+        path_c = store.store("c.pdf", b"%PDF other")
+
+        assert path_a == path_b != path_c
+        assert Path(path_a).read_bytes() == b"%PDF same"
+        assert store.lookup("a.pdf") == path_a
+        assert store.lookup("missing.pdf") is None
+
+    assert len(list((tmp_path / "objects").rglob("*.pdf"))) == 2
+    # the manifest is persisted across runs
+    with ContentStore(tmp_path) as store:
+        assert store.lookup("c.pdf") == path_c
+
+def test_content_store_moves_files_in(tmp_path):
+    with ContentStore(tmp_path) as store:
+        paths = []
+        for name in ("a.pdf", "b.pdf"):
+            spooled = store.objects_dir / f"{name}.tmp"
+            spooled.write_bytes(b"%PDF same")
+            paths.append(store.store_file(name, spooled))
+            assert not spooled.exists()
+
+        assert paths[0] == paths[1] == store.store("c.pdf", b"%PDF same")
+        assert Path(paths[0]).read_bytes() == b"%PDF same"
+        assert store.lookup("b.pdf") == paths[0]
+
+def test_content_store_concurrent_writers(tmp_path):
+    with ContentStore(tmp_path) as store:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            paths = list(executor.map(lambda i: store.store(f"{i}.pdf", b"%PDF " + bytes([i % 4])), range(64)))
+
+        assert len(set(paths)) == 4
+        assert all(store.lookup(f"{i}.pdf") == paths[i] for i in range(64))
+    assert not list(tmp_path.rglob("*.tmp"))
+
+@patch("aggregate_pdf_reports.download_pdf_from_azure")
+def test_fetch_pdf_into_store_downloads_once(mock_download, tmp_path):
+    mock_download.side_effect = lambda name, session=None: "download_failed" if name == "missing.pdf" else b"%PDF"
+
+    with ContentStore(tmp_path) as store:
+        first = fetch_pdf_into_store("a.pdf", store)
+        second = fetch_pdf_into_store("a.pdf", store)
+        missing = fetch_pdf_into_store("missing.pdf", store)
+
+    assert first == second
+    assert missing == "download_failed"
+    assert mock_download.call_count == 2
@@ -0,0 +1,34 @@
+from unittest.mock import patch, MagicMock
+import aggregate_pdf_reports
+from aggregate_pdf_reports import PipelineSession, download_pdf_from_azure
+
+@patch("aggregate_pdf_reports.load_dotenv")
+@patch("aggregate_pdf_reports.BlobServiceClient")
+def test_session_reuses_blob_service_client(mock_blob_service_client, mock_load_dotenv):
+    mock_blob_client = MagicMock()
+    mock_blob_client.download_blob.return_value.readall.return_value = b"%PDF-1.4"
+    mock_blob_service_client.from_connection_string.return_value.get_blob_client.return_value = mock_blob_client
+
+    with PipelineSession() as session:
+        assert download_pdf_from_azure("a.pdf", session=session) == b"%PDF-1.4"
+        assert download_pdf_from_azure("b.pdf", session=session) == b"%PDF-1.4"
+
+    # configuration is loaded and the client is created only once for the whole session
+    mock_load_dotenv.assert_called_once()
+    mock_blob_service_client.from_connection_string.assert_called_once()
+    mock_blob_service_client.from_connection_string.return_value.close.assert_called_once()
+
+@patch("aggregate_pdf_reports.load_dotenv")
+@patch("aggregate_pdf_reports.os.getenv")
+@patch("aggregate_pdf_reports.psycopg.connect")
+def test_session_reuses_pg_connection(mock_psycopg_connect, mock_getenv, mock_load_dotenv):
+    mock_getenv.side_effect = lambda key, default=None: {"PG_HOST": "db.local"}.get(key, default)
+
+    with PipelineSession() as session:
+        assert session.pg_connection() is session.pg_connection()
+        assert session.pg_connection() is mock_psycopg_connect.return_value.__enter__.return_value
+        assert str(session.pdf_target_dir) == "pdf_reports"
+
+    mock_psycopg_connect.assert_called_once()
+    assert mock_psycopg_connect.call_args.kwargs["host"] == "db.local"
+    mock_psycopg_connect.return_value.__exit__.assert_called_once()
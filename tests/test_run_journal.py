@@ -0,0 +1,37 @@
+from datetime import datetime
+from run_journal import RunJournal
+
+def test_run_journal_persists_resolved_and_stored(tmp_path):
+    report = tmp_path / "report1.pdf"
+    report.write_bytes(b"%PDF")
+
+    with RunJournal(tmp_path / "journal.sqlite") as journal:
+        assert journal.window is None
+        journal.start(datetime(2025, 1, 1), datetime(2025, 1, 15))
+        journal.record_resolved("dicoms", "a.dcm", "a.pdf")
+        journal.record_resolved("dicoms", "b.dcm", None)
+        journal.record_stored("a.pdf", str(report))
+
+    with RunJournal(tmp_path / "journal.sqlite", resume=True) as journal:
+        assert journal.window == (datetime(2025, 1, 1), datetime(2025, 1, 15))
+        assert journal.resolved == {("dicoms", "a.dcm"): "a.pdf", ("dicoms", "b.dcm"): None}
+        assert journal.stored_path("a.pdf") == str(report)
+        assert journal.stored_path("b.pdf") is None
+
+def test_run_journal_ignores_stored_files_that_are_gone(tmp_path):
+    report = tmp_path / "report1.pdf"
+    report.write_bytes(b"%PDF")
+    with RunJournal(tmp_path / "journal.sqlite") as journal:
+        journal.record_stored("a.pdf", str(report))
+        report.unlink()
+
+        assert journal.stored_path("a.pdf") is None
+
+def test_run_journal_starts_over_without_resume(tmp_path):
+    with RunJournal(tmp_path / "journal.sqlite") as journal:
+        journal.start(datetime(2025, 1, 1), datetime(2025, 1, 15))
+        journal.record_resolved("dicoms", "a.dcm", "a.pdf")
+
+    with RunJournal(tmp_path / "journal.sqlite") as journal:
+        assert journal.window is None
+        assert journal.resolved == {}
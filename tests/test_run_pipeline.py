@@ -0,0 +1,152 @@
+import threading
+import pytest
+from datetime import datetime
+from unittest.mock import patch, MagicMock
+import aggregate_pdf_reports
+from metadata_index import DicomMetadata
+from pdf_store import ContentStore
+from run_journal import RunJournal
+
+def make_session():
+    # Helper building a mocked session without the optional byte budget
+    session = MagicMock()
+    session.byte_budget = None
+    return session
+
+@patch("aggregate_pdf_reports.join_pdfs")
+@patch("aggregate_pdf_reports.store_pdf_on_disk")
+@patch("aggregate_pdf_reports.download_pdf_from_azure")
+@patch("aggregate_pdf_reports.iter_pdf_file_names")
+def test_run_pipeline_streams_stages(mock_iter_names, mock_download, mock_store, mock_join):
+    first_downloaded = threading.Event()
+
+    def fake_iter_names(*args):
+        yield "a.pdf"
+        # the download of the first name has to start before the resolution finishes
+        assert first_downloaded.wait(timeout=5)
+        yield "b.pdf"
+        yield "c.pdf"
+    mock_iter_names.side_effect = fake_iter_names
+
+    def fake_download(pdf_file_name, session=None):
+        first_downloaded.set()
+        return pdf_file_name.encode()
+    mock_download.side_effect = fake_download
+    mock_store.side_effect = lambda pdf, session=None: "/reports/" + pdf.decode()
+
+    joined = []
+    mock_join.side_effect = lambda pdf_paths, session=None: joined.extend(pdf_paths)
+
+    aggregate_pdf_reports.run_pipeline(datetime(2025, 1, 14), datetime(2025, 1, 16), workers=2,
+                                       session=make_session(), queue_size=1)
+
+    assert joined == ["/reports/a.pdf", "/reports/b.pdf", "/reports/c.pdf"]
+
+@patch("aggregate_pdf_reports.join_pdfs")
+@patch("aggregate_pdf_reports.download_pdf_from_azure")
+@patch("aggregate_pdf_reports.iter_pdf_file_names")
+def test_run_pipeline_propagates_errors(mock_iter_names, mock_download, mock_join):
+    mock_iter_names.side_effect = ValueError("Failed to connect to the database after retries.")
+    mock_join.side_effect = lambda pdf_paths, session=None: list(pdf_paths)
+
+    with pytest.raises(ValueError, match="Failed to connect"):
+        aggregate_pdf_reports.run_pipeline(datetime(2025, 1, 14), datetime(2025, 1, 16), session=make_session())
+    mock_download.assert_not_called()
+
+@patch("aggregate_pdf_reports.join_pdfs")
+@patch("aggregate_pdf_reports.download_pdf_from_azure")
+@patch("aggregate_pdf_reports.iter_pdf_file_names")
+def test_run_pipeline_content_store_dedupes_names(mock_iter_names, mock_download, mock_join, tmp_path):
+    mock_iter_names.side_effect = lambda *args: iter(["a.pdf", "b.pdf", "a.pdf"])
+    mock_download.side_effect = lambda pdf_file_name, session=None: pdf_file_name.encode()
+    joined = []
+    mock_join.side_effect = lambda pdf_paths, session=None: joined.extend(pdf_paths)
+
+    with ContentStore(tmp_path) as store:
+        aggregate_pdf_reports.run_pipeline(datetime(2025, 1, 14), datetime(2025, 1, 16), workers=2,
+                                           session=make_session(), content_store=store)
+        aggregate_pdf_reports.run_pipeline(datetime(2025, 1, 14), datetime(2025, 1, 16), workers=2,
+                                           session=make_session(), content_store=store)
+        assert joined == [store.lookup("a.pdf"), store.lookup("b.pdf")] * 2
+
+    # the second run finds both reports in the store
+    assert mock_download.call_count == 2
+
+@patch("aggregate_pdf_reports.join_pdfs")
+@patch("aggregate_pdf_reports.download_pdf_from_azure")
+@patch("aggregate_pdf_reports._get_dicom_metadata")
+@patch("aggregate_pdf_reports._query_dicom_reports")
+def test_run_pipeline_resumes_from_journal(mock_query, mock_metadata, mock_download, mock_join, tmp_path):
+    mock_query.side_effect = lambda *args: iter([("a.dcm", "dicoms"), ("skipped.dcm", "dicoms"),
+                                                 ("b.dcm", "dicoms"), ("c.dcm", "dicoms")])
+
+    def fake_metadata(blob_service_client, file_name, *args):
+        if file_name == "skipped.dcm":
+            return DicomMetadata(readable=False)
+        uid = file_name.removesuffix(".dcm")
+        return DicomMetadata(True, datetime(2025, 1, 15), uid, uid, uid)
+    mock_metadata.side_effect = fake_metadata
+
+    crashed = []
+    def fake_download(pdf_file_name, session=None):
+        # the run dies while downloading the last report
+        if pdf_file_name == "c_c_c.pdf" and not crashed:
+            crashed.append(pdf_file_name)
+            raise MemoryError()
+        return pdf_file_name.encode()
+    mock_download.side_effect = fake_download
+    joined = []
+    mock_join.side_effect = lambda pdf_paths, session=None: joined.extend(pdf_paths)
+
+    session = make_session()
+    session.pdf_target_dir = tmp_path / "pdfs"
+    with RunJournal(tmp_path / "journal.sqlite") as journal, pytest.raises(MemoryError):
+        aggregate_pdf_reports.run_pipeline(datetime(2025, 1, 14), datetime(2025, 1, 16), session=session,
+                                           journal=journal)
+    joined.clear()
+    with RunJournal(tmp_path / "journal.sqlite", resume=True) as journal:
+        aggregate_pdf_reports.run_pipeline(datetime(2025, 1, 14), datetime(2025, 1, 16), session=session,
+                                           journal=journal)
+
+    assert [(tmp_path / "pdfs" / path).read_bytes() for path in joined] == [b"a_a_a.pdf", b"b_b_b.pdf", b"c_c_c.pdf"]
+    # nothing finished before the crash is resolved or downloaded again
+    downloaded = [call.args[0] for call in mock_download.call_args_list]
+    assert downloaded.count("a_a_a.pdf") == 1 and downloaded.count("b_b_b.pdf") == 1
+    resolved = [call.args[1] for call in mock_metadata.call_args_list]
+    assert resolved.count("a.dcm") == 1 and resolved.count("skipped.dcm") == 1
+
+@patch("aggregate_pdf_reports.store_pdf_on_disk")
+@patch("aggregate_pdf_reports.download_pdf_from_azure")
+@patch("aggregate_pdf_reports._iter_resolved_reports")
+def test_run_pipeline_groups_by_study(mock_resolved, mock_download, mock_store):
+    mock_resolved.side_effect = lambda *args: iter([
+        (("1.dcm", "c"), "S1_a_b.pdf"), (("2.dcm", "c"), "S2_a_b.pdf"), (("3.dcm", "c"), "S1_c_d.pdf")])
+    mock_download.side_effect = lambda pdf_file_name, session=None: pdf_file_name.encode()
+    mock_store.side_effect = lambda pdf, session=None: "/reports/" + pdf.decode()
+    grouped = []
+
+    aggregate_pdf_reports.run_pipeline(datetime(2025, 1, 14), datetime(2025, 1, 16), workers=2, session=make_session(),
+                                       merge=lambda pairs, session=None: grouped.extend(pairs), group_by="study")
+
+    assert grouped == [("S1", "/reports/S1_a_b.pdf"), ("S2", "/reports/S2_a_b.pdf"), ("S1", "/reports/S1_c_d.pdf")]
+
+@patch("aggregate_pdf_reports.store_pdf_on_disk")
+@patch("aggregate_pdf_reports.download_pdf_from_azure")
+@patch("aggregate_pdf_reports._iter_resolved_reports")
+def test_run_pipeline_groups_by_aet(mock_resolved, mock_download, mock_store):
+    mock_resolved.side_effect = lambda *args: iter([
+        (("1.dcm", "c"), "S1_a_b.pdf"), (("2.dcm", "c"), "S2_a_b.pdf"), (("3.dcm", "c"), "S3_a_b.pdf")])
+    mock_download.side_effect = lambda pdf_file_name, session=None: pdf_file_name.encode()
+    mock_store.side_effect = lambda pdf, session=None: "/reports/" + pdf.decode()
+    session = make_session()
+    cursor = session.pg_connection.return_value.cursor.return_value.__enter__.return_value
+    cursor.fetchall.return_value = [("1.dcm", "c", "CT1"), ("2.dcm", "c", "MR1")]
+    grouped = []
+
+    aggregate_pdf_reports.run_pipeline(datetime(2025, 1, 14), datetime(2025, 1, 16), session=session,
+                                       merge=lambda pairs, session=None: grouped.extend(pairs), group_by="aet")
+
+    assert cursor.execute.call_args.args[0] == aggregate_pdf_reports.REPORT_AETS_QUERY
+    # a report without an AET lands in its own group
+    assert grouped == [("CT1", "/reports/S1_a_b.pdf"), ("MR1", "/reports/S2_a_b.pdf"),
+                       ("unknown", "/reports/S3_a_b.pdf")]
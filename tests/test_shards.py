@@ -0,0 +1,68 @@
+import os
+from datetime import datetime, timedelta
+from unittest.mock import patch
+import pytest
+import aggregate_pdf_reports
+from local_services import LocalBlobService, LocalPostgres
+from shards import Shard, ShardReport, merge_shards, plan_shards, read_shard, write_shard
+from synthetic import generate_reports
+
+def test_plan_shards_covers_window():
+    shards = plan_shards(datetime(2025, 1, 1), datetime(2025, 1, 3, 12), timedelta(days=1))
+
+    assert shards == [Shard(datetime(2025, 1, 1), datetime(2025, 1, 2)),
+                      Shard(datetime(2025, 1, 2), datetime(2025, 1, 3)),
+                      Shard(datetime(2025, 1, 3), datetime(2025, 1, 3, 12))]
+    assert shards[0].name == "20250101T000000_20250102T000000"
+
+def test_merge_shards_orders_by_id_descending(tmp_path):
+    write_shard(tmp_path / "a.tsv", [ShardReport(9, "i.pdf", "/i"), ShardReport(4, "d.pdf", "/d")])
+    write_shard(tmp_path / "b.tsv", [ShardReport(7, "g.pdf", "/g"), ShardReport(5, "e.pdf", "/e")])
+    write_shard(tmp_path / "c.tsv", [])
+
+    merged = list(merge_shards([tmp_path / "a.tsv", tmp_path / "b.tsv", tmp_path / "c.tsv"]))
+
+    assert [report.id for report in merged] == [9, 7, 5, 4]
+    assert read_shard(tmp_path / "c.tsv") == []
+
+@pytest.fixture
+def local_services(tmp_path):
+    # The pipeline runs against the offline stand-ins of Azure and Postgres used by the benchmarks
+    reports = generate_reports(12, datetime(2025, 1, 15), timedelta(days=4), pixel_bytes=1024)
+    database = LocalPostgres()
+    database.add_reports(reports)
+    blob_service = LocalBlobService(miss_rate=0.2)
+    blob_service.add_reports(reports, pixel_bytes=1024)
+    with patch.dict(os.environ, {"AZURE_CONNECTION_STRING": "local", "PDF_TARGET_DIR": str(tmp_path / "pdfs")}), \
+            patch("aggregate_pdf_reports.load_dotenv"), \
+            patch("aggregate_pdf_reports.BlobServiceClient", blob_service), \
+            patch("aggregate_pdf_reports.psycopg.connect", database):
+        yield blob_service
+
+def test_sharded_run_joins_reports_in_unsharded_order(local_services, tmp_path):
+    from_, to = datetime(2025, 1, 11), datetime(2025, 1, 15)
+    unsharded, sharded = [], []
+
+    aggregate_pdf_reports.run_pipeline(from_, to, stream_to_disk=True,
+                                       merge=lambda pdf_paths, session=None: unsharded.extend(pdf_paths))
+    processed = aggregate_pdf_reports.run_shards(from_, to, timedelta(days=1), tmp_path / "state", workers=2)
+    requests = local_services.requests
+    aggregate_pdf_reports.reduce_shards(from_, to, timedelta(days=1), tmp_path / "state",
+                                        merge=lambda pdf_paths, session=None: sharded.extend(pdf_paths))
+
+    assert processed == 4
+    assert sharded == [path for path in unsharded if path != "download_failed"]
+    assert len(sharded) > 0
+    # the shards are finished, running them again does nothing
+    assert aggregate_pdf_reports.run_shards(from_, to, timedelta(days=1), tmp_path / "state") == 0
+    assert local_services.requests == requests
+
+def test_shards_are_split_between_hosts(local_services, tmp_path):
+    from_, to = datetime(2025, 1, 11), datetime(2025, 1, 15)
+    aggregate_pdf_reports.run_shards(from_, to, timedelta(days=1), tmp_path / "state", shard_index=0, shard_count=2)
+
+    with pytest.raises(ValueError, match="2 shards are not finished"):
+        aggregate_pdf_reports.reduce_shards(from_, to, timedelta(days=1), tmp_path / "state")
+
+    aggregate_pdf_reports.run_shards(from_, to, timedelta(days=1), tmp_path / "state", shard_index=1, shard_count=2)
+    assert len(list((tmp_path / "state" / "shards").glob("*.tsv"))) == 4
@@ -1,4 +1,5 @@
 from pathlib import Path
+import pytest
 from unittest.mock import patch, MagicMock
 from aggregate_pdf_reports import join_pdfs
 
@@ -19,3 +20,220 @@ def test_join_pdfs_skips_failed(mock_writer_class, mock_mkdir, mock_getenv, mock
     assert not any(call.args[0] == "download_failed" for call in mock_writer.append.call_args_list)
     mock_writer.write.assert_called_once_with(str(Path("/fake/output") / "joined_report.pdf"))
     mock_writer.close.assert_called_once()
+
+def make_pdf(path, pages):
+    # Helper writing a real PDF with `pages` blank pages
+    from pypdf import PdfWriter
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=200, height=200)
+    writer.write(str(path))
+    return str(path)
+
+def test_join_pdfs_split_by_pages(tmp_path):
+    import json
+    from pypdf import PdfReader
+    from aggregate_pdf_reports import join_pdfs_split
+
+    sources = [make_pdf(tmp_path / f"report{i}.pdf", 2) for i in range(5)]
+    session = MagicMock()
+    session.joined_pdf_target_dir = tmp_path / "joined"
+    session.joined_pdf_target_dir.mkdir()
+    (session.joined_pdf_target_dir / "joined_report_part009.pdf").write_bytes(b"stale")
+
+    parts = join_pdfs_split(sources[:2] + ["download_failed"] + sources[2:], max_pages=4, max_bytes=None,
+                            session=session)
+
+    assert [Path(part).name for part in parts] == [f"joined_report_part00{i}.pdf" for i in (1, 2, 3)]
+    assert [len(PdfReader(part).pages) for part in parts] == [4, 4, 2]
+    assert not (session.joined_pdf_target_dir / "joined_report_part009.pdf").exists()
+
+    index = json.loads((session.joined_pdf_target_dir / "joined_report_index.json").read_text())
+    assert [part["sources"] for part in index["parts"]] == [sources[0:2], sources[2:4], sources[4:]]
+    assert [part["pages"] for part in index["parts"]] == [4, 4, 2]
+
+def test_join_pdfs_split_by_bytes(tmp_path):
+    from aggregate_pdf_reports import join_pdfs_split
+
+    sources = [make_pdf(tmp_path / f"report{i}.pdf", 1) for i in range(3)]
+    session = MagicMock()
+    session.joined_pdf_target_dir = tmp_path / "joined"
+
+    # a single report larger than the ceiling still gets a part of its own
+    parts = join_pdfs_split(sources, max_pages=None, max_bytes=1, session=session)
+    assert len(parts) == 3
+
+def test_join_pdfs_incremental(tmp_path):
+    import json
+    from pypdf import PdfReader
+    from aggregate_pdf_reports import join_pdfs_incremental
+
+    a, b, c = (make_pdf(tmp_path / f"report{i}.pdf", pages) for i, pages in enumerate((1, 2, 3)))
+    session = MagicMock()
+    session.joined_pdf_target_dir = tmp_path / "joined"
+    joined = session.joined_pdf_target_dir / "joined_report.pdf"
+
+    join_pdfs_incremental([a, b], session=session)
+    first = joined.read_bytes()
+    assert len(PdfReader(joined).pages) == 3
+
+    # a new report is appended after the unchanged original file
+    join_pdfs_incremental([c, "download_failed", a, b], session=session)
+    second = joined.read_bytes()
+    assert second.startswith(first)
+    assert len(PdfReader(joined).pages) == 6
+    manifest = json.loads((session.joined_pdf_target_dir / "joined_report.manifest.json").read_text())
+    assert [source["name"] for source in manifest["sources"]] == ["report0.pdf", "report1.pdf", "report2.pdf"]
+    assert manifest["size"] == len(second)
+
+    # nothing new, nothing written
+    join_pdfs_incremental([a, b, c], session=session)
+    assert joined.read_bytes() == second
+
+    # an expired report forces a rebuild
+    join_pdfs_incremental([b, c], session=session)
+    assert len(PdfReader(joined).pages) == 5
+    assert not joined.read_bytes().startswith(first)
+
+def test_join_pdfs_incremental_hashes_only_new_reports(tmp_path):
+    from pypdf import PdfReader
+    import aggregate_pdf_reports
+    from aggregate_pdf_reports import join_pdfs_incremental
+
+    a, b, c = (make_pdf(tmp_path / f"report{i}.pdf", pages) for i, pages in enumerate((1, 2, 3)))
+    session = MagicMock()
+    session.joined_pdf_target_dir = tmp_path / "joined"
+    join_pdfs_incremental([a, b], session=session)
+
+    with patch("aggregate_pdf_reports._file_sha256", wraps=aggregate_pdf_reports._file_sha256) as file_sha256:
+        join_pdfs_incremental([a, b, c], session=session)
+
+    file_sha256.assert_called_once_with(c)
+    assert len(PdfReader(session.joined_pdf_target_dir / "joined_report.pdf").pages) == 6
+
+def test_join_pdfs_incremental_append_costs_the_new_reports(tmp_path):
+    import os
+    import tracemalloc
+    from pypdf import PdfReader, PdfWriter
+    from pypdf.generic import DecodedStreamObject
+    from aggregate_pdf_reports import join_pdfs_incremental
+
+    # reports with incompressible page content, the joined file is about 12 MB
+    sources = []
+    for i in range(400):
+        writer = PdfWriter()
+        content = DecodedStreamObject()
+        content.set_data(b"% " + os.urandom(15_000).hex().encode() + b"\n")
+        writer.add_blank_page(width=200, height=200).replace_contents(content)
+        writer.write(str(tmp_path / f"report{i}.pdf"))
+        sources.append(str(tmp_path / f"report{i}.pdf"))
+    new = make_pdf(tmp_path / "new.pdf", 2)
+    session = MagicMock()
+    session.joined_pdf_target_dir = tmp_path / "joined"
+    joined = session.joined_pdf_target_dir / "joined_report.pdf"
+    join_pdfs_incremental(sources, session=session)
+    size = joined.stat().st_size
+
+    tracemalloc.start()
+    try:
+        join_pdfs_incremental(sources + [new], session=session)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    # neither the joined file nor its pages are loaded, only its cross-reference table (and a 1 MB hashing buffer)
+    assert peak < size / 6
+    reader = PdfReader(joined, strict=True)
+    assert len(reader.pages) == 402
+    assert reader.pages[0].get_contents().get_data() == PdfReader(sources[0]).pages[0].get_contents().get_data()
+
+def test_join_pdfs_memory_mapped(tmp_path):
+    from pypdf import PdfReader
+
+    sources = [make_pdf(tmp_path / f"report{i}.pdf", i + 1) for i in range(3)]
+    session = MagicMock()
+    session.joined_pdf_target_dir = tmp_path / "joined"
+
+    join_pdfs(sources + ["download_failed"], session=session, use_mmap=True)
+
+    assert len(PdfReader(tmp_path / "joined" / "joined_report.pdf").pages) == 6
+
+def make_templated_pdf(path, title):
+    # Helper writing a report that carries its own copy of a shared logo template, like the real reports
+    from reportlab.pdfgen import canvas
+    pdf = canvas.Canvas(str(path))
+    pdf.beginForm("logo")
+    for i in range(500):
+        pdf.circle(50 + i % 50, 50 + i // 50, 5)
+    pdf.endForm()
+    pdf.doForm("logo")
+    pdf.drawString(72, 700, title)
+    pdf.showPage()
+    pdf.save()
+    return str(path)
+
+def test_join_pdfs_optimize_deduplicates_shared_objects(tmp_path):
+    from pypdf import PdfReader
+
+    sources = [make_templated_pdf(tmp_path / f"report{i}.pdf", f"Report {i}") for i in range(10)]
+    session = MagicMock()
+    session.joined_pdf_target_dir = tmp_path / "joined"
+
+    join_pdfs(sources, session=session, optimize=True)
+
+    joined = tmp_path / "joined" / "joined_report.pdf"
+    reader = PdfReader(joined)
+    assert [page.extract_text().strip() for page in reader.pages] == [f"Report {i}" for i in range(10)]
+    input_bytes = sum(Path(source).stat().st_size for source in sources)
+    assert joined.stat().st_size * 5 < input_bytes
+    session.metrics.increment.assert_any_call("merge_input_bytes", input_bytes)
+    session.metrics.increment.assert_any_call("merge_output_bytes", joined.stat().st_size)
+
+def test_optimize_merged_stops_when_nothing_is_left_to_merge(tmp_path):
+    from io import BytesIO
+    from pypdf import PdfWriter
+    from aggregate_pdf_reports import _optimize_merged
+
+    merger = PdfWriter()
+    for i in range(4):
+        merger.append(make_templated_pdf(tmp_path / f"report{i}.pdf", f"Report {i}"))
+    session = MagicMock()
+
+    with patch.object(merger, "compress_identical_objects", wraps=merger.compress_identical_objects) as passes:
+        _optimize_merged(merger, session)
+
+    # the copies of the templates merge only in a later pass than the objects they reference
+    assert passes.call_count >= 3
+    optimized = BytesIO()
+    merger.write(optimized)
+    merger.compress_identical_objects(remove_duplicates=True, remove_unreferenced=True)
+    again = BytesIO()
+    merger.write(again)
+    assert len(again.getvalue()) == len(optimized.getvalue())
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_join_pdfs_grouped(tmp_path, processes):
+    import json
+    from pypdf import PdfReader
+    from aggregate_pdf_reports import join_pdfs_grouped
+    from telemetry import RunMetrics
+
+    a, b, c = (make_pdf(tmp_path / f"report{i}.pdf", pages) for i, pages in enumerate((1, 2, 3)))
+    session = MagicMock()
+    session.metrics = RunMetrics()
+    session.joined_pdf_target_dir = tmp_path / "joined"
+    session.joined_pdf_target_dir.mkdir()
+    (session.joined_pdf_target_dir / "joined_report_aet_OLD.pdf").write_bytes(b"stale")
+
+    paths = join_pdfs_grouped([("CT/1", a), ("MR", b), ("CT/1", c), ("MR", "download_failed")], "aet",
+                              session=session, processes=processes)
+
+    assert [Path(path).name for path in paths] == ["joined_report_aet_CT_1.pdf", "joined_report_aet_MR.pdf"]
+    assert [len(PdfReader(path).pages) for path in paths] == [4, 2]
+    assert not (session.joined_pdf_target_dir / "joined_report_aet_OLD.pdf").exists()
+    index = json.loads((session.joined_pdf_target_dir / "joined_report_groups.json").read_text())
+    assert index["group_by"] == "aet"
+    assert [(group["group"], group["reports"], group["sources"]) for group in index["groups"]] == [
+        ("CT/1", 2, [a, c]), ("MR", 1, [b])]
+    # the merges in worker processes are counted in the session metrics as well
+    assert session.metrics.stages["merge"].count == 3 and session.metrics.stages["merge_write"].count == 2
@@ -0,0 +1,53 @@
+import json
+import logging
+import pytest
+from telemetry import RunMetrics, JsonFormatter, skip_label
+
+def test_run_metrics_stage_histogram():
+    metrics = RunMetrics()
+    metrics.observe("pdf_download", 0.002, nbytes=100)
+    metrics.observe("pdf_download", 0.3, nbytes=50)
+    with pytest.raises(RuntimeError):
+        with metrics.stage("pdf_download") as span:
+            span.bytes = 10
+            raise RuntimeError("failed")
+
+    stage = metrics.summary()["stages"]["pdf_download"]
+    assert stage["count"] == 3
+    assert stage["errors"] == 1
+    assert stage["bytes"] == 160
+    assert stage["buckets"]["0.005"] == 2
+    assert stage["buckets"]["0.5"] == 1
+    assert stage["p99_seconds"] == 0.3
+
+def test_skip_labels():
+    assert skip_label(" not in storage") == "not_in_storage"
+    assert skip_label(" Date 2025-01-01 00:00:00 not in the range") == "not_in_range"
+    assert skip_label(" Missing StudyInstanceUID") == "missing_studyinstanceuid"
+
+def test_run_metrics_exports(tmp_path):
+    metrics = RunMetrics()
+    metrics.observe("db", 0.02)
+    metrics.skip(" Read failed", "file1.dcm")
+    metrics.increment("reports_resolved", 2)
+
+    metrics.write_json(tmp_path / "metrics.json")
+    metrics.write_prometheus(tmp_path / "metrics.prom")
+
+    summary = json.loads((tmp_path / "metrics.json").read_text())
+    assert summary["skipped"] == {"read_failed": 1}
+    assert summary["counters"] == {"reports_resolved": 2}
+    prom = (tmp_path / "metrics.prom").read_text()
+    assert 'pdf_reports_stage_seconds_bucket{stage="db",le="0.025"} 1' in prom
+    assert 'pdf_reports_stage_seconds_bucket{stage="db",le="+Inf"} 1' in prom
+    assert 'pdf_reports_skipped_total{reason="read_failed"} 1' in prom
+    assert "pdf_reports_reports_resolved_total 2" in prom
+
+def test_json_formatter_includes_extra_fields():
+    record = logging.LogRecord("aggregate_pdf_reports", logging.DEBUG, __file__, 1, "stage %s", ("db",), None)
+    record.stage = "db"
+    record.bytes = 42
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["message"] == "stage db"
+    assert entry["stage"] == "db"
+    assert entry["bytes"] == 42
@@ -0,0 +1,140 @@
+import os
+from datetime import datetime, timedelta
+from unittest.mock import patch
+import pytest
+from pypdf import PdfReader
+import aggregate_pdf_reports
+from local_services import LocalBlobService, LocalPostgres
+from pipeline_state import read_json
+from synthetic import generate_reports
+
+@pytest.fixture
+def services(tmp_path):
+    # The offline stand-ins of Azure and Postgres used by the benchmarks, filled as the test goes
+    database = LocalPostgres()
+    blob_service = LocalBlobService()
+    with patch.dict(os.environ, {"AZURE_CONNECTION_STRING": "local", "PDF_TARGET_DIR": str(tmp_path / "pdfs"),
+                                 "JOINED_PDF_TARGET_DIR": str(tmp_path / "joined")}), \
+            patch("aggregate_pdf_reports.load_dotenv"), \
+            patch("aggregate_pdf_reports.BlobServiceClient", blob_service), \
+            patch("aggregate_pdf_reports.psycopg.connect", database):
+        yield database, blob_service
+
+def test_watch_processes_only_new_reports(services, tmp_path):
+    database, blob_service = services
+    reports = generate_reports(7, datetime.now() - timedelta(hours=1), timedelta(days=2), pixel_bytes=1024)
+    resolved = []
+    get_dicom_metadata = aggregate_pdf_reports._get_dicom_metadata
+
+    def spy(blob_service_client, file_name, *args):
+        resolved.append(file_name)
+        return get_dicom_metadata(blob_service_client, file_name, *args)
+
+    cycles = []
+    with patch("aggregate_pdf_reports._get_dicom_metadata", side_effect=spy):
+        for batch in (reports[:4], [], reports[4:]):
+            database.add_reports(batch)
+            blob_service.add_reports(batch, pixel_bytes=1024)
+            with aggregate_pdf_reports.PipelineSession() as session:
+                aggregate_pdf_reports.watch_reports(timedelta(days=3), tmp_path / "state", poll_interval=0,
+                                                    session=session, cycles=1, on_cycle=cycles.append)
+
+    # every report is resolved once, the empty cycle does not touch Azure
+    assert sorted(resolved) == sorted(report.file_name for report in reports)
+    assert len(cycles) == 2
+    state = read_json(tmp_path / "state" / "watch.json")
+    assert state["high_water_mark"] == 7 and state["merged"]
+    assert len(state["reports"]) == 7
+    assert len(PdfReader(tmp_path / "joined" / "joined_report.pdf").pages) == 7
+
+def test_watch_polls_until_cycles_are_done(services, tmp_path):
+    with patch("aggregate_pdf_reports.sleep") as mock_sleep:
+        aggregate_pdf_reports.watch_reports(timedelta(days=3), tmp_path / "state", poll_interval=5, cycles=3)
+
+    assert [call.args[0] for call in mock_sleep.call_args_list] == [5, 5]
+    assert read_json(tmp_path / "state" / "watch.json") is None
+
+def test_watch_retries_pdf_reports_uploaded_later(services, tmp_path):
+    database, blob_service = services
+    report, = generate_reports(1, datetime.now() - timedelta(hours=1), timedelta(days=1), pixel_bytes=1024)
+    database.add_reports([report])
+    # the DICOM file is stored, its PDF report is not uploaded yet
+    blob_service.add(report.container, report.file_name, report.dicom_header, 1024)
+
+    with aggregate_pdf_reports.PipelineSession() as session:
+        aggregate_pdf_reports.watch_reports(timedelta(days=3), tmp_path / "state", session=session, cycles=1)
+        assert read_json(tmp_path / "state" / "watch.json")["pending"][report.pdf_file_name]["attempts"] == 1
+
+        blob_service.add_reports([report], pixel_bytes=1024)
+        aggregate_pdf_reports.watch_reports(timedelta(days=3), tmp_path / "state", session=session, cycles=1)
+
+    state = read_json(tmp_path / "state" / "watch.json")
+    assert state["pending"] == {}
+    assert len(state["reports"]) == 1
+
+def test_watch_retries_dicom_files_uploaded_later(services, tmp_path):
+    database, blob_service = services
+    reports = generate_reports(2, datetime.now() - timedelta(hours=1), timedelta(days=1), pixel_bytes=1024)
+    database.add_reports(reports)
+    # the second DICOM file is not stored yet, the mark moves past it
+    blob_service.add_reports(reports[:1], pixel_bytes=1024)
+
+    with aggregate_pdf_reports.PipelineSession() as session:
+        aggregate_pdf_reports.watch_reports(timedelta(days=3), tmp_path / "state", session=session, cycles=1)
+        state = read_json(tmp_path / "state" / "watch.json")
+        assert state["high_water_mark"] == 2
+        assert [(entry["container"], entry["file_name"], entry["attempts"]) for entry in state["pending_dicoms"]] \
+            == [(reports[1].container, reports[1].file_name, 1)]
+
+        blob_service.add_reports(reports[1:], pixel_bytes=1024)
+        aggregate_pdf_reports.watch_reports(timedelta(days=3), tmp_path / "state", session=session, cycles=1)
+
+    state = read_json(tmp_path / "state" / "watch.json")
+    assert state["pending_dicoms"] == []
+    assert sorted(report["id"] for report in state["reports"]) == [1, 2]
+    assert len(PdfReader(tmp_path / "joined" / "joined_report.pdf").pages) == 2
+
+def test_watch_picks_up_rows_committed_out_of_order(services, tmp_path):
+    database, blob_service = services
+    reports = generate_reports(3, datetime.now() - timedelta(hours=1), timedelta(days=1), pixel_bytes=1024)
+    blob_service.add_reports(reports, pixel_bytes=1024)
+
+    # the row with id 2 commits after the one with id 3
+    for batch in ([reports[0], reports[2]], [reports[1]], []):
+        database.add_reports(batch)
+        with aggregate_pdf_reports.PipelineSession() as session:
+            aggregate_pdf_reports.watch_reports(timedelta(days=3), tmp_path / "state", session=session, cycles=1)
+
+    state = read_json(tmp_path / "state" / "watch.json")
+    assert state["high_water_mark"] == 3 and state["seen_ids"] == [1, 2, 3]
+    assert sorted(report["id"] for report in state["reports"]) == [1, 2, 3]
+    assert len(PdfReader(tmp_path / "joined" / "joined_report.pdf").pages) == 3
+
+def test_watch_drops_reports_that_left_the_window(services, tmp_path):
+    database, blob_service = services
+    reports = generate_reports(4, datetime.now(), timedelta(days=4), pixel_bytes=1024)
+    database.add_reports(reports)
+    blob_service.add_reports(reports, pixel_bytes=1024)
+
+    with aggregate_pdf_reports.PipelineSession() as session:
+        aggregate_pdf_reports.watch_reports(timedelta(days=5), tmp_path / "state", session=session, cycles=1)
+        aggregate_pdf_reports.watch_reports(timedelta(days=2), tmp_path / "state", session=session, cycles=1)
+
+    state = read_json(tmp_path / "state" / "watch.json")
+    window_from = datetime.now() - timedelta(days=2)
+    kept = [report.id for report in reports if report.created_at > window_from]
+    assert 0 < len(kept) < 4
+    assert sorted(report["id"] for report in state["reports"]) == kept
+    assert len(PdfReader(tmp_path / "joined" / "joined_report.pdf").pages) == len(kept)
+
+def test_watch_command(services, tmp_path):
+    database, blob_service = services
+    reports = generate_reports(3, datetime.now() - timedelta(hours=1), timedelta(days=1), pixel_bytes=1024)
+    database.add_reports(reports)
+    blob_service.add_reports(reports, pixel_bytes=1024)
+
+    aggregate_pdf_reports.main(["watch", "--state-dir", str(tmp_path / "state"), "--cycles", "1", "--workers", "2",
+                                "--metrics-json", str(tmp_path / "metrics.json")])
+
+    assert read_json(tmp_path / "state" / "watch.json")["high_water_mark"] == 3
+    assert read_json(tmp_path / "metrics.json")["counters"]["reports_resolved"] == 3